@@ -17,7 +17,7 @@ import LayerUtils from '../utils/LayerUtils';
 import LocaleUtils from '../utils/LocaleUtils';
 import MapUtils from '../utils/MapUtils';
 import MiscUtils from '../utils/MiscUtils';
-import {Image} from './widgets/Primitives';
+import {Image, SpriteImage} from './widgets/Primitives';
 
 import './style/LayerInfoWindow.css';
 
@@ -63,7 +63,10 @@ class LayerInfoWindow extends React.Component {
         let legend = null;
         const scale = MapUtils.computeForZoom(this.props.map.scales, this.props.map.zoom);
         const legendUrl = LayerUtils.getLegendUrl(this.props.layer, this.props.sublayer, scale, this.props.map, this.props.bboxDependentLegend, this.props.scaleDependentLegend, this.props.extraLegendParameters);
-        if (legendUrl) {
+        const legendSprite = legendUrl ? LayerUtils.getLegendSprite(this.props.layer, this.props.sublayer, this.props.bboxDependentLegend, this.props.scaleDependentLegend, this.props.extraLegendParameters) : null;
+        if (legendSprite) {
+            legend = (<SpriteImage className="layer-info-window-legend" sprite={legendSprite} />);
+        } else if (legendUrl) {
             legend = (<Image className="layer-info-window-legend" src={legendUrl} />);
         } else if (this.props.layer.color) {
             legend = (<span className="layer-info-window-coloricon" style={{backgroundColor: this.props.layer.color}} />);
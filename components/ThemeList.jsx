@@ -153,7 +153,7 @@ class ThemeList extends React.Component {
                             </div>) : null}
                             <div className="theme-item-body" onKeyDown={MiscUtils.checkKeyActivate} tabIndex={0}>
                                 {item.description ? (<div className="theme-item-description" dangerouslySetInnerHTML={{__html: MiscUtils.sanitizeHtml(item.description)}} />) : null}
-                                <img className="theme-item-thumbnail" src={assetsPath + "/" + item.thumbnail} />
+                                <img className="theme-item-thumbnail" src={assetsPath + "/" + item.thumbnail} srcSet={ThemeUtils.getThumbnailSrcSet(item, assetsPath)} />
                             </div>
                             {!item.restricted ? (
                                 <div className="theme-item-icons">
@@ -10,3 +10,14 @@ import React from 'react';
 
 export const Image = React.memo(function Image(props) { return (<img {...props} />); });
 
+// Image cropped from a sprite sheet, sprite is {src, x, y, width, height}
+export const SpriteImage = React.memo(function SpriteImage({sprite, style, ...props}) {
+    const spriteStyle = {
+        display: "inline-block",
+        width: sprite.width + "px",
+        height: sprite.height + "px",
+        background: "url(" + sprite.src + ") -" + sprite.x + "px -" + sprite.y + "px no-repeat",
+        ...style
+    };
+    return (<span role="img" style={spriteStyle} {...props} />);
+});
@@ -21,6 +21,7 @@ import {MapButtonPortalContext} from '../components/PluginsContainer';
 import ConfigUtils from '../utils/ConfigUtils';
 import LocaleUtils from '../utils/LocaleUtils';
 import MiscUtils from '../utils/MiscUtils';
+import ThemeUtils from '../utils/ThemeUtils';
 
 import './style/BackgroundSwitcher.css';
 
@@ -175,7 +176,7 @@ export class BackgroundSwitcher extends React.Component {
                     <span tabIndex="-1" title={this.itemTitle(layer)}>{this.itemTitle(layer)}</span><Icon icon="chevron-down" />
                 </div>
                 <div className="background-switcher-item-thumbnail">
-                    <img src={assetsPath + "/" + layer.thumbnail} />
+                    <img src={assetsPath + "/" + layer.thumbnail} srcSet={ThemeUtils.getThumbnailSrcSet(layer, assetsPath)} />
                 </div>
                 <div className={groupclasses}>
                     {this.props.showGroupThumbnails ? otherLayers.map(l => this.renderLayerItem(l, visibleBgLayer)) : otherLayers.map(l => {
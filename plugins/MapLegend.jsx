@@ -14,7 +14,7 @@ import PropTypes from 'prop-types';
 
 import {setCurrentTask} from '../actions/task';
 import ResizeableWindow from '../components/ResizeableWindow';
-import {Image} from '../components/widgets/Primitives';
+import {Image, SpriteImage} from '../components/widgets/Primitives';
 import LayerUtils from '../utils/LayerUtils';
 import LocaleUtils from '../utils/LocaleUtils';
 import MapUtils from '../utils/MapUtils';
@@ -175,11 +175,12 @@ class MapLegend extends React.Component {
                 return null;
             }
             const request = LayerUtils.getLegendUrl(layer, sublayer, mapScale, this.props.map, this.state.bboxDependentLegend, this.state.scaleDependentLegend, this.props.extraLegendParameters);
+            const sprite = request ? LayerUtils.getLegendSprite(layer, sublayer, this.state.bboxDependentLegend, this.state.scaleDependentLegend, this.props.extraLegendParameters) : null;
             return request ? (
                 <div className="map-legend-legend-entry" key={sublayer.name}>
                     <div>
                         {this.props.addLayerTitles && !sublayer.category_sublayer ? (<div className="map-legend-entry-title">{sublayer.title || sublayer.name}</div>) : null}
-                        <div className="map-legend-entry-image"><Image src={request} /></div>
+                        <div className="map-legend-entry-image">{sprite ? (<SpriteImage sprite={sprite} />) : (<Image src={request} />)}</div>
                     </div>
                 </div>) : null;
         }
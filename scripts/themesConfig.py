@@ -17,43 +17,356 @@ except:
     from urllib import quote
     from urlparse import urljoin
 from xml.dom.minidom import parseString
+import xml.etree.ElementTree as ET
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from collections import Counter, OrderedDict
+import argparse
+import base64
+import contextlib
+import copy
+import filecmp
+import gzip
+import hashlib
+import http.client
+import io
 import json
+import multiprocessing
+import tempfile
+import threading
+import time
+import tracemalloc
 import traceback
 import socket
+import sys
 import re
 import uuid
+import zlib
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+try:
+    from wmts_config_generator import WMTSCapabilities
+except ImportError:
+    WMTSCapabilities = None
+
+
+# default settings of ThemesGenerator, overridable with QWC2_THEMES_* environment variables,
+# resolved when a generator is created
+def getDefaultSettings():
+    return {
+        "baseUrl": "http://" + socket.getfqdn(),
+        "qwc2_path": ".",
+        "themesConfig": os.environ.get("QWC2_THEMES_CONFIG", "static/themesConfig.json"),
+        "outputFile": "./static/themes.json",
+        "themesJobs": int(os.environ.get("QWC2_THEMES_JOBS", "1")),
+        "cacheDir": os.environ.get("QWC2_THEMES_CACHE_DIR", ""),
+        "cacheMaxAge": float(os.environ.get("QWC2_THEMES_CACHE_MAX_AGE", "0")),
+        "incremental": os.environ.get("QWC2_THEMES_INCREMENTAL", "0") == "1",
+        "xmlParser": os.environ.get("QWC2_THEMES_XML_PARSER", "minidom"),
+        "themesProcesses": int(os.environ.get("QWC2_THEMES_PROCESSES", "0")),
+        "processMinSize": int(os.environ.get("QWC2_THEMES_PROCESS_MIN_SIZE", "1000000")),
+        "documentCacheSize": int(os.environ.get("QWC2_THEMES_DOCUMENT_CACHE_SIZE", "16")),
+        "connectTimeout": float(os.environ.get("QWC2_THEMES_CONNECT_TIMEOUT", "10")),
+        "readTimeout": float(os.environ.get("QWC2_THEMES_READ_TIMEOUT", "120")),
+        "httpRetries": int(os.environ.get("QWC2_THEMES_RETRIES", "2")),
+        "watchInterval": float(os.environ.get("QWC2_THEMES_WATCH_INTERVAL", "2")),
+        "pollInterval": float(os.environ.get("QWC2_THEMES_POLL_INTERVAL", "300")),
+        "shardedOutput": os.environ.get("QWC2_THEMES_SHARDED", "0") == "1",
+        "precompressFormats": [fmt for fmt in os.environ.get("QWC2_THEMES_PRECOMPRESS", "").split(",") if fmt],
+        "metricsFile": os.environ.get("QWC2_THEMES_METRICS", ""),
+        "prometheusFile": os.environ.get("QWC2_THEMES_METRICS_PROM", ""),
+        "metricsMemory": os.environ.get("QWC2_THEMES_METRICS_MEMORY", "0") == "1",
+        "thumbnailMaxAge": float(os.environ.get("QWC2_THEMES_THUMBNAIL_MAX_AGE", "86400")),
+        "thumbnailVariantFormats": [fmt for fmt in os.environ.get("QWC2_THEMES_THUMBNAIL_VARIANTS", "").split(",") if fmt],
+        "legendSprites": os.environ.get("QWC2_THEMES_LEGEND_SPRITES", "0") == "1",
+        "legendJobs": int(os.environ.get("QWC2_THEMES_LEGEND_JOBS", "4")),
+        "staleFallback": os.environ.get("QWC2_THEMES_STALE_FALLBACK", "0") == "1",
+        "staleRetryInterval": float(os.environ.get("QWC2_THEMES_STALE_RETRY_INTERVAL", "30")),
+        "spoolOutput": os.environ.get("QWC2_THEMES_SPOOL", "0") == "1",
+        "compactOutput": os.environ.get("QWC2_THEMES_COMPACT", "0") == "1"
+    }
 
-baseUrl = "http://" + socket.getfqdn()
-qwc2_path = "."
-themesConfig = os.environ.get("QWC2_THEMES_CONFIG", "static/themesConfig.json")
-
-usedThemeIds = []
-autogenExternalLayers = []
-
-def uniqueThemeId(themeName):
-    if not themeName:
-        return str(uuid.uuid1())
-    if themeName in usedThemeIds:
-        i = 1
-        while ("%s%d") % (themeName, i) in usedThemeIds:
-            i += 1
-        usedThemeIds.append(("%s%d") % (themeName, i))
-        return usedThemeIds[-1]
-    else:
-        usedThemeIds.append(themeName)
-        return usedThemeIds[-1]
 
+# settings which may differ between the tenants of a batch, see ThemesGenerator.tenant
+tenantSettings = ["themesConfig", "outputFile", "qwc2_path", "shardedOutput", "metricsFile", "prometheusFile"]
+
+
+# timing, download and memory instrumentation of a theme item, recorded for the item processed
+# by the current thread, see itemMetrics
+class ItemMetrics:
+    def __init__(self):
+        self.phases = {}
+        self.bytesDownloaded = 0
+        self.peakMemoryDelta = None
+        self.status = "ok"
+        self.time = 0
+        self.activePhase = None
+
+    # nested phases are accounted to the outer phase, i.e. the GetMap request of the thumbnail phase
+    @contextlib.contextmanager
+    def phase(self, name):
+        if self.activePhase:
+            yield
+            return
+        self.activePhase = name
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0) + time.perf_counter() - start
+            self.activePhase = None
+
+    def addBytes(self, count):
+        self.bytesDownloaded += count
+
+    def start(self):
+        self.startTime = time.perf_counter()
+        self.startMemory = memoryTracker.start()
+
+    def stop(self):
+        self.time = time.perf_counter() - self.startTime
+        if self.startMemory is not None:
+            self.peakMemoryDelta = memoryTracker.stop(self.startMemory)
+
+    # merge metrics recorded in a parse process
+    def merge(self, metrics):
+        for name, value in metrics["phases"].items():
+            self.phases[name] = self.phases.get(name, 0) + value
+        if metrics["peakMemoryDelta"] is not None:
+            self.peakMemoryDelta = max(self.peakMemoryDelta or 0, metrics["peakMemoryDelta"])
+
+    def toDict(self):
+        return {"phases": self.phases, "peakMemoryDelta": self.peakMemoryDelta}
+
+# shared by all threads without metrics, hence never modified
+class NullMetrics(ItemMetrics):
+    @property
+    def status(self):
+        return "ok"
+
+    @status.setter
+    def status(self, value):
+        pass
+
+    def phase(self, name):
+        return contextlib.nullcontext()
+
+    def addBytes(self, count):
+        pass
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def merge(self, metrics):
+        pass
+
+nullMetrics = NullMetrics()
+threadMetrics = threading.local()
+
+def itemMetrics():
+    return getattr(threadMetrics, "current", nullMetrics)
+
+# peak traced memory while theme items are processed. The peak is only reset when no other item is
+# running, so with concurrent jobs the delta of an item includes the allocations of overlapping items.
+class MemoryTracker:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.active = 0
+        self.tracers = 0
+        self.ownsTracing = False
+
+    # enable tracemalloc while any generator requests memory metrics, tracing is process global and
+    # several generators may run concurrently. Tracing started outside of this script is left running.
+    @contextlib.contextmanager
+    def tracing(self, enabled=True):
+        if not enabled:
+            yield
+            return
+        with self.lock:
+            if self.tracers == 0:
+                self.ownsTracing = not tracemalloc.is_tracing()
+                if self.ownsTracing:
+                    tracemalloc.start()
+            self.tracers += 1
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.tracers -= 1
+                if self.tracers == 0 and self.ownsTracing:
+                    tracemalloc.stop()
+                    self.ownsTracing = False
+
+    def start(self):
+        if not tracemalloc.is_tracing():
+            return None
+        with self.lock:
+            if self.active == 0:
+                tracemalloc.reset_peak()
+            self.active += 1
+            return tracemalloc.get_traced_memory()[0]
+
+    def stop(self, startMemory):
+        with self.lock:
+            self.active -= 1
+            return max(0, tracemalloc.get_traced_memory()[1] - startMemory)
+
+memoryTracker = MemoryTracker()
+
+
+# HTTP client shared by all worker threads, with keep-alive connections per host,
+# connect/read timeouts, retries with exponential backoff on 5xx and connection errors
+# and gzip decoding. Requests to hosts behind a configured proxy go through urllib.
+class HttpClient:
+    redirectCodes = [301, 302, 303, 307, 308]
+
+    def __init__(self, connectTimeout, readTimeout, retries, backoff=0.5):
+        self.connectTimeout = connectTimeout
+        self.readTimeout = readTimeout
+        self.retries = retries
+        self.backoff = backoff
+        self.idleConnections = {}
+        self.lock = threading.Lock()
+
+    # returns (body, headers) of a successful reply, raises request.HTTPError for other status codes
+    def get(self, url, headers={}, auth=None):
+        headers = dict(headers)
+        headers["Accept-Encoding"] = "gzip"
+        if auth:
+            credentials = (auth['username'] + ":" + auth['password']).encode('utf-8')
+            headers["Authorization"] = "Basic " + base64.b64encode(credentials).decode('ascii')
+        for redirect in range(10):
+            status, reason, replyHeaders, body = self.requestWithRetries(url, headers)
+            if status not in self.redirectCodes or not replyHeaders.get("Location"):
+                break
+            location = urljoin(url, replyHeaders["Location"])
+            if urlparse(location).netloc != urlparse(url).netloc:
+                headers.pop("Authorization", None)
+            url = location
+        if replyHeaders.get("Content-Encoding") == "gzip":
+            body = gzip.decompress(body)
+        if status < 200 or status >= 300:
+            raise request.HTTPError(url, status, reason, replyHeaders, io.BytesIO(body))
+        return body, replyHeaders
+
+    def requestWithRetries(self, url, headers):
+        for attempt in range(self.retries + 1):
+            try:
+                status, reason, replyHeaders, body = self.request(url, headers)
+                if status < 500 or attempt == self.retries:
+                    return status, reason, replyHeaders, body
+                print(f"Request to {url} failed with HTTP {status}, retrying")
+            except (OSError, http.client.HTTPException) as e:
+                if attempt == self.retries:
+                    raise
+                print(f"Request to {url} failed ({e}), retrying")
+            time.sleep(self.backoff * 2 ** attempt)
+
+    def request(self, url, headers):
+        parsed = urlparse(url)
+        proxies = request.getproxies()
+        if parsed.scheme in proxies and not request.proxy_bypass(parsed.hostname or ""):
+            return self.requestUrllib(url, headers)
+
+        key = (parsed.scheme, parsed.netloc)
+        path = (parsed.path or "/") + ("?" + parsed.query if parsed.query else "")
+        with self.lock:
+            connections = self.idleConnections.get(key)
+            conn = connections.pop() if connections else None
+        reused = conn is not None
+        metrics = itemMetrics()
+        try:
+            if not conn:
+                with metrics.phase("connect"):
+                    conn = self.connect(parsed.scheme, parsed.netloc)
+            with metrics.phase("download"):
+                conn.request("GET", path, headers=headers)
+                response = conn.getresponse()
+                body = response.read()
+            metrics.addBytes(len(body))
+        except Exception as e:
+            if conn:
+                conn.close()
+            if reused and isinstance(e, ConnectionError):
+                # keep-alive connection was closed by the server, retry on a new connection
+                return self.request(url, headers)
+            raise
+        if response.will_close:
+            conn.close()
+        else:
+            with self.lock:
+                self.idleConnections.setdefault(key, []).append(conn)
+        return response.status, response.reason, response.headers, body
+
+    def connect(self, scheme, netloc):
+        if scheme == "https":
+            conn = http.client.HTTPSConnection(netloc, timeout=self.connectTimeout)
+        else:
+            conn = http.client.HTTPConnection(netloc, timeout=self.connectTimeout)
+        conn.connect()
+        conn.sock.settimeout(self.readTimeout)
+        return conn
+
+    def close(self):
+        with self.lock:
+            for connections in self.idleConnections.values():
+                for conn in connections:
+                    conn.close()
+            self.idleConnections = {}
+
+    def requestUrllib(self, url, headers):
+        metrics = itemMetrics()
+        with metrics.phase("download"):
+            try:
+                response = request.urlopen(request.Request(url, headers=headers), timeout=self.readTimeout)
+                status, reason, replyHeaders, body = response.status, response.reason, response.headers, response.read()
+            except request.HTTPError as e:
+                status, reason, replyHeaders, body = e.code, e.reason, e.headers, e.read()
+        metrics.addBytes(len(body))
+        return status, reason, replyHeaders, body
+
+# temporary file next to filename for replacing it, with the permissions of filename if it exists
+# (mkstemp would create it readable by the owner only, os.open applies the umask to the new file)
+def createTempFile(filename):
+    dirname = os.path.dirname(filename) or "."
+    try:
+        mode = os.stat(filename).st_mode & 0o7777
+    except FileNotFoundError:
+        mode = None
+    while True:
+        tmpname = os.path.join(dirname, ".tmp" + uuid.uuid4().hex)
+        try:
+            fd = os.open(tmpname, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+            break
+        except FileExistsError:
+            continue
+    if mode is not None:
+        os.chmod(tmpname, mode)
+    return fd, tmpname
+
+def writeFileAtomic(filename, data):
+    fd, tmpname = createTempFile(filename)
+    try:
+        with os.fdopen(fd, "wb") as fh:
+            # data is either bytes or an iterable of byte chunks
+            if isinstance(data, bytes):
+                fh.write(data)
+            else:
+                for chunk in data:
+                    fh.write(chunk)
+        os.replace(tmpname, filename)
+    except:
+        os.unlink(tmpname)
+        raise
 
-def getUrlOpener(configItem):
-    auth = configItem.get('wmsBasicAuth')
-    if auth:
-        manager = request.HTTPPasswordMgrWithDefaultRealm()
-        manager.add_password(None, configItem["url"], auth['username'], auth['password'])
-        auth_handler = request.HTTPBasicAuthHandler(manager)
-        opener = request.build_opener(auth_handler).open
-    else:
-        opener = request.urlopen
-    return opener
 
 def update_params(url,params):
     url_parse = urlparse(url)
@@ -64,111 +377,210 @@ def update_params(url,params):
     new_url = url_parse._replace(query=url_new_query).geturl()
     return new_url
 
-# load thumbnail from file or GetMap
-def getThumbnail(configItem, resultItem, layers, crs, extent):
-    if "thumbnail" in configItem:
-        if os.path.exists(qwc2_path + "/static/assets/img/mapthumbs/" + configItem["thumbnail"]):
-            resultItem["thumbnail"] = "img/mapthumbs/" + configItem["thumbnail"]
-            return
 
-    print("Using WMS GetMap to generate thumbnail for " + configItem["url"])
-
-    # WMS GetMap request
-    url = update_params(urljoin(baseUrl, configItem["url"]), {'SERVICE': 'WMS', 'VERSION': '1.3.0', 'REQUEST': 'GetMap', 'FORMAT': 'image/png', 'STYLES': '', 'WIDTH': '200', 'HEIGHT': '100', 'CRS': crs})
-    bboxw = extent[2] - extent[0]
-    bboxh = extent[3] - extent[1]
-    bboxcx = 0.5 * (extent[0] + extent[2])
-    bboxcy = 0.5 * (extent[1] + extent[3])
-    imgratio = 200. / 100.
-    if bboxw > bboxh:
-        bboxratio = bboxw / bboxh
-        if bboxratio > imgratio:
-            bboxh = bboxw / imgratio
+# collect (layer, style) of all leaf layers of a layer tree
+def getLegendLayers(layers, result):
+    for layer in layers:
+        if "sublayers" in layer:
+            getLegendLayers(layer["sublayers"], result)
         else:
-            bboxw = bboxh * imgratio
-    else:
-        bboxw = bboxh * imgratio
-    adjustedExtent = [bboxcx - 0.5 * bboxw, bboxcy - 0.5 * bboxh,
-                      bboxcx + 0.5 * bboxw, bboxcy + 0.5 * bboxh]
-    url += "&BBOX=" + (",".join(map(str, adjustedExtent)))
-    url += "&LAYERS=" + quote(",".join(layers).encode('utf-8'))
+            for style in layer.get("styles") or {"": ""}:
+                result.append((layer["name"], style))
+    return result
 
-    try:
-        opener = getUrlOpener(configItem)
-        reply = opener(url).read()
-        basename = configItem["url"].rsplit("/")[-1].rstrip("?") + ".png"
-        try:
-            os.makedirs(qwc2_path + "/static/assets/img/genmapthumbs/")
-        except Exception as e:
-            if not isinstance(e, FileExistsError): raise e
-        thumbnail = qwc2_path + "/static/assets/img/genmapthumbs/" + basename
-        with open(thumbnail, "wb") as fh:
-            fh.write(reply)
-        resultItem["thumbnail"] = "img/genmapthumbs/" + basename
-    except Exception as e:
-        print("ERROR generating thumbnail for WMS " + configItem["url"] + ":\n" + str(e))
-        resultItem["thumbnail"] = "img/mapthumbs/default.jpg"
-        traceback.print_exc()
+# pack images into a sprite sheet, rows of images sorted by height, returns the sheet and the offsets per image
+def packSprite(images):
+    width = max([512] + [image.width for image in images.values()])
+    offsets = {}
+    x = y = rowHeight = 0
+    for key, image in sorted(images.items(), key=lambda entry: (-entry[1].height, entry[0])):
+        if x + image.width > width:
+            x = 0
+            y += rowHeight
+            rowHeight = 0
+        offsets[key] = [x, y, image.width, image.height]
+        x += image.width
+        rowHeight = max(rowHeight, image.height)
+    sheet = Image.new("RGBA", (width, max(1, y + rowHeight)))
+    for key, image in images.items():
+        sheet.paste(image, tuple(offsets[key][0:2]))
+    return sheet, offsets
+
+
+# lightweight element built by iterparseCapabilities, implements the subset of the
+# xml.dom.minidom API used by this script
+class StreamedElement:
+    __slots__ = ("nodeName", "attributes", "childNodes", "text")
+    nodeValue = None
+
+    def __init__(self, nodeName, attributes):
+        self.nodeName = nodeName
+        self.attributes = attributes
+        self.childNodes = []
+        self.text = None
+
+    @property
+    def firstChild(self):
+        if self.text:
+            return StreamedText(self.text)
+        return self.childNodes[0] if self.childNodes else None
+
+    def getAttribute(self, name):
+        return self.attributes.get(name, "")
+
+    def getElementsByTagName(self, name):
+        result = []
+        stack = self.childNodes[::-1]
+        while stack:
+            node = stack.pop()
+            if node.nodeName == name:
+                result.append(node)
+            stack.extend(node.childNodes[::-1])
+        return result
+
+
+class StreamedText:
+    __slots__ = ("nodeValue",)
+
+    def __init__(self, nodeValue):
+        self.nodeValue = nodeValue
+
+
+# parse capabilities with ElementTree.iterparse, releasing every parsed ElementTree element right away
+# NOTE: this is not a bounded memory streaming parse, the whole document is still built as a
+# StreamedElement tree. Only LegendURL elements and the CRS and BoundingBox elements of nested
+# layers (which make up most of large documents) are dropped, the latter once the top layer CRS and
+# BoundingBox used for the thumbnail have been found. Unlike minidom, comments are skipped and CDATA
+# sections are merged into the element text, so firstChild of an element starting with a comment
+# differs. Hence minidom remains the default parser.
+def iterparseCapabilities(reply):
+    prefixes = {"http://www.w3.org/XML/1998/namespace": "xml"}
+    qnames = {}
+    def qname(tag):
+        if tag not in qnames:
+            if tag[0] == "{":
+                uri, local = tag[1:].split("}", 1)
+                prefix = prefixes.get(uri)
+                qnames[tag] = prefix + ":" + local if prefix else local
+            else:
+                qnames[tag] = tag
+        return qnames[tag]
+
+    root = None
+    stack = []
+    etStack = []
+    topLayer = None
+    topLayerOpen = False
+    topCrs = None
+    topBboxCrs = set()
+    for event, item in ET.iterparse(io.BytesIO(reply), events=("start-ns", "start", "end")):
+        if event == "start-ns":
+            prefix, uri = item
+            if uri not in prefixes or not prefix:
+                prefixes[uri] = prefix
+                qnames.clear()
+        elif event == "start":
+            attributes = {qname(key): value for key, value in item.attrib.items()}
+            element = StreamedElement(qname(item.tag), attributes)
+            if stack:
+                stack[-1].childNodes.append(element)
+            else:
+                root = element
+            if topLayer is None and stack and element.nodeName.split(':')[-1] == "Layer" and stack[-1].nodeName.split(':')[-1] == "Capability":
+                topLayer = element
+                topLayerOpen = True
+            stack.append(element)
+            etStack.append(item)
+        else:
+            element = stack.pop()
+            element.text = item.text
+            etStack.pop()
+            if etStack:
+                # the finished element is always the last child of its parent
+                del etStack[-1][-1]
+            if element is topLayer:
+                topLayerOpen = False
+            if not stack or not topLayerOpen:
+                continue
+            parent = stack[-1]
+            tagname = element.nodeName.split(':')[-1]
+            nested = parent is not topLayer
+            if tagname == "LegendURL":
+                parent.childNodes.pop()
+            elif tagname == "CRS":
+                if nested and topCrs is not None:
+                    parent.childNodes.pop()
+                elif topCrs is None and element.text != "CRS:84":
+                    topCrs = element.text
+            elif tagname == "BoundingBox":
+                if nested and topCrs is not None and topCrs in topBboxCrs:
+                    parent.childNodes.pop()
+                else:
+                    topBboxCrs.add(element.getAttribute("CRS"))
+
+    if root.nodeName == "WMS_Capabilities":
+        return root
+    return root.getElementsByTagName("WMS_Capabilities")[0]
+
+
+def parseCapabilities(reply, xmlParser="minidom"):
+    if xmlParser == "minidom":
+        return parseString(reply).getElementsByTagName("WMS_Capabilities")[0]
+    return iterparseCapabilities(reply)
+
+
+# index of a capabilities document built in a single pass, for constant time lookups
+# of child elements by path and of layers by name
+class CapabilitiesIndex:
+    def __init__(self, capabilities):
+        # id(element) -> {child name without prefix: first child element with that name}
+        self.children = {}
+        # layer name -> first layer element with that name
+        self.layers = {}
+        stack = [capabilities]
+        while stack:
+            element = stack.pop()
+            children = {}
+            for node in element.childNodes:
+                childName = node.nodeName.split(':')[-1]
+                if not childName.startswith("#") and childName not in children:
+                    children[childName] = node
+            if children:
+                self.children[id(element)] = children
+                if element.nodeName.split(':')[-1] == "Layer":
+                    self.layers.setdefault(getElementValue(children.get("Name")), element)
+            stack.extend(element.childNodes[::-1])
+
+    def getChildElement(self, parent, path):
+        for part in path.split("/"):
+            parent = self.children.get(id(parent), {}).get(part)
+            if parent is None:
+                return None
+        return parent
+
+    def getChildElementValue(self, parent, path):
+        return getElementValue(self.getChildElement(parent, path))
 
-def getEditConfig(editConfig):
-    if not editConfig:
-        return None
-    elif isinstance(editConfig, dict):
-        return editConfig
-    elif os.path.isabs(editConfig) and os.path.exists(editConfig):
-        with open(editConfig, encoding='utf-8') as fh:
-            config = json.load(fh)
-        return config
-    else:
-        dirname = os.path.dirname(themesConfig)
-        if not dirname:
-            dirname = "."
-        filename = os.path.join(dirname, editConfig)
-        if os.path.exists(filename):
-            with open(filename, encoding='utf-8') as fh:
-                config = json.load(fh)
-            return config
-    return None
 
 def getDirectChildElements(parent, tagname):
     return [node for node in parent.childNodes if node.nodeName.split(':')[-1] == tagname]
 
 
-def getChildElement(parent, path):
-    for part in path.split("/"):
-        for node in parent.childNodes:
-            if node.nodeName.split(':')[-1] == part:
-                parent = node
-                break
-        else:
-            return None
-    return parent
-
-
 def getElementValue(element):
     return element.firstChild.nodeValue if element and element.firstChild else ""
 
 
-def getChildElementValue(parent, path):
-    return getElementValue(getChildElement(parent, path))
-
-
 # recursively get layer tree
-def getLayerTree(layer, resultLayers, visibleLayers, printLayers, level, collapseBelowLevel, titleNameMap, featureReports, externalLayers):
-    name = getChildElementValue(layer, "Name")
-    title = getChildElementValue(layer, "Title")
+def getLayerTree(index, layer, resultLayers, visibleLayers, printLayers, level, collapseBelowLevel, titleNameMap, featureReports, externalLayers):
+    name = index.getChildElementValue(layer, "Name")
+    title = index.getChildElementValue(layer, "Title")
     layers = getDirectChildElements(layer, "Layer")
-    treeName = getChildElementValue(layer, "TreeName")
+    treeName = index.getChildElementValue(layer, "TreeName")
 
 
     # skip print layers
-    for printLayer in printLayers:
-        if type(printLayer) is list:
-            for entry in printLayer:
-                if entry["name"] == name:
-                    return
-        elif printLayer == name:
-            return
+    if name in printLayers:
+        return
 
     layerEntry = {"name": name, "title": title}
 
@@ -187,26 +599,26 @@ def getLayerTree(layer, resultLayers, visibleLayers, printLayers, level, collaps
             # collect visible layers
             visibleLayers.append(name)
 
-        layerEntry['primary_key'] = getChildElementValue(layer, 'PrimaryKey/PrimaryKeyAttribute')
+        layerEntry['primary_key'] = index.getChildElementValue(layer, 'PrimaryKey/PrimaryKeyAttribute')
 
         layerEntry["queryable"] = layer.getAttribute("queryable") == "1"
         if layerEntry["queryable"] and layer.getAttribute("displayField"):
             layerEntry["displayField"] = layer.getAttribute("displayField")
 
         try:
-            onlineResource = getChildElement(layer, "Attribution/OnlineResource")
+            onlineResource = index.getChildElement(layer, "Attribution/OnlineResource")
             layerEntry["attribution"] = {
-                "Title": getChildElementValue(layer, "Attribution/Title"),
+                "Title": index.getChildElementValue(layer, "Attribution/Title"),
                 "OnlineResource": onlineResource.getAttribute("xlink:href") if onlineResource else ""
             }
         except:
             pass
         try:
-            layerEntry["abstract"] = getChildElementValue(layer, "Abstract")
+            layerEntry["abstract"] = index.getChildElementValue(layer, "Abstract")
         except:
             pass
         try:
-            onlineResource = getChildElement(layer, "DataURL/OnlineResource")
+            onlineResource = index.getChildElement(layer, "DataURL/OnlineResource")
             layerEntry["dataUrl"] = onlineResource.getAttribute("xlink:href")
             if layerEntry["dataUrl"].startswith("wms:"):
                 externalLayers.append({"internalLayer": name, "name": layerEntry["dataUrl"]})
@@ -214,13 +626,13 @@ def getLayerTree(layer, resultLayers, visibleLayers, printLayers, level, collaps
         except:
             pass
         try:
-            onlineResource = getChildElement(layer, "MetadataURL/OnlineResource")
+            onlineResource = index.getChildElement(layer, "MetadataURL/OnlineResource")
             layerEntry["metadataUrl"] = onlineResource.getAttribute("xlink:href")
         except:
             pass
         try:
             keywords = []
-            for keyword in getChildElement(layer, "KeywordList").getElementsByTagName("Keyword"):
+            for keyword in index.getChildElement(layer, "KeywordList").getElementsByTagName("Keyword"):
                 keywords.append(getElementValue(keyword))
             layerEntry["keywords"] = ", ".join(keywords)
         except:
@@ -228,8 +640,8 @@ def getLayerTree(layer, resultLayers, visibleLayers, printLayers, level, collaps
         
         styles = {}
         for style in layer.getElementsByTagName("Style"):
-            name = getChildElementValue(style, "Name")
-            title = getChildElementValue(style, "Title")
+            name = index.getChildElementValue(style, "Name")
+            title = index.getChildElementValue(style, "Title")
             styles[name] = title
         layerEntry["styles"] = styles
         layerEntry['style'] = 'default' if 'default' in styles else (list(styles)[0] if len(styles) > 0 else '')
@@ -240,21 +652,21 @@ def getLayerTree(layer, resultLayers, visibleLayers, printLayers, level, collaps
             layerEntry["opacity"] = int(float(layer.getAttribute("opacity")) * 255)
         else:
             layerEntry["opacity"] = 255
-        minScale = getChildElementValue(layer, "MinScaleDenominator")
-        maxScale = getChildElementValue(layer, "MaxScaleDenominator")
+        minScale = index.getChildElementValue(layer, "MinScaleDenominator")
+        maxScale = index.getChildElementValue(layer, "MaxScaleDenominator")
         if minScale and maxScale:
             layerEntry["minScale"] = int(float(minScale))
             layerEntry["maxScale"] = int(float(maxScale))
         # use geographic bounding box, as default CRS may have inverted axis order with WMS 1.3.0
-        geoBBox = getChildElement(layer, "EX_GeographicBoundingBox")
+        geoBBox = index.getChildElement(layer, "EX_GeographicBoundingBox")
         if geoBBox:
             layerEntry["bbox"] = {
                 "crs": "EPSG:4326",
                 "bounds": [
-                    float(getChildElementValue(geoBBox, "westBoundLongitude")),
-                    float(getChildElementValue(geoBBox, "southBoundLatitude")),
-                    float(getChildElementValue(geoBBox, "eastBoundLongitude")),
-                    float(getChildElementValue(geoBBox, "northBoundLatitude"))
+                    float(index.getChildElementValue(geoBBox, "westBoundLongitude")),
+                    float(index.getChildElementValue(geoBBox, "southBoundLatitude")),
+                    float(index.getChildElementValue(geoBBox, "eastBoundLongitude")),
+                    float(index.getChildElementValue(geoBBox, "northBoundLatitude"))
                 ]
             }
         if name in featureReports:
@@ -284,7 +696,7 @@ def getLayerTree(layer, resultLayers, visibleLayers, printLayers, level, collaps
         else:
             layerEntry["expanded"] = False if collapseBelowLevel >= 0 and level >= collapseBelowLevel else True
         for sublayer in layers:
-            getLayerTree(sublayer, layerEntry["sublayers"], visibleLayers, printLayers, level + 1, collapseBelowLevel, titleNameMap, featureReports, externalLayers)
+            getLayerTree(index, sublayer, layerEntry["sublayers"], visibleLayers, printLayers, level + 1, collapseBelowLevel, titleNameMap, featureReports, externalLayers)
 
         if not layerEntry["sublayers"]:
             # skip empty groups
@@ -293,67 +705,103 @@ def getLayerTree(layer, resultLayers, visibleLayers, printLayers, level, collaps
     resultLayers.append(layerEntry)
     titleNameMap[treeName] = name
 
-# parse GetCapabilities for theme
-def getTheme(config, configItem, result, resultItem):
-    global autogenExternalLayers
-    if (configItem.get("disabled", False)):
-        print(f"Item {configItem.get("url")} {"(" + configItem.get("title") + ")" if configItem.get("title") else ""} has been disabled")
-        return
 
-    url = update_params(urljoin(baseUrl, configItem["url"]), {'SERVICE': 'WMS', 'VERSION': '1.3.0', 'REQUEST': 'GetProjectSettings'})
-
-    try:
-        opener = getUrlOpener(configItem)
-        reply = opener(url).read()
-        capabilities = parseString(reply)
-        capabilities = capabilities.getElementsByTagName("WMS_Capabilities")[0]
-        print(f"Parsing WMS GetProjectSettings of {configItem.get("url")} {"(" + configItem.get("title") + ")" if configItem.get("title") else ""}")
-
-        topLayer = getChildElement(getChildElement(capabilities, "Capability"), "Layer")
-        wmsName = re.sub(r".*/", "", configItem["url"]).rstrip("?")
-
-        # use name from config or fallback to WMS title
-        wmsTitle = configItem.get("title") or getChildElementValue(capabilities, "Service/Title") or getChildElementValue(topLayer, "Title") or wmsName
-
-
-        # keywords
-        keywords = []
-        keywordList = getChildElement(capabilities, "Service/KeywordList")
-        if keywordList:
-            for keyword in keywordList.getElementsByTagName("Keyword"):
-                value = getElementValue(keyword)
-                if value != "infoMapAccessService":
-                    keywords.append(value)
-
-        # collect WMS layers for printing
-        printLayers = configItem["extraPrintLayers"] if "extraPrintLayers" in configItem else []
-        if "backgroundLayers" in configItem:
-            printLayers = [entry["printLayer"] for entry in configItem["backgroundLayers"] if "printLayer" in entry]
-
-        # layer tree and visible layers
-        collapseLayerGroupsBelowLevel = -1
-        if "collapseLayerGroupsBelowLevel" in configItem:
-            collapseLayerGroupsBelowLevel = configItem["collapseLayerGroupsBelowLevel"]
-
-        layerTree = []
-        visibleLayers = []
-        titleNameMap = {}
-        featureReports = configItem["featureReport"] if "featureReport" in configItem else {}
-        externalLayers = []
-        getLayerTree(topLayer, layerTree, visibleLayers, printLayers, 1, collapseLayerGroupsBelowLevel, titleNameMap, featureReports, externalLayers)
-        autogenExternalLayers += list(map(lambda entry: entry["name"], externalLayers))
-        if "externalLayers" in configItem:
-            externalLayers += configItem["externalLayers"]
-        visibleLayers.reverse()
-
-        # print templates
+# GetProjectSettings replies and parsed documents shared by the theme items of a run with the same
+# request key. Concurrent requests for a key wait for the first one, results of a key are dropped
+# once all its items have been released.
+class SharedRequests:
+    def __init__(self, requestKeys):
+        self.lock = threading.Lock()
+        self.keyCounts = Counter(requestKeys)
+        self.futures = {}
+
+    def get(self, kind, key, func):
+        with self.lock:
+            future = self.futures.get((kind, key))
+            owner = future is None
+            if owner:
+                future = Future()
+                if self.keyCounts[key] > 1:
+                    self.futures[(kind, key)] = future
+        if owner:
+            try:
+                future.set_result(func())
+            except Exception as e:
+                future.set_exception(e)
+        return future.result()
+
+    def release(self, key):
+        with self.lock:
+            self.keyCounts[key] -= 1
+            if self.keyCounts[key] <= 0:
+                for kind in ["reply", "document"]:
+                    self.futures.pop((kind, key), None)
+
+
+def parseDocument(reply, xmlParser="minidom"):
+    with itemMetrics().phase("parse"):
+        capabilities = parseCapabilities(reply, xmlParser)
+        return capabilities, CapabilitiesIndex(capabilities)
+
+
+# build theme from parsed GetProjectSettings, returns the arguments for getThumbnail if a thumbnail is needed
+# NOTE: the document may be shared with other theme items and must not be modified
+def parseTheme(config, configItem, result, resultItem, deferred, capabilities, index):
+    print(f"Parsing WMS GetProjectSettings of {configItem.get("url")} {"(" + configItem.get("title") + ")" if configItem.get("title") else ""}")
+
+    topLayer = index.getChildElement(index.getChildElement(capabilities, "Capability"), "Layer")
+    wmsName = re.sub(r".*/", "", configItem["url"]).rstrip("?")
+
+    # use name from config or fallback to WMS title
+    wmsTitle = configItem.get("title") or index.getChildElementValue(capabilities, "Service/Title") or index.getChildElementValue(topLayer, "Title") or wmsName
+
+
+    # keywords
+    keywords = []
+    keywordList = index.getChildElement(capabilities, "Service/KeywordList")
+    if keywordList:
+        for keyword in keywordList.getElementsByTagName("Keyword"):
+            value = getElementValue(keyword)
+            if value != "infoMapAccessService":
+                keywords.append(value)
+
+    # collect WMS layers for printing
+    printLayers = configItem["extraPrintLayers"] if "extraPrintLayers" in configItem else []
+    if "backgroundLayers" in configItem:
+        printLayers = [entry["printLayer"] for entry in configItem["backgroundLayers"] if "printLayer" in entry]
+    printLayerNames = set()
+    for printLayer in printLayers:
+        if type(printLayer) is list:
+            printLayerNames.update(entry["name"] for entry in printLayer)
+        else:
+            printLayerNames.add(printLayer)
+
+    # layer tree and visible layers
+    collapseLayerGroupsBelowLevel = -1
+    if "collapseLayerGroupsBelowLevel" in configItem:
+        collapseLayerGroupsBelowLevel = configItem["collapseLayerGroupsBelowLevel"]
+
+    layerTree = []
+    visibleLayers = []
+    titleNameMap = {}
+    featureReports = configItem["featureReport"] if "featureReport" in configItem else {}
+    externalLayers = []
+    with itemMetrics().phase("getLayerTree"):
+        getLayerTree(index, topLayer, layerTree, visibleLayers, printLayerNames, 1, collapseLayerGroupsBelowLevel, titleNameMap, featureReports, externalLayers)
+    deferred["autogenExternalLayers"] = list(map(lambda entry: entry["name"], externalLayers))
+    if "externalLayers" in configItem:
+        externalLayers += configItem["externalLayers"]
+    visibleLayers.reverse()
+
+    # print templates
+    with itemMetrics().phase("printTemplates"):
         printTemplates = []
-        composerTemplates = getChildElement(capabilities, "Capability/ComposerTemplates")
+        composerTemplates = index.getChildElement(capabilities, "Capability/ComposerTemplates")
         if composerTemplates:
 
             composerTemplateMap = {}
             for composerTemplate in composerTemplates.getElementsByTagName("ComposerTemplate"):
-                composerMap = getChildElement(composerTemplate, "ComposerMap")
+                composerMap = index.getChildElement(composerTemplate, "ComposerMap")
                 if composerMap:
                     composerTemplateMap[composerTemplate.getAttribute("name")] = composerTemplate;
 
@@ -363,7 +811,7 @@ def getTheme(config, configItem, result, resultItem):
                 if templateName.endswith("_legend") and templateName[:-7] in composerTemplateMap:
                     continue
 
-                composerMap = getChildElement(composerTemplate, "ComposerMap")
+                composerMap = index.getChildElement(composerTemplate, "ComposerMap")
                 printTemplate = {
                     "name": templateName,
                     "map": {
@@ -386,8 +834,7 @@ def getTheme(config, configItem, result, resultItem):
                 if composerTemplate.getAttribute('atlasEnabled') == '1':
                     atlasLayer = composerTemplate.getAttribute('atlasCoverageLayer')
                     try:
-                        layers = capabilities.getElementsByTagName("Layer")
-                        pk = getChildElementValue(list(filter(lambda l: getChildElementValue(l, "Name") == atlasLayer, layers))[0], "PrimaryKey/PrimaryKeyAttribute")
+                        pk = index.getChildElementValue(index.layers[atlasLayer], "PrimaryKey/PrimaryKeyAttribute")
                         printTemplate["atlasCoverageLayer"] = atlasLayer
                         printTemplate["atlas_pk"] = pk
                     except:
@@ -395,196 +842,251 @@ def getTheme(config, configItem, result, resultItem):
 
                 printTemplates.append(printTemplate)
 
-        # drawing order
-        drawingOrder = getChildElementValue(capabilities, "Capability/LayerDrawingOrder").split(",")
-        drawingOrder = list(map(lambda title: titleNameMap[title] if title in titleNameMap else title, drawingOrder))
-
-        # getmap formats
-        availableFormats = []
-        for format in getChildElement(capabilities, "Capability/Request/GetMap").getElementsByTagName("Format"):
-          availableFormats.append(getElementValue(format))
-
-        # update theme config
-        resultItem["url"] = configItem["url"]
-        resultItem["id"] = uniqueThemeId(configItem.get("id", wmsName))
-        resultItem["name"] = getChildElementValue(topLayer, "Name")
-        resultItem["title"] = wmsTitle
-        resultItem["description"] = configItem["description"] if "description" in configItem else ""
-        resultItem["attribution"] = {
-            "Title": configItem["attribution"] if "attribution" in configItem else "",
-            "OnlineResource": configItem["attributionUrl"] if "attributionUrl" in configItem else ""
-        }
-        # service info
-        resultItem["abstract"] = getChildElementValue(capabilities, "Service/Abstract")
-        resultItem["keywords"] = ", ".join(keywords)
-        resultItem["onlineResource"] = getChildElement(capabilities, "Service/OnlineResource").getAttribute("xlink:href")
-        resultItem["contact"] = {
-            "person": getChildElementValue(capabilities, "Service/ContactInformation/ContactPersonPrimary/ContactPerson"),
-            "organization": getChildElementValue(capabilities, "Service/ContactInformation/ContactPersonPrimary/ContactOrganization"),
-            "position": getChildElementValue(capabilities, "Service/ContactInformation/ContactPosition"),
-            "phone": getChildElementValue(capabilities, "Service/ContactInformation/ContactVoiceTelephone"),
-            "email": getChildElementValue(capabilities, "Service/ContactInformation/ContactElectronicMailAddress")
-        }
+    # drawing order
+    drawingOrder = index.getChildElementValue(capabilities, "Capability/LayerDrawingOrder").split(",")
+    drawingOrder = list(map(lambda title: titleNameMap[title] if title in titleNameMap else title, drawingOrder))
+
+    # getmap formats
+    availableFormats = []
+    for format in index.getChildElement(capabilities, "Capability/Request/GetMap").getElementsByTagName("Format"):
+      availableFormats.append(getElementValue(format))
+
+    # update theme config
+    resultItem["url"] = configItem["url"]
+    resultItem["id"] = configItem.get("id", wmsName)
+    resultItem["name"] = index.getChildElementValue(topLayer, "Name")
+    resultItem["title"] = wmsTitle
+    resultItem["description"] = configItem["description"] if "description" in configItem else ""
+    resultItem["attribution"] = {
+        "Title": configItem["attribution"] if "attribution" in configItem else "",
+        "OnlineResource": configItem["attributionUrl"] if "attributionUrl" in configItem else ""
+    }
+    # service info
+    resultItem["abstract"] = index.getChildElementValue(capabilities, "Service/Abstract")
+    resultItem["keywords"] = ", ".join(keywords)
+    resultItem["onlineResource"] = index.getChildElement(capabilities, "Service/OnlineResource").getAttribute("xlink:href")
+    resultItem["contact"] = {
+        "person": index.getChildElementValue(capabilities, "Service/ContactInformation/ContactPersonPrimary/ContactPerson"),
+        "organization": index.getChildElementValue(capabilities, "Service/ContactInformation/ContactPersonPrimary/ContactOrganization"),
+        "position": index.getChildElementValue(capabilities, "Service/ContactInformation/ContactPosition"),
+        "phone": index.getChildElementValue(capabilities, "Service/ContactInformation/ContactVoiceTelephone"),
+        "email": index.getChildElementValue(capabilities, "Service/ContactInformation/ContactElectronicMailAddress")
+    }
 
-        if "format" in configItem:
-            resultItem["format"] = configItem["format"]
-        resultItem["availableFormats"] = availableFormats
-        if "tiled" in configItem:
-            resultItem["tiled"] = configItem["tiled"]
-        if "tileSize" in configItem:
-            resultItem["tileSize"] = configItem["tileSize"]
-        if "version" in configItem:
-            resultItem["version"] = configItem["version"]
-        elif "defaultWMSVersion" in config:
-            resultItem["version"] = config["defaultWMSVersion"]
-        resultItem["infoFormats"] = [getElementValue(format) for format in getChildElement(capabilities, "Capability/Request/GetFeatureInfo").getElementsByTagName("Format")]
-        # use geographic bounding box for theme, as default CRS may have inverted axis order with WMS 1.3.0
-        bounds = [
-            float(getChildElementValue(topLayer, "EX_GeographicBoundingBox/westBoundLongitude")),
-            float(getChildElementValue(topLayer, "EX_GeographicBoundingBox/southBoundLatitude")),
-            float(getChildElementValue(topLayer, "EX_GeographicBoundingBox/eastBoundLongitude")),
-            float(getChildElementValue(topLayer, "EX_GeographicBoundingBox/northBoundLatitude"))
-        ]
-        resultItem["bbox"] = {
-            "crs": "EPSG:4326",
-            "bounds": bounds
+    if "format" in configItem:
+        resultItem["format"] = configItem["format"]
+    resultItem["availableFormats"] = availableFormats
+    if "tiled" in configItem:
+        resultItem["tiled"] = configItem["tiled"]
+    if "tileSize" in configItem:
+        resultItem["tileSize"] = configItem["tileSize"]
+    if "version" in configItem:
+        resultItem["version"] = configItem["version"]
+    elif "defaultWMSVersion" in config:
+        resultItem["version"] = config["defaultWMSVersion"]
+    resultItem["infoFormats"] = [getElementValue(format) for format in index.getChildElement(capabilities, "Capability/Request/GetFeatureInfo").getElementsByTagName("Format")]
+    # use geographic bounding box for theme, as default CRS may have inverted axis order with WMS 1.3.0
+    bounds = [
+        float(index.getChildElementValue(topLayer, "EX_GeographicBoundingBox/westBoundLongitude")),
+        float(index.getChildElementValue(topLayer, "EX_GeographicBoundingBox/southBoundLatitude")),
+        float(index.getChildElementValue(topLayer, "EX_GeographicBoundingBox/eastBoundLongitude")),
+        float(index.getChildElementValue(topLayer, "EX_GeographicBoundingBox/northBoundLatitude"))
+    ]
+    resultItem["bbox"] = {
+        "crs": "EPSG:4326",
+        "bounds": bounds
+    }
+    if "extent" in configItem:
+        resultItem["initialBbox"] = {
+            "crs": configItem["mapCrs"] if "mapCrs" in configItem else result["themes"]["defaultMapCrs"],
+            "bounds": configItem["extent"]
         }
-        if "extent" in configItem:
-            resultItem["initialBbox"] = {
-                "crs": configItem["mapCrs"] if "mapCrs" in configItem else result["themes"]["defaultMapCrs"],
-                "bounds": configItem["extent"]
-            }
-        else:
-            resultItem["initialBbox"] = resultItem["bbox"]
-        if "scales" in configItem:
-            resultItem["scales"] = configItem["scales"]
-        if "printScales" in configItem:
-            resultItem["printScales"] = configItem["printScales"]
-        if "printResolutions" in configItem:
-            resultItem["printResolutions"] = configItem["printResolutions"]
-        if "printGrid" in configItem:
-            resultItem["printGrid"] = configItem["printGrid"]
-        # NOTE: skip root WMS layer
-        resultItem["sublayers"] = layerTree[0]["sublayers"] if len(layerTree) > 0 and "sublayers" in layerTree[0] else []
-        resultItem["expanded"] = True
-        if "backgroundLayers" in configItem:
-            resultItem["backgroundLayers"] = configItem["backgroundLayers"]
-        resultItem["externalLayers"] = externalLayers
-        if "pluginData" in configItem:
-            resultItem["pluginData"] = configItem["pluginData"]
-        if "predefinedFilters" in configItem:
-            resultItem["predefinedFilters"] = configItem["predefinedFilters"]
-        if "snapping" in configItem:
-            resultItem["snapping"] = configItem["snapping"]
-        if "minSearchScaleDenom" in configItem:
-            resultItem["minSearchScaleDenom"] = configItem["minSearchScaleDenom"]
-        elif "minSearchScale" in configItem: # Legacy name
-            resultItem["minSearchScaleDenom"] = configItem["minSearchScale"]
-        if "themeInfoLinks" in configItem:
-            resultItem["themeInfoLinks"] = configItem["themeInfoLinks"]
-        if "layerTreeHiddenSublayers" in configItem:
-            resultItem["layerTreeHiddenSublayers"] = configItem["layerTreeHiddenSublayers"]
-        resultItem["searchProviders"] = configItem["searchProviders"] if "searchProviders" in configItem else []
-        if "additionalMouseCrs" in configItem:
-            resultItem["additionalMouseCrs"] = configItem["additionalMouseCrs"]
-        if "mapCrs" in configItem:
-            resultItem["mapCrs"] = configItem["mapCrs"]
-        else:
-            resultItem["mapCrs"] = result["themes"]["defaultMapCrs"]
-        if "defaultDisplayCrs" in configItem:
-            resultItem["defaultDisplayCrs"] = configItem["defaultDisplayCrs"]
-        else:
-            resultItem["defaultDisplayCrs"] = result["themes"]["defaultDisplayCrs"]
-        if printTemplates:
-            resultItem["print"] = printTemplates
-        resultItem["drawingOrder"] = drawingOrder
-        if "extraPrintParameters" in configItem:
-            resultItem["extraPrintParameters"] = configItem["extraPrintParameters"]
-        extraLegenParams = configItem["extraLegendParameters"] if "extraLegendParameters" in configItem else ""
-        if "legendUrl" in configItem:
-            resultItem["legendUrl"] = configItem["legendUrl"]
-        else:
-            resultItem["legendUrl"] = getChildElement(capabilities, "Capability/Request/GetLegendGraphic/DCPType/HTTP/Get/OnlineResource").getAttribute("xlink:href").rstrip("?") + "?" + extraLegenParams
-        if "featureInfoUrl" in configItem:
-            resultItem["featureInfoUrl"] = configItem["featureInfoUrl"]
-        else:
-            resultItem["featureInfoUrl"] = getChildElement(capabilities, "Capability/Request/GetFeatureInfo/DCPType/HTTP/Get/OnlineResource").getAttribute("xlink:href").rstrip("?") + "?"
-        if "printUrl" in configItem:
-            resultItem["printUrl"] = configItem["printUrl"]
-        else:
-            resultItem["printUrl"] = getChildElement(capabilities, "Capability/Request/GetPrint/DCPType/HTTP/Get/OnlineResource").getAttribute("xlink:href").rstrip("?") + "?"
-        if "printLabelForSearchResult" in configItem:
-            resultItem["printLabelForSearchResult"] = configItem["printLabelForSearchResult"]
-        if "printLabelForAttribution" in configItem:
-            resultItem["printLabelForAttribution"] = configItem["printLabelForAttribution"]
-        if "printLabelConfig" in configItem:
-            resultItem["printLabelConfig"] = configItem["printLabelConfig"]
-
-        if "watermark" in configItem:
-            resultItem["watermark"] = configItem["watermark"]
-
-        if "skipEmptyFeatureAttributes" in configItem:
-            resultItem["skipEmptyFeatureAttributes"] = configItem["skipEmptyFeatureAttributes"]
-
-        if "config" in configItem:
-            resultItem["config"] = configItem["config"]
-
-        if "flags" in configItem:
-            resultItem["flags"] = configItem["flags"]
-
-        if "mapTips" in configItem:
-            resultItem["mapTips"] = configItem["mapTips"]
-
-        if "userMap" in configItem:
-            resultItem["userMap"] = configItem["userMap"]
-
-        if "map3d" in configItem:
-            resultItem["map3d"] = configItem["map3d"]
-        if "obliqueDatasets" in configItem:
-            resultItem["obliqueDatasets"] = configItem["obliqueDatasets"]
-        if "viewMode" in configItem:
-            resultItem["viewMode"] = configItem["viewMode"]
-        if "filter" in configItem:
-            resultItem["filter"] = configItem["filter"]
-
-        resultItem["editConfig"] = getEditConfig(configItem["editConfig"] if "editConfig" in configItem else None)
+    else:
+        resultItem["initialBbox"] = resultItem["bbox"]
+    if "scales" in configItem:
+        resultItem["scales"] = configItem["scales"]
+    if "printScales" in configItem:
+        resultItem["printScales"] = configItem["printScales"]
+    if "printResolutions" in configItem:
+        resultItem["printResolutions"] = configItem["printResolutions"]
+    if "printGrid" in configItem:
+        resultItem["printGrid"] = configItem["printGrid"]
+    # NOTE: skip root WMS layer
+    resultItem["sublayers"] = layerTree[0]["sublayers"] if len(layerTree) > 0 and "sublayers" in layerTree[0] else []
+    resultItem["expanded"] = True
+    if "backgroundLayers" in configItem:
+        resultItem["backgroundLayers"] = configItem["backgroundLayers"]
+    resultItem["externalLayers"] = externalLayers
+    if "pluginData" in configItem:
+        resultItem["pluginData"] = configItem["pluginData"]
+    if "predefinedFilters" in configItem:
+        resultItem["predefinedFilters"] = configItem["predefinedFilters"]
+    if "snapping" in configItem:
+        resultItem["snapping"] = configItem["snapping"]
+    if "minSearchScaleDenom" in configItem:
+        resultItem["minSearchScaleDenom"] = configItem["minSearchScaleDenom"]
+    elif "minSearchScale" in configItem: # Legacy name
+        resultItem["minSearchScaleDenom"] = configItem["minSearchScale"]
+    if "themeInfoLinks" in configItem:
+        resultItem["themeInfoLinks"] = configItem["themeInfoLinks"]
+    if "layerTreeHiddenSublayers" in configItem:
+        resultItem["layerTreeHiddenSublayers"] = configItem["layerTreeHiddenSublayers"]
+    resultItem["searchProviders"] = configItem["searchProviders"] if "searchProviders" in configItem else []
+    if "additionalMouseCrs" in configItem:
+        resultItem["additionalMouseCrs"] = configItem["additionalMouseCrs"]
+    if "mapCrs" in configItem:
+        resultItem["mapCrs"] = configItem["mapCrs"]
+    else:
+        resultItem["mapCrs"] = result["themes"]["defaultMapCrs"]
+    if "defaultDisplayCrs" in configItem:
+        resultItem["defaultDisplayCrs"] = configItem["defaultDisplayCrs"]
+    else:
+        resultItem["defaultDisplayCrs"] = result["themes"]["defaultDisplayCrs"]
+    if printTemplates:
+        resultItem["print"] = printTemplates
+    resultItem["drawingOrder"] = drawingOrder
+    if "extraPrintParameters" in configItem:
+        resultItem["extraPrintParameters"] = configItem["extraPrintParameters"]
+    extraLegenParams = configItem["extraLegendParameters"] if "extraLegendParameters" in configItem else ""
+    if "legendUrl" in configItem:
+        resultItem["legendUrl"] = configItem["legendUrl"]
+    else:
+        resultItem["legendUrl"] = index.getChildElement(capabilities, "Capability/Request/GetLegendGraphic/DCPType/HTTP/Get/OnlineResource").getAttribute("xlink:href").rstrip("?") + "?" + extraLegenParams
+    if "featureInfoUrl" in configItem:
+        resultItem["featureInfoUrl"] = configItem["featureInfoUrl"]
+    else:
+        resultItem["featureInfoUrl"] = index.getChildElement(capabilities, "Capability/Request/GetFeatureInfo/DCPType/HTTP/Get/OnlineResource").getAttribute("xlink:href").rstrip("?") + "?"
+    if "printUrl" in configItem:
+        resultItem["printUrl"] = configItem["printUrl"]
+    else:
+        resultItem["printUrl"] = index.getChildElement(capabilities, "Capability/Request/GetPrint/DCPType/HTTP/Get/OnlineResource").getAttribute("xlink:href").rstrip("?") + "?"
+    if "printLabelForSearchResult" in configItem:
+        resultItem["printLabelForSearchResult"] = configItem["printLabelForSearchResult"]
+    if "printLabelForAttribution" in configItem:
+        resultItem["printLabelForAttribution"] = configItem["printLabelForAttribution"]
+    if "printLabelConfig" in configItem:
+        resultItem["printLabelConfig"] = configItem["printLabelConfig"]
+
+    if "watermark" in configItem:
+        resultItem["watermark"] = configItem["watermark"]
+
+    if "skipEmptyFeatureAttributes" in configItem:
+        resultItem["skipEmptyFeatureAttributes"] = configItem["skipEmptyFeatureAttributes"]
+
+    if "config" in configItem:
+        resultItem["config"] = configItem["config"]
+
+    if "flags" in configItem:
+        resultItem["flags"] = configItem["flags"]
+
+    if "mapTips" in configItem:
+        resultItem["mapTips"] = configItem["mapTips"]
+
+    if "userMap" in configItem:
+        resultItem["userMap"] = configItem["userMap"]
+
+    if "map3d" in configItem:
+        resultItem["map3d"] = configItem["map3d"]
+    if "obliqueDatasets" in configItem:
+        resultItem["obliqueDatasets"] = configItem["obliqueDatasets"]
+    if "viewMode" in configItem:
+        resultItem["viewMode"] = configItem["viewMode"]
+    if "filter" in configItem:
+        resultItem["filter"] = configItem["filter"]
+
+    # set default theme
+    deferred["default"] = configItem.get("default", False)
+
+    # use first CRS for thumbnail request which is not CRS:84
+    for item in topLayer.getElementsByTagName("CRS"):
+        crs = getElementValue(item)
+        if crs != "CRS:84":
+            break
+    extent = None
+    for bbox in topLayer.getElementsByTagName("BoundingBox"):
+        if bbox.getAttribute("CRS") == crs:
+            extent = [
+                float(bbox.getAttribute("minx")),
+                float(bbox.getAttribute("miny")),
+                float(bbox.getAttribute("maxx")),
+                float(bbox.getAttribute("maxy"))
+            ]
+            break
+    if extent:
+        return visibleLayers, crs, extent
+    return None
 
-        # set default theme
-        if configItem.get("default", False) or not result["themes"]["defaultTheme"]:
-            result["themes"]["defaultTheme"] = resultItem["id"]
 
-        # use first CRS for thumbnail request which is not CRS:84
-        for item in topLayer.getElementsByTagName("CRS"):
-            crs = getElementValue(item)
-            if crs != "CRS:84":
-                break
-        extent = None
-        for bbox in topLayer.getElementsByTagName("BoundingBox"):
-            if bbox.getAttribute("CRS") == crs:
-                extent = [
-                    float(bbox.getAttribute("minx")),
-                    float(bbox.getAttribute("miny")),
-                    float(bbox.getAttribute("maxx")),
-                    float(bbox.getAttribute("maxy"))
-                ]
-                break
-        if extent:
-            getThumbnail(configItem, resultItem, visibleLayers, crs, extent)
+def initParseProcess(traceMemory):
+    if traceMemory:
+        tracemalloc.start()
 
+# parseTheme wrapper for the process pool, returns the partial result on failure like an in-thread parseTheme
+def parseThemeProcess(config, configItem, result, reply, xmlParser, collectMetrics):
+    resultItem = {}
+    deferred = {}
+    metrics = ItemMetrics() if collectMetrics else nullMetrics
+    threadMetrics.current = metrics
+    metrics.start()
+    try:
+        capabilities, index = parseDocument(reply, xmlParser)
+        thumbnailArgs = parseTheme(config, configItem, result, resultItem, deferred, capabilities, index)
+        error = None
     except Exception as e:
-        print("ERROR reading WMS GetProjectSettings of " + configItem["url"] + ":\n" + str(e))
-        resultItem["error"] = "Could not read GetProjectSettings"
-        resultItem["title"] = "Error"
         traceback.print_exc()
-
-
-# recursively get themes for groups
-def getGroupThemes(config, configGroup, result, resultGroup, groupCounter):
+        thumbnailArgs = None
+        error = str(e)
+    finally:
+        metrics.stop()
+        threadMetrics.current = nullMetrics
+    return resultItem, deferred, thumbnailArgs, error, metrics.toDict()
+
+
+def getGeneratorFingerprint():
+    with open(__file__, "rb") as fh:
+        return hashlib.sha256(fh.read()).hexdigest()
+
+
+def formatPrometheusMetrics(items, startTime, duration):
+    def escape(value):
+        return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+    def labels(index, item, extra={}):
+        entries = {"item": index, "url": item["url"] or "", "theme": item["id"] or ""}
+        entries.update(extra)
+        return ",".join('%s="%s"' % (key, escape(value)) for key, value in entries.items())
+
+    lines = []
+    def metric(name, help, samples):
+        lines.append("# HELP %s %s" % (name, help))
+        lines.append("# TYPE %s gauge" % name)
+        for sampleLabels, value in samples:
+            lines.append("%s{%s} %s" % (name, sampleLabels, repr(float(value))) if sampleLabels else "%s %s" % (name, repr(float(value))))
+
+    metric("qwc2_themes_last_run_timestamp_seconds", "Start time of the last themes.json generation", [(None, startTime)])
+    metric("qwc2_themes_run_seconds", "Duration of processing the theme items", [(None, duration)])
+    metric("qwc2_themes_item_seconds", "Time spent processing a theme item", [
+        (labels(index, item), item["time"]) for index, item in enumerate(items)
+    ])
+    metric("qwc2_themes_item_phase_seconds", "Time spent per phase of a theme item", [
+        (labels(index, item, {"phase": phase}), value) for index, item in enumerate(items) for phase, value in sorted(item["phases"].items())
+    ])
+    metric("qwc2_themes_item_downloaded_bytes", "Bytes downloaded for a theme item", [
+        (labels(index, item), item["bytesDownloaded"]) for index, item in enumerate(items)
+    ])
+    metric("qwc2_themes_item_peak_memory_delta_bytes", "Peak traced memory increase while processing a theme item", [
+        (labels(index, item), item["peakMemoryDelta"]) for index, item in enumerate(items) if item["peakMemoryDelta"] is not None
+    ])
+    metric("qwc2_themes_item_error", "Whether processing a theme item failed", [
+        (labels(index, item), 1 if item["status"] == "error" else 0) for index, item in enumerate(items)
+    ])
+    return "\n".join(lines) + "\n"
+
+
+# recursively collect theme items of groups
+def getGroupThemes(config, configGroup, result, resultGroup, groupCounter, tasks):
     for item in configGroup["items"]:
-        itemEntry = {}
-        getTheme(config, item, result, itemEntry)
-        if itemEntry:
-            resultGroup["items"].append(itemEntry)
+        tasks.append((item, resultGroup))
 
     if "groups" in configGroup:
         for group in configGroup["groups"]:
@@ -596,7 +1098,7 @@ def getGroupThemes(config, configGroup, result, resultGroup, groupCounter):
                 "items": [],
                 "subdirs": []
             }
-            getGroupThemes(config, group, result, groupEntry, groupCounter)
+            getGroupThemes(config, group, result, groupEntry, groupCounter, tasks)
             resultGroup["subdirs"].append(groupEntry)
 
 
@@ -609,67 +1111,1411 @@ def reformatAttribution(entry):
     return entry
 
 
-def genThemes(themesConfig):
-    # load themesConfig.json
-    try:
-        with open(themesConfig, encoding='utf-8') as fh:
-            config = json.load(fh)
-    except:
-        return {"error": "Failed to read themesConfig.json"}
-    result = {
-        "themes": {
-            "title": "root",
-            "subdirs": [],
-            "items": [],
-            "defaultTheme": config["defaultTheme"] if "defaultTheme" in config else None,
-            "defaultMapCrs": config["defaultMapCrs"] if "defaultMapCrs" in config else "EPSG:3857",
-            "defaultScales": config["defaultScales"],
-            "defaultPrintScales": config["defaultPrintScales"] if "defaultPrintScales" in config else None,
-            "defaultPrintResolutions": config["defaultPrintResolutions"] if "defaultPrintResolutions" in config else None,
-            "defaultPrintGrid": config["defaultPrintGrid"] if "defaultPrintGrid" in config else None,
-            "defaultSearchProviders": config["defaultSearchProviders"] if "defaultSearchProviders" in config else None,
-            "defaultBackgroundLayers": config["defaultBackgroundLayers"] if "defaultBackgroundLayers" in config else [],
-            "defaultMapTips": config["defaultMapTips"] if "defaultMapTips" in config else None,
-            "defaultLabelProfiles": config["defaultLabelProfiles"] if "defaultLabelProfiles" in config else None,
-            "pluginData": config["themes"]["pluginData"] if "pluginData" in config["themes"] else [],
-            "themeInfoLinks": config["themes"]["themeInfoLinks"] if "themeInfoLinks" in config["themes"] else [],
-            "externalLayers": config["themes"]["externalLayers"] if "externalLayers" in config["themes"] else [],
-            "backgroundLayers": list(map(reformatAttribution, config["themes"]["backgroundLayers"])),
-            "defaultWMSVersion": config["defaultWMSVersion"] if "defaultWMSVersion" in config else None,
-            "defaultDisplayCrs": config["defaultDisplayCrs"] if "defaultDisplayCrs" in config else None
-            }
+# theme item fields included in the index of the sharded output
+indexThemeKeys = ["id", "name", "title", "description", "url", "thumbnail", "bbox", "initialBbox", "mapCrs", "defaultDisplayCrs", "keywords", "abstract", "error", "stale"]
+
+def getThemeFileName(themeId):
+    name = re.sub(r'[^\w.-]', '_', themeId)
+    if name != themeId:
+        name += "-" + hashlib.sha1(themeId.encode('utf-8')).hexdigest()[:8]
+    return name + ".json"
+
+# split themes into an index with the group tree, defaults and light theme item fields,
+# and the full theme items by file name
+def shardThemes(themes):
+    shards = {}
+    def shardGroup(group):
+        items = []
+        for item in group["items"]:
+            summary = item.indexEntry if isinstance(item, SpooledItem) else item
+            if "id" in summary:
+                fileName = getThemeFileName(summary["id"])
+                shards[fileName] = item
+                entry = {key: summary[key] for key in indexThemeKeys if key in summary}
+                entry["themeFile"] = fileName
+                items.append(entry)
+            else:
+                items.append(item)
+        return dict(group, items=items, subdirs=[shardGroup(subdir) for subdir in group["subdirs"]])
+    if "themes" not in themes:
+        return themes, {}
+    return dict(themes, themes=shardGroup(themes["themes"])), shards
+
+
+# theme item serialized to a ThemeSpool, standing in for the item in the result until the output is written
+class SpooledItem:
+    def __init__(self, spool, offset, size, indexEntry):
+        self.spool = spool
+        self.offset = offset
+        self.size = size
+        self.indexEntry = indexEntry
+
+    def chunks(self):
+        return self.spool.readChunks(self.offset, self.size)
+
+    def load(self):
+        return json.loads(b"".join(self.chunks()))
+
+
+# temporary file collecting the serialized theme items of a run, so that their memory is released as
+# soon as they are finished. Items are stored as formatted in themes.json, see iterThemesJson.
+class ThemeSpool:
+    chunkSize = 65536
+
+    def __init__(self):
+        self.file = tempfile.TemporaryFile(prefix="themes-spool")
+        self.lock = threading.Lock()
+
+    def add(self, item):
+        data = json.dumps(item, indent=2, separators=(',', ': '), sort_keys=True).encode('utf-8')
+        with self.lock:
+            offset = self.file.seek(0, os.SEEK_END)
+            self.file.write(data)
+        return SpooledItem(self, offset, len(data), {key: item[key] for key in indexThemeKeys if key in item})
+
+    def readChunks(self, offset, size):
+        end = offset + size
+        while offset < end:
+            with self.lock:
+                self.file.seek(offset)
+                chunk = self.file.read(min(self.chunkSize, end - offset))
+            if not chunk:
+                raise Exception("Truncated themes spool")
+            offset += len(chunk)
+            yield chunk
+
+    def close(self):
+        self.file.close()
+
+
+# encode themes as themes.json in chunks, streaming spooled theme items from their spool
+# the output is identical to json.dumps(themes, indent=2, separators=(',', ': '), sort_keys=True)
+def iterThemesJson(themes):
+    spooledItems = {}
+    token = uuid.uuid4().hex
+    def default(obj):
+        if isinstance(obj, SpooledItem):
+            marker = "spool:%s:%d" % (token, len(spooledItems))
+            spooledItems[json.dumps(marker)] = obj
+            return marker
+        raise TypeError("Object of type %s is not JSON serializable" % type(obj).__name__)
+
+    encoder = json.JSONEncoder(indent=2, separators=(',', ': '), sort_keys=True, default=default)
+    indent = ""
+    pending = []
+    pendingSize = 0
+    for chunk in encoder.iterencode(themes):
+        item = spooledItems.pop(chunk, None)
+        if item is None:
+            pos = chunk.rfind("\n")
+            if pos >= 0:
+                line = chunk[pos + 1:]
+                indent = line[:len(line) - len(line.lstrip(" "))]
+            pending.append(chunk)
+            pendingSize += len(chunk)
+            if pendingSize >= ThemeSpool.chunkSize:
+                yield "".join(pending).encode('utf-8')
+                pending = []
+                pendingSize = 0
+            continue
+        if pending:
+            yield "".join(pending).encode('utf-8')
+            pending = []
+            pendingSize = 0
+        # spooled items are formatted at the top level, indent them to their position in the tree
+        newline = ("\n" + indent).encode('utf-8')
+        for data in item.chunks():
+            yield data.replace(b"\n", newline)
+    if pending:
+        yield "".join(pending).encode('utf-8')
+
+
+# compress a file to a gz or br sibling in chunks
+def compressFileChunks(filename, ext, chunkSize=65536):
+    with open(filename, "rb") as fh:
+        if ext == "gz":
+            # same as gzip.compress(data, compresslevel=9, mtime=0)
+            compressor = zlib.compressobj(9, zlib.DEFLATED, 31)
+            for chunk in iter(lambda: fh.read(chunkSize), b""):
+                yield compressor.compress(chunk)
+            yield compressor.flush()
+        else:
+            compressor = brotli.Compressor()
+            for chunk in iter(lambda: fh.read(chunkSize), b""):
+                yield compressor.process(chunk)
+            yield compressor.finish()
+
+
+# version of the compact themes.json schema, see compactThemes
+compactThemesVersion = 2
+
+# fields omitted from theme items, layer groups and layers of the compact schema if they have these values
+compactDefaults = {
+    "theme": {
+        "abstract": "",
+        "attribution": {"Title": "", "OnlineResource": ""},
+        "defaultDisplayCrs": None,
+        "description": "",
+        "editConfig": None,
+        "expanded": True,
+        "externalLayers": [],
+        "keywords": "",
+        "searchProviders": []
+    },
+    "group": {
+        "expanded": True,
+        "mutuallyExclusive": False,
+        "visibility": True
+    },
+    "layer": {
+        "abstract": "",
+        "attribution": {"Title": "", "OnlineResource": ""},
+        "dataUrl": "",
+        "dimensions": [],
+        "keywords": "",
+        "metadataUrl": "",
+        "opacity": 255,
+        "queryable": False,
+        "style": "default",
+        "styles": {"default": "default"},
+        "visibility": True
     }
-    groupCounter = 0
-    getGroupThemes(config, config["themes"], result, result["themes"], groupCounter)
-
-    for entry in autogenExternalLayers:
-        cpos = entry.find(":")
-        hpos = entry.rfind('#')
-        type = entry[0:cpos]
-        url = entry[cpos+1:hpos]
-        layername = entry[hpos+1:]
-        result["themes"]["externalLayers"].append({
-            "name": entry,
-            "type": type,
+}
+
+# minimum serialized size of repeated sub-objects moved to the shared table of the compact schema
+compactMinSharedSize = 24
+
+
+# walk the theme items and layers of the themes tree, calling func(entry, kind) with kind a key of compactDefaults
+def walkThemeEntries(group, func):
+    def walkLayer(layer):
+        func(layer, "group" if "sublayers" in layer else "layer")
+        for sublayer in layer.get("sublayers", []):
+            walkLayer(sublayer)
+    for item in group["items"]:
+        func(item, "theme")
+        for sublayer in item.get("sublayers", []):
+            walkLayer(sublayer)
+    for subdir in group["subdirs"]:
+        walkThemeEntries(subdir, func)
+
+
+# encode themes in the compact schema: fields equal to compactDefaults are omitted (fields absent although they
+# have a default are listed in "$missing"), repeated sub-objects are moved to the "shared" table and replaced
+# by {"$ref": index}. The defaults are included, expandCompactThemes restores the original structure.
+# Keys starting with "$" are reserved for the schema, such keys of the themes (i.e. in pluginData) get another "$".
+def compactThemes(themes):
+    if "themes" not in themes:
+        return themes
+    def escapeKeys(node):
+        if isinstance(node, dict):
+            return {("$" + name if name.startswith("$") else name): escapeKeys(value) for name, value in node.items()}
+        elif isinstance(node, list):
+            return [escapeKeys(value) for value in node]
+        return node
+    themes = escapeKeys(themes)
+    def omitDefaults(entry, kind):
+        defaults = compactDefaults[kind]
+        missing = sorted(key for key in defaults if key not in entry)
+        for key, value in defaults.items():
+            # compare types too, as 1 == True
+            if key in entry and type(entry[key]) is type(value) and entry[key] == value:
+                del entry[key]
+        if missing:
+            entry["$missing"] = missing
+    walkThemeEntries(themes["themes"], omitDefaults)
+
+    # count identical sub-objects by structural signature, along with their approximate serialized size
+    signatures = {}
+    nodeSignatures = {}
+    counts = Counter()
+    sizes = {}
+    def signature(node):
+        if isinstance(node, dict):
+            key = ("d",) + tuple((name, signature(value)) for name, value in sorted(node.items()))
+            size = 2 + sum(len(name) + 4 + sizes[sig] for name, sig in key[1:])
+        elif isinstance(node, list):
+            key = ("l",) + tuple(signature(value) for value in node)
+            size = 2 + sum(sizes[sig] + 1 for sig in key[1:])
+        else:
+            key = ("v", type(node).__name__, node)
+            size = len(json.dumps(node))
+        sig = signatures.setdefault(key, len(signatures))
+        sizes[sig] = size
+        if isinstance(node, (dict, list)):
+            counts[sig] += 1
+            nodeSignatures[id(node)] = sig
+        return sig
+    signature(themes)
+
+    shared = []
+    sharedIds = {}
+    def intern(node, root=False):
+        if not isinstance(node, (dict, list)):
+            return node
+        sig = nodeSignatures[id(node)]
+        if not root and counts[sig] > 1 and sizes[sig] >= compactMinSharedSize:
+            if sig not in sharedIds:
+                entry = intern(node, True)
+                sharedIds[sig] = len(shared)
+                shared.append(entry)
+            return {"$ref": sharedIds[sig]}
+        if isinstance(node, dict):
+            return {name: intern(value) for name, value in sorted(node.items())}
+        return [intern(value) for value in node]
+
+    result = intern(themes, True)
+    result["compact"] = compactThemesVersion
+    result["defaults"] = compactDefaults
+    result["shared"] = shared
+    return result
+
+
+# expand themes in the compact schema written by compactThemes to the regular structure
+def expandCompactThemes(themes):
+    if "compact" not in themes:
+        return themes
+    shared = themes["shared"]
+    # shared entries are expanded again for every reference, so that no objects are shared in the result
+    def expand(node):
+        if isinstance(node, dict):
+            if len(node) == 1 and "$ref" in node:
+                return expand(shared[node["$ref"]])
+            return {name: expand(value) for name, value in node.items()}
+        elif isinstance(node, list):
+            return [expand(value) for value in node]
+        return node
+    result = expand({key: value for key, value in themes.items() if key not in ["compact", "defaults", "shared"]})
+    def applyDefaults(entry, kind):
+        missing = entry.pop("$missing", [])
+        for key, value in themes["defaults"][kind].items():
+            if key not in entry and key not in missing:
+                entry[key] = expand(value)
+    walkThemeEntries(result["themes"], applyDefaults)
+    # unescaped once "$missing" is consumed, as an escaped "$$missing" key becomes "$missing"
+    def unescapeKeys(node):
+        if isinstance(node, dict):
+            return {(name[1:] if name.startswith("$$") else name): unescapeKeys(value) for name, value in node.items()}
+        elif isinstance(node, list):
+            return [unescapeKeys(value) for value in node]
+        return node
+    return unescapeKeys(result)
+
+
+def getConfigEditConfigs(configGroup):
+    editConfigs = [item["editConfig"] for item in configGroup.get("items", []) if isinstance(item.get("editConfig"), str)]
+    for group in configGroup.get("groups", []):
+        editConfigs += getConfigEditConfigs(group)
+    return editConfigs
+
+
+# Generator of themes.json from a themes config. Owns its settings (see getDefaultSettings), the HTTP
+# client, the parsed GetProjectSettings documents and the edit configs, which are reused by later
+# generate() calls. Runs of the same instance are serialized, separate instances may run concurrently.
+class ThemesGenerator:
+    def __init__(self, **settings):
+        defaultSettings = getDefaultSettings()
+        unknown = set(settings) - set(defaultSettings)
+        if unknown:
+            raise TypeError("Unknown settings: " + ", ".join(sorted(unknown)))
+        for key, value in dict(defaultSettings, **settings).items():
+            setattr(self, key, copy.copy(value))
+        if "br" in self.precompressFormats and not brotli:
+            print("WARNING: brotli module not available, not writing .br files")
+            self.precompressFormats.remove("br")
+        self.thumbnailVariantFormats = [fmt for fmt in self.thumbnailVariantFormats if fmt in ["png", "webp"]]
+        if self.thumbnailVariantFormats and not Image:
+            print("WARNING: PIL module not available, not generating thumbnail variants")
+            self.thumbnailVariantFormats = []
+        if self.legendSprites and not Image:
+            print("WARNING: PIL module not available, not generating legend sprites")
+            self.legendSprites = False
+        if self.compactOutput and self.spoolOutput:
+            print("WARNING: compact output requires all themes in memory, not spooling")
+            self.spoolOutput = False
+
+        self.httpClient = HttpClient(self.connectTimeout, self.readTimeout, self.httpRetries)
+        self.processPool = None
+        self.documentCache = OrderedDict()
+        self.editConfigCache = {}
+        self.wmtsCapabilitiesCache = {}
+        self.cacheLock = threading.Lock()
+        self.generateLock = threading.Lock()
+        self.stateName = "themes-state"
+        # state of the current run
+        self.usedThemeIds = []
+        self.autogenExternalLayers = []
+        self.staleThemeItems = []
+        self.thumbnailVariantsCache = {}
+        self.spool = None
+
+    # release the process pool, the idle HTTP connections and the spool of the last run
+    def close(self):
+        if self.spool:
+            self.spool.close()
+            self.spool = None
+        if self.processPool:
+            self.processPool.shutdown()
+            self.processPool = None
+        self.httpClient.close()
+
+    # generator for one tenant of a batch, with its own themes config, output and theme ids, sharing
+    # the HTTP client, caches and process pool of this generator. Tenants must not be closed.
+    def tenant(self, **settings):
+        unknown = set(settings) - set(tenantSettings)
+        if unknown:
+            raise TypeError("Unknown tenant settings: " + ", ".join(sorted(unknown)))
+        tenant = copy.copy(self)
+        tenant.metricsFile = ""
+        tenant.prometheusFile = ""
+        for key, value in settings.items():
+            setattr(tenant, key, value)
+        # tenants sharing a cache dir keep separate incremental states
+        tenant.stateName = "themes-state-" + hashlib.sha256(os.path.abspath(tenant.outputFile).encode('utf-8')).hexdigest()[:16]
+        tenant.generateLock = threading.Lock()
+        tenant.usedThemeIds = []
+        tenant.autogenExternalLayers = []
+        tenant.staleThemeItems = []
+        tenant.thumbnailVariantsCache = {}
+        tenant.spool = None
+        return tenant
+
+    def getProcessPool(self, traceMemory):
+        if self.themesProcesses > 0 and not self.processPool:
+            # the pool is started while HTTP worker threads are running, forking them could deadlock the workers
+            startMethod = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            self.processPool = ProcessPoolExecutor(
+                max_workers=self.themesProcesses, mp_context=multiprocessing.get_context(startMethod),
+                initializer=initParseProcess, initargs=(traceMemory,)
+            )
+        return self.processPool
+
+    # parsed GetProjectSettings document, cached for the next runs as long as the reply does not change
+    def getDocument(self, requestKey, reply):
+        digest = hashlib.sha256(reply).digest()
+        with self.cacheLock:
+            entry = self.documentCache.get(requestKey)
+            if entry and entry[0] == digest:
+                self.documentCache.move_to_end(requestKey)
+                return entry[1]
+        document = parseDocument(reply, self.xmlParser)
+        if self.documentCacheSize > 0:
+            with self.cacheLock:
+                self.documentCache[requestKey] = (digest, document)
+                self.documentCache.move_to_end(requestKey)
+                while len(self.documentCache) > self.documentCacheSize:
+                    self.documentCache.popitem(last=False)
+        return document
+
+    def uniqueThemeId(self, themeName):
+        if not themeName:
+            return str(uuid.uuid1())
+        if themeName in self.usedThemeIds:
+            i = 1
+            while ("%s%d") % (themeName, i) in self.usedThemeIds:
+                i += 1
+            self.usedThemeIds.append(("%s%d") % (themeName, i))
+            return self.usedThemeIds[-1]
+        else:
+            self.usedThemeIds.append(themeName)
+            return self.usedThemeIds[-1]
+
+    def httpGet(self, configItem, url, headers={}):
+        return self.httpClient.get(url, headers, configItem.get('wmsBasicAuth'))
+
+    def getCacheFiles(self, configItem, url):
+        auth = configItem.get('wmsBasicAuth')
+        key = hashlib.sha256((url + "\n" + (auth['username'] if auth else "")).encode('utf-8')).hexdigest()
+        return os.path.join(self.cacheDir, key + ".body"), os.path.join(self.cacheDir, key + ".json")
+
+    # read url, using the cache directory if configured
+    # cached replies are revalidated with If-None-Match / If-Modified-Since unless younger than cacheMaxAge
+    def cachedUrlRead(self, configItem, url):
+        if not self.cacheDir:
+            return self.httpGet(configItem, url)[0]
+
+        bodyFile, metaFile = self.getCacheFiles(configItem, url)
+        meta = None
+        if os.path.exists(bodyFile) and os.path.exists(metaFile):
+            try:
+                with open(metaFile, encoding='utf-8') as fh:
+                    meta = json.load(fh)
+            except:
+                meta = None
+
+        if meta and self.cacheMaxAge > 0 and time.time() - meta["fetched"] < self.cacheMaxAge:
+            with open(bodyFile, "rb") as fh:
+                return fh.read()
+
+        requestHeaders = {}
+        if meta and meta.get("etag"):
+            requestHeaders["If-None-Match"] = meta["etag"]
+        if meta and meta.get("lastModified"):
+            requestHeaders["If-Modified-Since"] = meta["lastModified"]
+        try:
+            reply, headers = self.httpGet(configItem, url, requestHeaders)
+        except request.HTTPError as e:
+            if e.code != 304 or not meta:
+                raise
+            with open(bodyFile, "rb") as fh:
+                reply = fh.read()
+            headers = e.headers
+            meta["etag"] = headers.get("ETag") or meta.get("etag")
+            meta["lastModified"] = headers.get("Last-Modified") or meta.get("lastModified")
+            meta["fetched"] = time.time()
+            writeFileAtomic(metaFile, json.dumps(meta).encode('utf-8'))
+            return reply
+
+        os.makedirs(self.cacheDir, exist_ok=True)
+        writeFileAtomic(bodyFile, reply)
+        writeFileAtomic(metaFile, json.dumps({
             "url": url,
-            "params": {"LAYERS": layername},
-            "infoFormats": ["text/plain"]
-        })
+            "etag": headers.get("ETag"),
+            "lastModified": headers.get("Last-Modified"),
+            "fetched": time.time()
+        }).encode('utf-8'))
+        return reply
+
+    # last cached reply of url regardless of its age, or None
+    def readStaleReply(self, configItem, url):
+        if not self.cacheDir:
+            return None
+        bodyFile = self.getCacheFiles(configItem, url)[0]
+        try:
+            with open(bodyFile, "rb") as fh:
+                return fh.read()
+        except OSError:
+            return None
 
-    if "backgroundLayers" in result["themes"]:
-        # get thumbnails for background layers
+    # load thumbnail from file or GetMap
+    # generated thumbnails are named by a hash of the GetMap request and only rendered again once older than thumbnailMaxAge
+    def getThumbnail(self, configItem, resultItem, layers, crs, extent):
+        if "thumbnail" in configItem:
+            if os.path.exists(self.qwc2_path + "/static/assets/img/mapthumbs/" + configItem["thumbnail"]):
+                resultItem["thumbnail"] = "img/mapthumbs/" + configItem["thumbnail"]
+                return True
+
+        # WMS GetMap request, at twice the size if 2x variants are generated from it
+        scale = 2 if self.thumbnailVariantFormats else 1
+        params = {'SERVICE': 'WMS', 'VERSION': '1.3.0', 'REQUEST': 'GetMap', 'FORMAT': 'image/png', 'STYLES': '', 'WIDTH': str(200 * scale), 'HEIGHT': str(100 * scale), 'CRS': crs}
+        if scale > 1:
+            params['DPI'] = str(96 * scale)
+        url = update_params(urljoin(self.baseUrl, configItem["url"]), params)
+        bboxw = extent[2] - extent[0]
+        bboxh = extent[3] - extent[1]
+        bboxcx = 0.5 * (extent[0] + extent[2])
+        bboxcy = 0.5 * (extent[1] + extent[3])
+        imgratio = 200. / 100.
+        if bboxw > bboxh:
+            bboxratio = bboxw / bboxh
+            if bboxratio > imgratio:
+                bboxh = bboxw / imgratio
+            else:
+                bboxw = bboxh * imgratio
+        else:
+            bboxw = bboxh * imgratio
+        adjustedExtent = [bboxcx - 0.5 * bboxw, bboxcy - 0.5 * bboxh,
+                          bboxcx + 0.5 * bboxw, bboxcy + 0.5 * bboxh]
+        url += "&BBOX=" + (",".join(map(str, adjustedExtent)))
+        url += "&LAYERS=" + quote(",".join(layers).encode('utf-8'))
+
+        auth = configItem.get('wmsBasicAuth')
+        key = hashlib.sha256((url + "\n" + (auth['username'] if auth else "")).encode('utf-8')).hexdigest()[:16]
+        basename = configItem["url"].rsplit("/")[-1].rstrip("?") + "-" + key + ".png"
+        thumbnail = self.qwc2_path + "/static/assets/img/genmapthumbs/" + basename
+        try:
+            if self.thumbnailMaxAge > 0 and os.path.exists(thumbnail) and time.time() - os.path.getmtime(thumbnail) < self.thumbnailMaxAge:
+                print("Using cached thumbnail " + basename)
+                resultItem["thumbnail"] = "img/genmapthumbs/" + basename
+                return True
+
+            print("Using WMS GetMap to generate thumbnail for " + configItem["url"])
+            reply = self.httpGet(configItem, url)[0]
+            try:
+                os.makedirs(self.qwc2_path + "/static/assets/img/genmapthumbs/")
+            except Exception as e:
+                if not isinstance(e, FileExistsError): raise e
+            writeFileAtomic(thumbnail, reply)
+            resultItem["thumbnail"] = "img/genmapthumbs/" + basename
+            return True
+        except Exception as e:
+            print("ERROR generating thumbnail for WMS " + configItem["url"] + ":\n" + str(e))
+            resultItem["thumbnail"] = "img/mapthumbs/default.jpg"
+            traceback.print_exc()
+            return False
+
+    # optimized variants of a thumbnail for the thumbnailVariantFormats, fitted into 200x100 at 1x and 400x200 at 2x
+    # variants are named by a hash of the source image and only generated if missing
+    def getThumbnailVariants(self, thumbnail):
+        with open(self.qwc2_path + "/static/assets/" + thumbnail, "rb") as fh:
+            data = fh.read()
+        key = hashlib.sha256(data + ",".join(self.thumbnailVariantFormats).encode('utf-8')).hexdigest()[:16]
+        stem = os.path.splitext(os.path.basename(thumbnail))[0]
+        image = Image.open(io.BytesIO(data))
+        hasAlpha = image.mode in ["RGBA", "LA", "PA"] or "transparency" in image.info
+        converted = None
+        variants = []
+        previousSize = None
+        for scale in [1, 2]:
+            factor = min(1, 200. * scale / image.width, 100. * scale / image.height)
+            size = (max(1, round(image.width * factor)), max(1, round(image.height * factor)))
+            if size == previousSize:
+                # source too small for this scale
+                break
+            previousSize = size
+            for fmt in self.thumbnailVariantFormats:
+                path = "img/thumbvariants/%s-%s@%dx.%s" % (stem, key, scale, fmt)
+                filename = self.qwc2_path + "/static/assets/" + path
+                if not os.path.exists(filename):
+                    if not converted:
+                        converted = image.convert("RGBA" if hasAlpha else "RGB")
+                    resized = converted.resize(size, Image.Resampling.LANCZOS) if size != converted.size else converted
+                    out = io.BytesIO()
+                    if fmt == "webp":
+                        resized.save(out, "WEBP", quality=80, method=6)
+                    else:
+                        method = Image.Quantize.FASTOCTREE if hasAlpha else Image.Quantize.MEDIANCUT
+                        resized.quantize(256, method=method).save(out, "PNG", optimize=True)
+                    os.makedirs(os.path.dirname(filename), exist_ok=True)
+                    writeFileAtomic(filename, out.getvalue())
+                variants.append({"src": path, "type": "image/" + fmt, "scale": scale, "width": size[0], "height": size[1]})
+        return variants
+
+    # add thumbnailVariants to all theme items and background layers, the thumbnail itself is replaced by the 1x PNG variant
+    # variantsCache holds the variants of the thumbnails already processed in this run
+    def addThumbnailVariants(self, entry, variantsCache):
+        thumbnail = entry.get("thumbnail")
+        # entries published from the previous output keep their variants, their thumbnail already is a variant
+        if not thumbnail or "thumbnailVariants" in entry:
+            return
+        if thumbnail not in variantsCache:
+            try:
+                variantsCache[thumbnail] = self.getThumbnailVariants(thumbnail)
+            except Exception as e:
+                print("ERROR generating thumbnail variants of " + thumbnail + ":\n" + str(e))
+                variantsCache[thumbnail] = None
+        variants = variantsCache[thumbnail]
+        if variants:
+            entry["thumbnailVariants"] = variants
+            entry["thumbnail"] = next((variant["src"] for variant in variants if variant["type"] == "image/png" and variant["scale"] == 1), thumbnail)
+
+    # spooled theme items got their variants before being spooled
+    def genThumbnailVariants(self, result, variantsCache):
+        def addGroupVariants(group):
+            for item in group["items"]:
+                if not isinstance(item, SpooledItem):
+                    self.addThumbnailVariants(item, variantsCache)
+            for subdir in group["subdirs"]:
+                addGroupVariants(subdir)
+
+        addGroupVariants(result["themes"])
         for backgroundLayer in result["themes"]["backgroundLayers"]:
-            imgPath = "img/mapthumbs/" + backgroundLayer.get("thumbnail", "default.jpg")
-            if not os.path.isfile(qwc2_path + "/static/assets/" + imgPath):
-                imgPath = "img/mapthumbs/default.jpg"
-            backgroundLayer["thumbnail"] = imgPath
+            self.addThumbnailVariants(backgroundLayer, variantsCache)
+
+    # fetch the legend graphics of all leaf layers and styles of a theme and pack them into a sprite sheet
+    # identical legend images are stored once, the sheet is named by a hash of its content
+    # returns whether all legend graphics could be fetched
+    def genLegendSprite(self, configItem, resultItem):
+        legendLayers = getLegendLayers(resultItem["sublayers"], [])
+        if not legendLayers or not resultItem.get("legendUrl"):
+            return True
+        legendUrl = urljoin(self.baseUrl, resultItem["legendUrl"])
+
+        def fetchLegend(layer, style):
+            url = update_params(legendUrl, {'SERVICE': 'WMS', 'VERSION': '1.3.0', 'REQUEST': 'GetLegendGraphic', 'FORMAT': 'image/png', 'SLD_VERSION': '1.1.0', 'WIDTH': '200', 'HEIGHT': '200', 'LAYER': layer, 'STYLES': style})
+            try:
+                return self.cachedUrlRead(configItem, url)
+            except Exception as e:
+                print("ERROR fetching legend graphic of layer " + layer + " of " + configItem["url"] + ":\n" + str(e))
+                return None
+
+        print("Generating legend sprite for " + configItem["url"])
+        with ThreadPoolExecutor(max_workers=max(1, self.legendJobs)) as executor:
+            replies = list(executor.map(lambda entry: fetchLegend(*entry), legendLayers))
+
+        images = {}
+        legendKeys = {}
+        complete = True
+        for (layer, style), reply in zip(legendLayers, replies):
+            if not reply:
+                complete = False
+                continue
+            key = hashlib.sha256(reply).hexdigest()
+            if key not in images:
+                try:
+                    images[key] = Image.open(io.BytesIO(reply)).convert("RGBA")
+                except Exception as e:
+                    print("ERROR reading legend graphic of layer " + layer + " of " + configItem["url"] + ":\n" + str(e))
+                    complete = False
+                    continue
+            legendKeys[(layer, style)] = key
+        if not images:
+            return complete
+
+        sheet, offsets = packSprite(images)
+        out = io.BytesIO()
+        sheet.save(out, "PNG", optimize=True)
+        data = out.getvalue()
+        path = "img/legendsprites/" + hashlib.sha256(data).hexdigest()[:16] + ".png"
+        filename = self.qwc2_path + "/static/assets/" + path
+        if not os.path.exists(filename):
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            writeFileAtomic(filename, data)
+        layers = {}
+        for (layer, style), key in legendKeys.items():
+            layers.setdefault(layer, {})[style] = offsets[key]
+        resultItem["legendSprite"] = {
+            "src": path,
+            "width": sheet.width,
+            "height": sheet.height,
+            "layers": layers
+        }
+        return complete
 
-    return result
+    def getEditConfigFilename(self, editConfig):
+        if not editConfig or isinstance(editConfig, dict):
+            return None
+        elif os.path.isabs(editConfig):
+            filename = editConfig
+        else:
+            dirname = os.path.dirname(self.themesConfig)
+            if not dirname:
+                dirname = "."
+            filename = os.path.join(dirname, editConfig)
+        return filename if os.path.exists(filename) else None
+
+    def getEditConfig(self, editConfig):
+        if not editConfig:
+            return None
+        elif isinstance(editConfig, dict):
+            return editConfig
+        filename = self.getEditConfigFilename(editConfig)
+        if filename:
+            # reuse the parsed file until it changes on disk
+            stat = os.stat(filename)
+            with self.cacheLock:
+                entry = self.editConfigCache.get(filename)
+            if entry and entry[0] == (stat.st_mtime_ns, stat.st_size):
+                return entry[1]
+            with open(filename, encoding='utf-8') as fh:
+                config = json.load(fh)
+            with self.cacheLock:
+                self.editConfigCache[filename] = ((stat.st_mtime_ns, stat.st_size), config)
+            return config
+        return None
+
+    def getProjectSettingsUrl(self, configItem):
+        return update_params(urljoin(self.baseUrl, configItem["url"]), {'SERVICE': 'WMS', 'VERSION': '1.3.0', 'REQUEST': 'GetProjectSettings'})
+
+    # theme items with the same request key share their GetProjectSettings request
+    def getRequestKey(self, configItem):
+        return self.getProjectSettingsUrl(configItem) + "\n" + json.dumps(configItem.get('wmsBasicAuth'), sort_keys=True)
+
+    def getTasksRequestKeys(self, tasks):
+        return [self.getRequestKey(item) for item, resultGroup in tasks if not item.get("disabled", False)]
+
+    # compute hash of all inputs of a theme item, for incremental regeneration
+    def getThemeFingerprint(self, config, configItem, result, reply):
+        fingerprint = hashlib.sha256()
+        inputs = [configItem, self.baseUrl, config.get("defaultWMSVersion"), result["themes"]["defaultMapCrs"], result["themes"]["defaultDisplayCrs"], self.legendSprites, bool(self.thumbnailVariantFormats)]
+        fingerprint.update(json.dumps(inputs, sort_keys=True).encode('utf-8'))
+        fingerprint.update(reply)
+        editConfigFile = self.getEditConfigFilename(configItem.get("editConfig"))
+        if editConfigFile:
+            with open(editConfigFile, "rb") as fh:
+                fingerprint.update(fh.read())
+        if "thumbnail" in configItem:
+            thumbnailExists = os.path.exists(self.qwc2_path + "/static/assets/img/mapthumbs/" + configItem["thumbnail"])
+            fingerprint.update(b"1" if thumbnailExists else b"0")
+        return fingerprint.hexdigest()
+
+    # check whether a theme item from a previous run can be reused
+    def isReusableThemeItem(self, previous):
+        if not previous:
+            return False
+        thumbnail = previous["item"].get("thumbnail", "")
+        if thumbnail.startswith("img/genmapthumbs/") and not os.path.exists(self.qwc2_path + "/static/assets/" + thumbnail):
+            return False
+        return "legendSprite" not in previous["item"] or os.path.exists(self.qwc2_path + "/static/assets/" + previous["item"]["legendSprite"]["src"])
+
+    # get theme from GetProjectSettings, reusing the previous result if its inputs are unchanged
+    # NOTE: may run concurrently for several items, state shared between items is recorded in
+    # deferred and applied by finalizeTheme in config order
+    def getTheme(self, config, configItem, result, resultItem, deferred, previousItems=None, processPool=None, sharedRequests=None):
+        if (configItem.get("disabled", False)):
+            print(f"Item {configItem.get("url")} {"(" + configItem.get("title") + ")" if configItem.get("title") else ""} has been disabled")
+            return
+
+        url = self.getProjectSettingsUrl(configItem)
+        if not sharedRequests:
+            sharedRequests = SharedRequests([])
+        requestKey = self.getRequestKey(configItem)
+
+        # with staleFallback, the last cached reply is used if the request fails
+        def fetchReply():
+            try:
+                return self.cachedUrlRead(configItem, url), False
+            except Exception as e:
+                reply = self.readStaleReply(configItem, url) if self.staleFallback else None
+                if reply is None:
+                    raise
+                print("WARNING: reading WMS GetProjectSettings of " + configItem["url"] + " failed (" + str(e) + "), using last cached reply")
+                return reply, True
+
+        try:
+            reply, stale = sharedRequests.get("reply", requestKey, fetchReply)
+            if stale:
+                deferred["stale"] = True
+            if previousItems is not None:
+                deferred["fingerprint"] = self.getThemeFingerprint(config, configItem, result, reply)
+                previous = previousItems.get(deferred["fingerprint"])
+                if self.isReusableThemeItem(previous):
+                    print(f"Reusing unchanged theme item {configItem.get("url")} {"(" + configItem.get("title") + ")" if configItem.get("title") else ""}")
+                    itemMetrics().status = "reused"
+                    resultItem.update(copy.deepcopy(previous["item"]))
+                    deferred.update(previous["deferred"])
+                    return
+            if processPool and len(reply) >= self.processMinSize:
+                # parse large documents in a separate process, the defaults are the only part of result used by parseTheme
+                resultDefaults = {"themes": {key: result["themes"][key] for key in ["defaultMapCrs", "defaultDisplayCrs"]}}
+                processResult = processPool.submit(parseThemeProcess, config, configItem, resultDefaults, reply, self.xmlParser, itemMetrics() is not nullMetrics).result()
+                resultItem.update(processResult[0])
+                deferred.update(processResult[1])
+                thumbnailArgs = processResult[2]
+                itemMetrics().merge(processResult[4])
+                if processResult[3] is not None:
+                    raise Exception(processResult[3])
+            else:
+                capabilities, index = sharedRequests.get("document", requestKey, lambda: self.getDocument(requestKey, reply))
+                thumbnailArgs = parseTheme(config, configItem, result, resultItem, deferred, capabilities, index)
+            with itemMetrics().phase("editConfig"):
+                resultItem["editConfig"] = self.getEditConfig(configItem["editConfig"] if "editConfig" in configItem else None)
+            if thumbnailArgs:
+                with itemMetrics().phase("thumbnail"):
+                    if not self.getThumbnail(configItem, resultItem, *thumbnailArgs):
+                        deferred["thumbnailFailed"] = True
+            if self.legendSprites and "sublayers" in resultItem:
+                with itemMetrics().phase("legendSprite"):
+                    if not self.genLegendSprite(configItem, resultItem):
+                        deferred["legendsFailed"] = True
+
+        except Exception as e:
+            print("ERROR reading WMS GetProjectSettings of " + configItem["url"] + ":\n" + str(e))
+            resultItem["error"] = "Could not read GetProjectSettings"
+            resultItem["title"] = "Error"
+            traceback.print_exc()
+            deferred.pop("fingerprint", None)
+            # a failed item is never the default theme, even if it failed after parseTheme
+            deferred.pop("default", None)
+
+    # apply theme id, default theme and autogenerated external layers, must be called in config order
+    def finalizeTheme(self, result, resultItem, deferred):
+        self.autogenExternalLayers += deferred.get("autogenExternalLayers", [])
+        if "id" in resultItem:
+            resultItem["id"] = self.uniqueThemeId(resultItem["id"])
+        if "default" in deferred and (deferred["default"] or not result["themes"]["defaultTheme"]):
+            result["themes"]["defaultTheme"] = resultItem["id"]
+
+    def processTheme(self, config, configItem, result, previousItems, processPool, sharedRequests, metrics):
+        resultItem = {}
+        deferred = {}
+        threadMetrics.current = metrics
+        metrics.start()
+        try:
+            self.getTheme(config, configItem, result, resultItem, deferred, previousItems, processPool, sharedRequests)
+        finally:
+            metrics.stop()
+            threadMetrics.current = nullMetrics
+        return resultItem, deferred
+
+    # process collected theme items with a bounded worker pool, optionally parsing large documents in a process pool
+    # returns the theme items to store for the next incremental run, by fingerprint
+    # if metricsReport is a list, the metrics of each theme item are appended to it
+    # with staleFallback, failed theme items are replaced by their entry in outputFile, see loadPreviousThemes
+    # executor and sharedRequests are passed for batches, to share them between the tenants
+    # with spoolOutput, finished theme items are moved to the spool and at most a few jobs per worker are pending
+    def processThemes(self, config, result, tasks, previousItems=None, metricsReport=None, executor=None, sharedRequests=None):
+        currentItems = {}
+        # memory tracing considerably slows down parsing, hence only enabled on request
+        traceMemory = metricsReport is not None and self.metricsMemory
+        with memoryTracker.tracing(traceMemory):
+            processPool = self.getProcessPool(traceMemory)
+            if not sharedRequests:
+                sharedRequests = SharedRequests(self.getTasksRequestKeys(tasks))
+            itemsMetrics = [ItemMetrics() if metricsReport is not None else nullMetrics for task in tasks]
+            publishedCount = 0
+            # previous output, only loaded once an item fails
+            previousThemes = None
+            window = 4 * max(1, self.themesJobs) if self.spool else len(tasks)
+            with contextlib.ExitStack() as stack:
+                if not executor:
+                    executor = stack.enter_context(ThreadPoolExecutor(max_workers=max(1, self.themesJobs)))
+                futures = {}
+                def submit(index):
+                    if index < len(tasks):
+                        futures[index] = executor.submit(self.processTheme, config, tasks[index][0], result, previousItems, processPool, sharedRequests, itemsMetrics[index])
+                for index in range(window):
+                    submit(index)
+                for index, ((item, resultGroup), metrics) in enumerate(zip(tasks, itemsMetrics)):
+                    resultItem, deferred = futures.pop(index).result()
+                    submit(index + window)
+                    if not item.get("disabled", False):
+                        sharedRequests.release(self.getRequestKey(item))
+                    # theme items are matched to the previous entries by their configured id, else by their
+                    # position among the published items, i.e. all but the disabled ones, if the url is unchanged
+                    position = publishedCount
+                    if not item.get("disabled", False):
+                        publishedCount += 1
+                    previousThemeItem = None
+                    if "error" in resultItem and self.staleFallback:
+                        if previousThemes is None:
+                            previousThemes = self.loadPreviousThemes(self.outputFile)
+                        if "id" in item:
+                            previousThemeItem = next((entry for entry in previousThemes if entry.get("url") == item["url"] and entry.get("id") == item["id"]), None)
+                        if not previousThemeItem and position < len(previousThemes) and previousThemes[position].get("url") == item["url"]:
+                            previousThemeItem = previousThemes[position]
+                    if previousThemeItem and "error" not in previousThemeItem:
+                        print("WARNING: publishing previous entry of " + item["url"] + " until it can be read again")
+                        resultItem.clear()
+                        resultItem.update(previousThemeItem)
+                        deferred["stale"] = True
+                        deferred["default"] = item.get("default", False)
+                        deferred["autogenExternalLayers"] = [entry["name"] for entry in resultItem.get("externalLayers", []) if entry not in item.get("externalLayers", [])]
+                    if deferred.get("stale"):
+                        resultItem["stale"] = True
+                        self.staleThemeItems.append(item["url"])
+                        metrics.status = "stale"
+                    if "fingerprint" in deferred and not "error" in resultItem and not deferred.get("thumbnailFailed") and not deferred.get("legendsFailed") and not deferred.get("stale"):
+                        currentItems[deferred["fingerprint"]] = {
+                            "item": json.loads(json.dumps(resultItem)),
+                            "deferred": {key: deferred[key] for key in ["autogenExternalLayers", "default"] if key in deferred}
+                        }
+                    self.finalizeTheme(result, resultItem, deferred)
+                    if self.spool and "id" in resultItem:
+                        if self.thumbnailVariantFormats:
+                            self.addThumbnailVariants(resultItem, self.thumbnailVariantsCache)
+                        resultGroup["items"].append(self.spool.add(resultItem))
+                    elif resultItem:
+                        resultGroup["items"].append(resultItem)
+                    if metricsReport is not None:
+                        if item.get("disabled", False):
+                            metrics.status = "disabled"
+                        elif "error" in resultItem:
+                            metrics.status = "error"
+                        metricsReport.append({
+                            "url": item.get("url"),
+                            "title": item.get("title"),
+                            "id": resultItem.get("id"),
+                            "status": metrics.status,
+                            "time": metrics.time,
+                            "phases": metrics.phases,
+                            "bytesDownloaded": metrics.bytesDownloaded,
+                            "peakMemoryDelta": metrics.peakMemoryDelta
+                        })
+        return currentItems
+
+    # theme items of a previously written output file in config order, for publishing them while their GetProjectSettings fails
+    # failed items are included, hence the list matches the published (i.e. not disabled) items of themesConfig
+    def loadPreviousThemes(self, filename):
+        try:
+            with open(filename, encoding='utf-8') as fh:
+                # the previous output may be in the compact schema, its items reference its own shared table
+                themes = expandCompactThemes(json.load(fh))
+        except:
+            return []
+
+        previousThemes = []
+        def collectItems(group):
+            for item in group.get("items", []):
+                previousThemes.append(item)
+            for subdir in group.get("subdirs", []):
+                collectItems(subdir)
+        collectItems(themes.get("themes", {}))
+        return previousThemes
+
+    # state of incremental runs is stored in the cache dir and discarded whenever this script changes
+    def getIncrementalStateFilename(self):
+        return os.path.join(self.cacheDir, self.stateName + ".json")
+
+    def loadIncrementalState(self):
+        try:
+            with open(self.getIncrementalStateFilename(), encoding='utf-8') as fh:
+                state = json.load(fh)
+            if state.get("generator") == getGeneratorFingerprint():
+                return state["items"]
+        except:
+            pass
+        return {}
+
+    def saveIncrementalState(self, items):
+        os.makedirs(self.cacheDir, exist_ok=True)
+        state = {"generator": getGeneratorFingerprint(), "items": items}
+        writeFileAtomic(self.getIncrementalStateFilename(), json.dumps(state).encode('utf-8'))
+
+    # write the theme item metrics as JSON report and/or Prometheus textfile collector file
+    def writeMetrics(self, items, startTime, duration):
+        if self.metricsFile:
+            report = {
+                "timestamp": startTime,
+                "time": duration,
+                "items": items
+            }
+            writeFileAtomic(self.metricsFile, json.dumps(report, indent=2).encode('utf-8'))
+        if self.prometheusFile:
+            writeFileAtomic(self.prometheusFile, formatPrometheusMetrics(items, startTime, duration).encode('utf-8'))
+
+    # generate the themes from themesConfig, with staleFallback failed theme items are replaced by their entries in outputFile
+    def generate(self):
+        with self.generateLock:
+            return self.generateThemes()
+
+    # WMTS background layers declared as {"wmts": {"capabilitiesUrl": ..., "layer": ..., "crs": ..., "style": ...}, ...}
+    # are resolved to the full entry produced by wmts_config_generator.py, with the other keys of the declaration
+    # taking precedence. Declarations of the same service share one capabilities request. Returns the futures of
+    # the services, see applyWmtsBackgroundLayers.
+    def submitWmtsBackgroundLayers(self, result, executor):
+        declarations = {}
+        for entry in result["themes"]["backgroundLayers"]:
+            if "wmts" in entry:
+                declarations.setdefault(entry["wmts"].get("capabilitiesUrl"), []).append(entry)
+        if declarations and not WMTSCapabilities:
+            print("WARNING: wmts_config_generator module not available, not resolving WMTS background layers")
+            return {}
+        return {url: executor.submit(self.resolveWmtsBackgroundLayers, url, entries) for url, entries in declarations.items()}
+
+    # resolve the declarations of a WMTS service, returns the configuration or the exception of each declaration
+    # resolved configurations and errors are cached in the cache dir by capabilities content and layer, crs and style
+    def resolveWmtsBackgroundLayers(self, url, entries):
+        try:
+            try:
+                reply = self.cachedUrlRead(entries[0], url)
+            except Exception as e:
+                reply = self.readStaleReply(entries[0], url) if self.staleFallback else None
+                if reply is None:
+                    raise
+                print("WARNING: reading WMTS capabilities " + url + " failed (" + str(e) + "), using last cached reply")
+        except Exception as e:
+            return [Exception("Failed to read WMTS capabilities " + str(url) + ": " + str(e))] * len(entries)
+
+        digest = hashlib.sha256(reply).hexdigest()
+        with self.cacheLock:
+            capabilities = self.wmtsCapabilitiesCache.get(url)
+        if capabilities and capabilities[0] != digest:
+            capabilities = None
+        results = []
+        for entry in entries:
+            declaration = entry["wmts"]
+            cacheFile = None
+            if self.cacheDir:
+                key = hashlib.sha256(json.dumps([digest, declaration.get("layer"), declaration.get("crs"), declaration.get("style", "")]).encode('utf-8')).hexdigest()
+                cacheFile = os.path.join(self.cacheDir, "wmts-" + key + ".json")
+                try:
+                    with open(cacheFile, encoding='utf-8') as fh:
+                        cached = json.load(fh)
+                    results.append(Exception(cached["error"]) if "error" in cached else cached["layer"])
+                    continue
+                except:
+                    pass
+            try:
+                if not capabilities:
+                    capabilities = (digest, WMTSCapabilities(url, reply))
+                    with self.cacheLock:
+                        self.wmtsCapabilitiesCache[url] = capabilities
+                cached = {"layer": capabilities[1].getLayerConfig(declaration.get("layer"), declaration.get("crs"), declaration.get("style", ""))}
+            except Exception as e:
+                cached = {"error": str(e)}
+            if cacheFile:
+                os.makedirs(self.cacheDir, exist_ok=True)
+                writeFileAtomic(cacheFile, json.dumps(cached).encode('utf-8'))
+            results.append(Exception(cached["error"]) if "error" in cached else cached["layer"])
+        return results
+
+    # replace the WMTS background layer declarations with their resolved configurations, failed ones are dropped
+    def applyWmtsBackgroundLayers(self, result, futures):
+        resolved = {url: iter(future.result()) for url, future in futures.items()}
+        backgroundLayers = []
+        for entry in result["themes"]["backgroundLayers"]:
+            if "wmts" in entry and entry["wmts"].get("capabilitiesUrl") in resolved:
+                layerConfig = next(resolved[entry["wmts"].get("capabilitiesUrl")])
+                if isinstance(layerConfig, Exception):
+                    print("ERROR resolving WMTS background layer " + str(entry.get("name")) + ":\n" + str(layerConfig))
+                    continue
+                entry = dict(layerConfig, **{key: value for key, value in entry.items() if key != "wmts"})
+            backgroundLayers.append(entry)
+        result["themes"]["backgroundLayers"] = backgroundLayers
+
+    # load themesConfig.json, returns the config, the result skeleton and the theme items to process,
+    # or None if the config cannot be read
+    def loadThemesConfig(self):
+        try:
+            with open(self.themesConfig, encoding='utf-8') as fh:
+                config = json.load(fh)
+        except:
+            return None
+        result = {
+            "themes": {
+                "title": "root",
+                "subdirs": [],
+                "items": [],
+                "defaultTheme": config["defaultTheme"] if "defaultTheme" in config else None,
+                "defaultMapCrs": config["defaultMapCrs"] if "defaultMapCrs" in config else "EPSG:3857",
+                "defaultScales": config["defaultScales"],
+                "defaultPrintScales": config["defaultPrintScales"] if "defaultPrintScales" in config else None,
+                "defaultPrintResolutions": config["defaultPrintResolutions"] if "defaultPrintResolutions" in config else None,
+                "defaultPrintGrid": config["defaultPrintGrid"] if "defaultPrintGrid" in config else None,
+                "defaultSearchProviders": config["defaultSearchProviders"] if "defaultSearchProviders" in config else None,
+                "defaultBackgroundLayers": config["defaultBackgroundLayers"] if "defaultBackgroundLayers" in config else [],
+                "defaultMapTips": config["defaultMapTips"] if "defaultMapTips" in config else None,
+                "defaultLabelProfiles": config["defaultLabelProfiles"] if "defaultLabelProfiles" in config else None,
+                "pluginData": config["themes"]["pluginData"] if "pluginData" in config["themes"] else [],
+                "themeInfoLinks": config["themes"]["themeInfoLinks"] if "themeInfoLinks" in config["themes"] else [],
+                "externalLayers": config["themes"]["externalLayers"] if "externalLayers" in config["themes"] else [],
+                "backgroundLayers": list(map(reformatAttribution, config["themes"]["backgroundLayers"])),
+                "defaultWMSVersion": config["defaultWMSVersion"] if "defaultWMSVersion" in config else None,
+                "defaultDisplayCrs": config["defaultDisplayCrs"] if "defaultDisplayCrs" in config else None
+                }
+        }
+        groupCounter = 0
+        tasks = []
+        getGroupThemes(config, config["themes"], result, result["themes"], groupCounter, tasks)
+        return config, result, tasks
+
+    def generateThemes(self, loadedConfig=None, executor=None, sharedRequests=None):
+        self.usedThemeIds = []
+        self.autogenExternalLayers = []
+        self.staleThemeItems = []
+        self.thumbnailVariantsCache = {}
+        if self.spool:
+            self.spool.close()
+        self.spool = ThemeSpool() if self.spoolOutput else None
+
+        loadedConfig = loadedConfig or self.loadThemesConfig()
+        if not loadedConfig:
+            return {"error": "Failed to read themesConfig.json"}
+        config, result, tasks = loadedConfig
+        incremental = self.incremental
+        if incremental and not self.cacheDir:
+            print("WARNING: incremental mode requires a cache dir, doing a full rebuild")
+            incremental = False
+        previousItems = self.loadIncrementalState() if incremental else None
+        metricsReport = [] if self.metricsFile or self.prometheusFile else None
+        startTime = time.time()
+        # WMTS background layers are resolved while the theme items are processed
+        with ThreadPoolExecutor(max_workers=max(1, self.themesJobs)) as wmtsExecutor:
+            wmtsFutures = self.submitWmtsBackgroundLayers(result, wmtsExecutor)
+            currentItems = self.processThemes(config, result, tasks, previousItems, metricsReport, executor, sharedRequests)
+            self.applyWmtsBackgroundLayers(result, wmtsFutures)
+        if self.staleThemeItems:
+            print("WARNING: %d theme items are stale: %s" % (len(self.staleThemeItems), ", ".join(self.staleThemeItems)))
+        if incremental:
+            self.saveIncrementalState(currentItems)
+        if metricsReport is not None:
+            self.writeMetrics(metricsReport, startTime, time.time() - startTime)
+
+        for entry in self.autogenExternalLayers:
+            cpos = entry.find(":")
+            hpos = entry.rfind('#')
+            type = entry[0:cpos]
+            url = entry[cpos+1:hpos]
+            layername = entry[hpos+1:]
+            result["themes"]["externalLayers"].append({
+                "name": entry,
+                "type": type,
+                "url": url,
+                "params": {"LAYERS": layername},
+                "infoFormats": ["text/plain"]
+            })
+
+        if "backgroundLayers" in result["themes"]:
+            # get thumbnails for background layers
+            for backgroundLayer in result["themes"]["backgroundLayers"]:
+                imgPath = "img/mapthumbs/" + backgroundLayer.get("thumbnail", "default.jpg")
+                if not os.path.isfile(self.qwc2_path + "/static/assets/" + imgPath):
+                    imgPath = "img/mapthumbs/default.jpg"
+                backgroundLayer["thumbnail"] = imgPath
+
+        if self.thumbnailVariantFormats:
+            self.genThumbnailVariants(result, self.thumbnailVariantsCache)
+
+        return result
+
+    # generate the themes of several tenants (see tenant) at once. The theme items of all tenants are processed
+    # by one pool of themesJobs workers, GetProjectSettings documents used by several tenants are fetched and
+    # parsed once. Returns the themes of each tenant, in order.
+    def generateBatch(self, tenants):
+        with self.generateLock:
+            loadedConfigs = [tenant.loadThemesConfig() for tenant in tenants]
+            requestKeys = []
+            for tenant, loadedConfig in zip(tenants, loadedConfigs):
+                if loadedConfig:
+                    requestKeys += tenant.getTasksRequestKeys(loadedConfig[2])
+            sharedRequests = SharedRequests(requestKeys)
+
+            # the process pool and memory tracing are set up once for all tenants
+            traceMemory = self.metricsMemory and any(tenant.metricsFile or tenant.prometheusFile for tenant in tenants)
+            processPool = self.getProcessPool(traceMemory)
+            for tenant in tenants:
+                tenant.processPool = processPool
+
+            def generateTenant(tenant, loadedConfig):
+                with tenant.generateLock:
+                    return tenant.generateThemes(loadedConfig, executor, sharedRequests)
+
+            with memoryTracker.tracing(traceMemory), ThreadPoolExecutor(max_workers=max(1, self.themesJobs)) as executor:
+                # tenant threads only submit their theme items to executor and wait for them
+                with ThreadPoolExecutor(max_workers=max(1, len(tenants))) as tenantExecutor:
+                    futures = [tenantExecutor.submit(generateTenant, tenant, loadedConfig) for tenant, loadedConfig in zip(tenants, loadedConfigs)]
+                    return [future.result() for future in futures]
+
+    # write an output file atomically if its content changed, along with precompressed siblings
+    # (.gz, .br) for the configured precompressFormats. Returns whether the content changed.
+    def writeOutputFile(self, filename, data):
+        changed = True
+        if os.path.exists(filename):
+            with open(filename, "rb") as fh:
+                changed = fh.read() != data
+        if changed:
+            writeFileAtomic(filename, data)
+        compressors = {
+            "gz": lambda data: gzip.compress(data, compresslevel=9, mtime=0),
+            "br": lambda data: brotli.compress(data)
+        }
+        for ext, compress in compressors.items():
+            sibling = filename + "." + ext
+            if ext in self.precompressFormats:
+                if changed or not os.path.exists(sibling):
+                    writeFileAtomic(sibling, compress(data))
+            elif os.path.exists(sibling):
+                os.remove(sibling)
+        return changed
+
+    # like writeOutputFile, for content produced in chunks which is never held in memory as a whole
+    def writeOutputStream(self, filename, chunks):
+        fd, tmpname = createTempFile(filename)
+        try:
+            with os.fdopen(fd, "wb") as fh:
+                for chunk in chunks:
+                    fh.write(chunk)
+            changed = not os.path.exists(filename) or not filecmp.cmp(tmpname, filename, shallow=False)
+            if changed:
+                os.replace(tmpname, filename)
+            else:
+                os.unlink(tmpname)
+        except:
+            if os.path.exists(tmpname):
+                os.unlink(tmpname)
+            raise
+        for ext in ["gz", "br"]:
+            sibling = filename + "." + ext
+            if ext in self.precompressFormats:
+                if changed or not os.path.exists(sibling):
+                    writeFileAtomic(sibling, compressFileChunks(filename, ext))
+            elif os.path.exists(sibling):
+                os.remove(sibling)
+        return changed
+
+    # write themes.json, and with shardedOutput additionally an index.json and one file per theme item in
+    # a directory named after themes.json. Returns whether anything changed.
+    # Spooled theme items (see spoolOutput) are streamed from the spool, one at a time.
+    def writeThemesOutput(self, themes, filename=None):
+        filename = filename or self.outputFile
+        changed = False
+        if self.shardedOutput:
+            changed |= self.writeThemeShards(themes, os.path.splitext(filename)[0])
+        if self.compactOutput:
+            changed |= self.writeOutputFile(filename, json.dumps(compactThemes(themes), separators=(',', ':'), sort_keys=True).encode('utf-8'))
+        elif self.spoolOutput:
+            changed |= self.writeOutputStream(filename, iterThemesJson(themes))
+        else:
+            changed |= self.writeOutputFile(filename, json.dumps(themes, indent=2, separators=(',', ': '), sort_keys=True).encode('utf-8'))
+        return changed
+
+    # write the index.json and theme files of the sharded output to shardDir
+    def writeThemeShards(self, themes, shardDir):
+        os.makedirs(shardDir, exist_ok=True)
+        indexFile = os.path.join(shardDir, "index.json")
+        # theme files of the previous run, only these are removed if no longer needed
+        previousFiles = set()
+        def collectThemeFiles(group):
+            for item in group.get("items", []):
+                if isinstance(item.get("themeFile"), str) and os.path.basename(item["themeFile"]) == item["themeFile"]:
+                    previousFiles.add(item["themeFile"])
+            for subdir in group.get("subdirs", []):
+                collectThemeFiles(subdir)
+        try:
+            with open(indexFile, encoding='utf-8') as fh:
+                collectThemeFiles(json.load(fh).get("themes", {}))
+        except (OSError, ValueError, AttributeError):
+            pass
+
+        index, shards = shardThemes(themes)
+        changed = False
+        # write theme files before the index referencing them
+        for fileName, item in shards.items():
+            if isinstance(item, SpooledItem):
+                item = item.load()
+            changed |= self.writeOutputFile(os.path.join(shardDir, fileName), json.dumps(item, separators=(',', ':'), sort_keys=True).encode('utf-8'))
+        changed |= self.writeOutputFile(indexFile, json.dumps(index, separators=(',', ':'), sort_keys=True).encode('utf-8'))
+
+        # remove theme files of the previous run which are no longer referenced
+        for fileName in previousFiles - set(shards):
+            for path in [fileName, fileName + ".gz", fileName + ".br"]:
+                if os.path.exists(os.path.join(shardDir, path)):
+                    os.remove(os.path.join(shardDir, path))
+                    changed = True
+        return changed
+
+    # modification state of the themes config, the edit configs it references and the thumbnails
+    def getWatchedFilesState(self):
+        filenames = [self.themesConfig]
+        try:
+            with open(self.themesConfig, encoding='utf-8') as fh:
+                config = json.load(fh)
+            for editConfig in getConfigEditConfigs(config.get("themes", {})):
+                filenames.append(editConfig if os.path.isabs(editConfig) else os.path.join(os.path.dirname(self.themesConfig) or ".", editConfig))
+        except:
+            pass
+        thumbnailDir = self.qwc2_path + "/static/assets/img/mapthumbs"
+        if os.path.isdir(thumbnailDir):
+            filenames += [os.path.join(thumbnailDir, entry) for entry in sorted(os.listdir(thumbnailDir))]
+        state = {}
+        for filename in filenames:
+            try:
+                stat = os.stat(filename)
+                state[filename] = (stat.st_mtime_ns, stat.st_size)
+            except OSError:
+                state[filename] = None
+        return state
+
+    # keep themes.json up to date, regenerating it whenever a watched file changes and every pollInterval seconds
+    # to pick up GetProjectSettings changes, or every staleRetryInterval seconds while theme items are stale.
+    # Unchanged theme items are reused if a cache dir is configured.
+    def watch(self):
+        filesState = None
+        lastPoll = 0
+        while True:
+            currentFilesState = self.getWatchedFilesState()
+            interval = self.staleRetryInterval if self.staleThemeItems else self.pollInterval
+            if currentFilesState != filesState or time.time() - lastPoll >= interval:
+                filesState = currentFilesState
+                lastPoll = time.time()
+                try:
+                    print("Reading " + self.themesConfig)
+                    themes = self.generate()
+                    if "error" in themes:
+                        print("ERROR generating themes: " + themes["error"] + ", keeping previous " + self.outputFile)
+                    elif self.writeThemesOutput(themes, self.outputFile):
+                        print("Updated " + self.outputFile)
+                    else:
+                        print(self.outputFile + " is up to date")
+                except Exception as e:
+                    print("ERROR generating themes:\n" + str(e))
+                    traceback.print_exc()
+            time.sleep(self.watchInterval)
+
+
+# generate the themes of a themes config, without writing them, see ThemesGenerator for the settings
+def genThemes(themesConfig, **settings):
+    # the themes are returned as plain dicts, hence not spooled
+    generator = ThemesGenerator(**dict(settings, themesConfig=themesConfig, spoolOutput=False))
+    try:
+        return generator.generateThemes()
+    finally:
+        generator.close()
 
 
 if __name__ == '__main__':
-    print("Reading " + themesConfig)
-    themes = genThemes(themesConfig)
-    # write config file
-    with open("./static/themes.json", "w") as fh:
-        json.dump(themes, fh, indent=2, separators=(',', ': '), sort_keys=True)
+    defaultSettings = getDefaultSettings()
+    parser = argparse.ArgumentParser(description="Generate themes.json from themesConfig.json")
+    parser.add_argument("-j", "--jobs", type=int, default=defaultSettings["themesJobs"], help="Number of theme items to process in parallel (default: QWC2_THEMES_JOBS or 1)")
+    parser.add_argument("--cache-dir", default=defaultSettings["cacheDir"], help="Directory for caching GetProjectSettings replies (default: QWC2_THEMES_CACHE_DIR, disabled if empty)")
+    parser.add_argument("--cache-max-age", type=float, default=defaultSettings["cacheMaxAge"], help="Seconds during which cached replies are used without revalidation (default: QWC2_THEMES_CACHE_MAX_AGE or 0)")
+    parser.add_argument("--incremental", action="store_true", default=defaultSettings["incremental"], help="Only reprocess theme items whose inputs changed since the last run, requires a cache dir (default: QWC2_THEMES_INCREMENTAL=1)")
+    parser.add_argument("--xml-parser", choices=["etree", "minidom"], default=defaultSettings["xmlParser"], help="Capabilities parser, minidom builds the full DOM, etree builds a reduced tree without legend URLs and nested layer CRS/bounding boxes, using less memory for large documents (default: QWC2_THEMES_XML_PARSER or minidom)")
+    parser.add_argument("--processes", type=int, default=defaultSettings["themesProcesses"], help="Number of processes for parsing large GetProjectSettings documents, 0 to parse in the worker threads (default: QWC2_THEMES_PROCESSES or 0)")
+    parser.add_argument("--process-min-size", type=int, default=defaultSettings["processMinSize"], help="Minimum document size in bytes for parsing in a separate process (default: QWC2_THEMES_PROCESS_MIN_SIZE or 1000000)")
+    parser.add_argument("--connect-timeout", type=float, default=defaultSettings["connectTimeout"], help="HTTP connect timeout in seconds (default: QWC2_THEMES_CONNECT_TIMEOUT or 10)")
+    parser.add_argument("--read-timeout", type=float, default=defaultSettings["readTimeout"], help="HTTP read timeout in seconds (default: QWC2_THEMES_READ_TIMEOUT or 120)")
+    parser.add_argument("--retries", type=int, default=defaultSettings["httpRetries"], help="Number of retries of HTTP requests failing with 5xx or connection errors (default: QWC2_THEMES_RETRIES or 2)")
+    parser.add_argument("--batch", help="JSON file with a list of tenants to generate at once, sharing the GetProjectSettings requests and parsed documents, each an object with themesConfig and outputFile and optionally qwc2_path, shardedOutput, metricsFile and prometheusFile")
+    parser.add_argument("--watch", action="store_true", help="Keep running and regenerate themes.json whenever the themes config, its edit configs or the thumbnails change, implies --incremental and requires --cache-dir")
+    parser.add_argument("--watch-interval", type=float, default=defaultSettings["watchInterval"], help="Seconds between checks for changed files in watch mode (default: QWC2_THEMES_WATCH_INTERVAL or 2)")
+    parser.add_argument("--poll-interval", type=float, default=defaultSettings["pollInterval"], help="Seconds between GetProjectSettings revalidations in watch mode (default: QWC2_THEMES_POLL_INTERVAL or 300)")
+    parser.add_argument("--sharded", action="store_true", default=defaultSettings["shardedOutput"], help="Additionally to static/themes.json, write static/themes/index.json with the group tree and defaults, and one compact file per theme (default: QWC2_THEMES_SHARDED=1)")
+    parser.add_argument("--metrics", default=defaultSettings["metricsFile"], help="Write a JSON report with the time spent per phase and the bytes downloaded of each theme item to this file (default: QWC2_THEMES_METRICS)")
+    parser.add_argument("--metrics-prom", default=defaultSettings["prometheusFile"], help="Write the theme item metrics to this Prometheus textfile collector file (default: QWC2_THEMES_METRICS_PROM)")
+    parser.add_argument("--metrics-memory", action="store_true", default=defaultSettings["metricsMemory"], help="Also record the peak traced memory increase of each theme item, slows down parsing (default: QWC2_THEMES_METRICS_MEMORY=1)")
+    parser.add_argument("--thumbnail-max-age", type=float, default=defaultSettings["thumbnailMaxAge"], help="Seconds during which generated thumbnails are reused instead of rendered again, 0 to always render (default: QWC2_THEMES_THUMBNAIL_MAX_AGE or 86400)")
+    parser.add_argument("--thumbnail-variants", default=",".join(defaultSettings["thumbnailVariantFormats"]), help="Comma separated list of optimized thumbnail variants to generate at 1x and 2x, png (palette quantized) and/or webp, requires Pillow (default: QWC2_THEMES_THUMBNAIL_VARIANTS)")
+    parser.add_argument("--legend-sprites", action="store_true", default=defaultSettings["legendSprites"], help="Pack the legend graphics of all leaf layers and styles of each theme into a sprite sheet referenced by legendSprite, requires Pillow (default: QWC2_THEMES_LEGEND_SPRITES=1)")
+    parser.add_argument("--legend-jobs", type=int, default=defaultSettings["legendJobs"], help="Number of concurrent legend graphic requests per theme (default: QWC2_THEMES_LEGEND_JOBS or 4)")
+    parser.add_argument("--stale-fallback", action=argparse.BooleanOptionalAction, default=defaultSettings["staleFallback"], help="Publish the last cached GetProjectSettings reply or the previous output entry of a theme item, marked as stale, if its GetProjectSettings request fails (default: QWC2_THEMES_STALE_FALLBACK or 0)")
+    parser.add_argument("--stale-retry-interval", type=float, default=defaultSettings["staleRetryInterval"], help="Seconds between regenerations in watch mode while theme items are stale (default: QWC2_THEMES_STALE_RETRY_INTERVAL or 30)")
+    parser.add_argument("--spool", action="store_true", default=defaultSettings["spoolOutput"], help="Move finished theme items to a temporary spool file and stream the output from it, keeps the memory usage flat for many themes (default: QWC2_THEMES_SPOOL=1)")
+    parser.add_argument("--compact", action="store_true", default=defaultSettings["compactOutput"], help="Write themes.json in the compact schema, with default values omitted and repeated sub-objects in a shared table, expanded by the viewer on load (default: QWC2_THEMES_COMPACT=1)")
+    parser.add_argument("--precompress", default=",".join(defaultSettings["precompressFormats"]), help="Comma separated list of precompressed siblings to write next to the output files, gz and/or br (default: QWC2_THEMES_PRECOMPRESS)")
+    args = parser.parse_args()
+    if args.batch and args.watch:
+        parser.error("--batch cannot be combined with --watch")
+    if args.watch and not args.cache_dir:
+        parser.error("--watch requires --cache-dir (or QWC2_THEMES_CACHE_DIR), the regenerations are incremental")
+
+    settings = {
+        "themesJobs": args.jobs,
+        "cacheDir": args.cache_dir,
+        "cacheMaxAge": args.cache_max_age,
+        "incremental": args.incremental or args.watch,
+        "xmlParser": args.xml_parser,
+        "themesProcesses": args.processes,
+        "processMinSize": args.process_min_size,
+        # parsed documents are only reused by the regenerations in watch mode
+        "documentCacheSize": defaultSettings["documentCacheSize"] if args.watch else 0,
+        "connectTimeout": args.connect_timeout,
+        "readTimeout": args.read_timeout,
+        "httpRetries": args.retries,
+        "watchInterval": args.watch_interval,
+        "pollInterval": args.poll_interval,
+        "shardedOutput": args.sharded,
+        "precompressFormats": [fmt for fmt in args.precompress.split(",") if fmt],
+        "metricsFile": args.metrics,
+        "prometheusFile": args.metrics_prom,
+        "metricsMemory": args.metrics_memory,
+        "thumbnailMaxAge": args.thumbnail_max_age,
+        "thumbnailVariantFormats": [fmt for fmt in args.thumbnail_variants.split(",") if fmt],
+        "legendSprites": args.legend_sprites,
+        "legendJobs": args.legend_jobs,
+        "staleFallback": args.stale_fallback,
+        "staleRetryInterval": args.stale_retry_interval,
+        "spoolOutput": args.spool,
+        "compactOutput": args.compact
+    }
+    generator = ThemesGenerator(**settings)
+    try:
+        if args.batch:
+            with open(args.batch, encoding='utf-8') as fh:
+                tenants = [generator.tenant(**entry) for entry in json.load(fh)]
+            print("Reading %d themes configs" % len(tenants))
+            failed = []
+            for tenant, themes in zip(tenants, generator.generateBatch(tenants)):
+                if "error" in themes:
+                    print("ERROR generating themes of " + tenant.themesConfig + ": " + themes["error"] + ", keeping previous " + tenant.outputFile)
+                    failed.append(tenant.themesConfig)
+                elif tenant.writeThemesOutput(themes):
+                    print("Updated " + tenant.outputFile)
+                else:
+                    print(tenant.outputFile + " is up to date")
+            if failed:
+                print("ERROR: %d of %d themes configs failed: %s" % (len(failed), len(tenants), ", ".join(failed)))
+                sys.exit(1)
+        elif args.watch:
+            try:
+                generator.watch()
+            except KeyboardInterrupt:
+                pass
+        else:
+            print("Reading " + generator.themesConfig)
+            themes = generator.generate()
+            # write config file
+            generator.writeThemesOutput(themes)
+    finally:
+        generator.close()
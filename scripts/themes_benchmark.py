@@ -0,0 +1,382 @@
+#!/usr/bin/python3
+
+# Benchmark for themesConfig.py against a synthetic local QGIS Server stand-in
+#
+# Usage:
+#   themes_benchmark.py generate [options] > GetProjectSettings.xml
+#       Write a synthetic GetProjectSettings document
+#   themes_benchmark.py serve [--port 8090] [--latency 0.05] [--gzip]
+#       Serve synthetic GetProjectSettings documents and PNG GetMap replies. The document
+#       parameters are encoded in the path, i.e. /ows/layers=1000,depth=3,styles=2/<name>
+#   themes_benchmark.py run [--layers 100,1000,5000] [--projects 20] [--latency 0.05] [-- <themesConfig.py args>]
+#       Run themesConfig.py for each scale and report wall time, peak RSS and the
+#       time spent per phase for a single document. With --item-metrics, also report
+#       the phase times of all theme items from the themesConfig.py metrics report
+#
+# Example: themes_benchmark.py run --layers 100,2000 --projects 50 --latency 0.1 -- --jobs 8
+
+import argparse
+import contextlib
+import gzip
+import hashlib
+import http.server
+import importlib.util
+import io
+import json
+import os
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from urllib.parse import urlparse, parse_qsl
+
+
+scriptDir = os.path.dirname(os.path.abspath(__file__))
+
+defaultParams = {
+    "layers": 100,
+    "depth": 2,
+    "fanout": 4,
+    "styles": 2,
+    "crs": 20,
+    "templates": 4,
+    "atlas": 1,
+    "dimensions": 5
+}
+
+
+def generateProjectSettings(name, params, serviceUrl=None):
+    params = dict(defaultParams, **params)
+    serviceUrl = serviceUrl or "http://localhost/ows/" + name
+    crsList = ["EPSG:2056", "EPSG:4326", "EPSG:3857"] + ["EPSG:%d" % (32600 + i) for i in range(max(0, params["crs"] - 3))]
+    crsList = crsList[:max(1, params["crs"])]
+    bboxes = "".join('<BoundingBox CRS="%s" minx="2600000" miny="1200000" maxx="2610000" maxy="1210000"/>' % crs for crs in crsList)
+    crsElements = "".join("<CRS>%s</CRS>" % crs for crs in crsList)
+    geoBBox = ("<EX_GeographicBoundingBox><westBoundLongitude>7.1</westBoundLongitude><eastBoundLongitude>7.9</eastBoundLongitude>"
+               "<southBoundLatitude>46.1</southBoundLatitude><northBoundLatitude>46.9</northBoundLatitude></EX_GeographicBoundingBox>")
+    parts = []
+    counter = {"leaves": 0, "groups": 0}
+
+    def leaf():
+        index = counter["leaves"]
+        counter["leaves"] += 1
+        layerName = "%s_layer%d" % (name, index)
+        styles = "".join(
+            '<Style><Name>%s</Name><Title>Style %d</Title><LegendURL width="16" height="16"><Format>image/png</Format>'
+            '<OnlineResource xlink:type="simple" xlink:href="%s?SERVICE=WMS&amp;REQUEST=GetLegendGraphic&amp;LAYER=%s"/></LegendURL></Style>'
+            % ("default" if i == 0 else "style%d" % i, i, serviceUrl, layerName) for i in range(params["styles"]))
+        dimension = ""
+        if index < params["dimensions"]:
+            dimension = '<Dimension name="time" units="ISO8601" multipleValues="0" fieldName="date" endFieldName="">2020-01-01/2024-12-31</Dimension>'
+        parts.append(
+            '<Layer queryable="1" displayField="name" geometryType="Polygon" visible="%d" opacity="1" expanded="1">'
+            '<Name>%s</Name><Title>Layer %d</Title><Abstract>Abstract of layer %d</Abstract>'
+            '<KeywordList><Keyword>keyword</Keyword></KeywordList>%s%s%s'
+            '<Attribution><Title>Attribution</Title><OnlineResource xlink:type="simple" xlink:href="https://example.com"/></Attribution>'
+            '<MetadataURL type="FGDC"><Format>text/xml</Format><OnlineResource xlink:type="simple" xlink:href="https://example.com/metadata/%d"/></MetadataURL>'
+            '%s<MinScaleDenominator>100</MinScaleDenominator><MaxScaleDenominator>1000000</MaxScaleDenominator>'
+            '<TreeName>Layer %d</TreeName><PrimaryKey><PrimaryKeyAttribute>fid</PrimaryKeyAttribute></PrimaryKey>%s</Layer>'
+            % (index % 2, layerName, index, index, crsElements, geoBBox, bboxes, index, styles, index, dimension))
+
+    def group(level, count):
+        if level >= params["depth"]:
+            for i in range(count):
+                leaf()
+            return
+        fanout = max(1, params["fanout"])
+        for i in range(fanout):
+            childCount = count // fanout + (1 if i < count % fanout else 0)
+            if childCount == 0:
+                continue
+            counter["groups"] += 1
+            groupName = "%s_group%d" % (name, counter["groups"])
+            parts.append('<Layer queryable="1" visible="1" expanded="1" mutuallyExclusive="0"><Name>%s</Name><Title>Group %d</Title>%s%s%s<TreeName>Group %d</TreeName>'
+                         % (groupName, counter["groups"], crsElements, geoBBox, bboxes, counter["groups"]))
+            group(level + 1, childCount)
+            parts.append('</Layer>')
+
+    group(0, params["layers"])
+    layerTree = "".join(parts)
+
+    templates = []
+    for i in range(params["templates"]):
+        atlas = ' atlasEnabled="1" atlasCoverageLayer="%s_layer%d"' % (name, i % max(1, params["layers"])) if i < params["atlas"] else ""
+        templates.append(
+            '<ComposerTemplate name="Layout %d" width="297" height="210"%s><ComposerMap name="map0" width="277" height="180"/>'
+            '<ComposerLabel name="title"/><ComposerLabel name="subtitle"/></ComposerTemplate>' % (i, atlas))
+
+    def request(tag, formats):
+        return ('<%s>%s<DCPType><HTTP><Get><OnlineResource xlink:type="simple" xlink:href="%s?"/></Get></HTTP></DCPType></%s>'
+                % (tag, "".join("<Format>%s</Format>" % fmt for fmt in formats), serviceUrl, tag))
+
+    return ('<?xml version="1.0" encoding="utf-8"?>\n'
+            '<WMS_Capabilities xmlns="http://www.opengis.net/wms" xmlns:sld="http://www.opengis.net/sld" xmlns:xlink="http://www.w3.org/1999/xlink" '
+            'xmlns:qgs="http://www.qgis.org/wms" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" version="1.3.0">'
+            '<Service><Name>WMS</Name><Title>Project %s</Title><Abstract>Synthetic project</Abstract>'
+            '<KeywordList><Keyword vocabulary="ISO">infoMapAccessService</Keyword><Keyword>benchmark</Keyword></KeywordList>'
+            '<OnlineResource xlink:type="simple" xlink:href="%s"/>'
+            '<ContactInformation><ContactPersonPrimary><ContactPerson>Person</ContactPerson><ContactOrganization>Organization</ContactOrganization></ContactPersonPrimary>'
+            '<ContactPosition>Position</ContactPosition><ContactVoiceTelephone>000</ContactVoiceTelephone><ContactElectronicMailAddress>info@example.com</ContactElectronicMailAddress></ContactInformation>'
+            '</Service><Capability><Request>%s%s%s%s%s</Request>'
+            '<Exception><Format>XML</Format></Exception>'
+            '<ComposerTemplates xsi:type="wms:_ExtendedCapabilities">%s</ComposerTemplates>'
+            '<Layer queryable="1"><Name>%s</Name><Title>Project %s</Title>%s%s%s<TreeName>%s</TreeName>%s</Layer>'
+            '<LayerDrawingOrder>%s</LayerDrawingOrder>'
+            '</Capability></WMS_Capabilities>' % (
+                name, serviceUrl,
+                request("GetCapabilities", ["text/xml"]),
+                request("GetMap", ["image/png", "image/jpeg"]),
+                request("GetFeatureInfo", ["text/html", "text/plain", "text/xml"]),
+                request("sld:GetLegendGraphic", ["image/png"]),
+                request("GetPrint", ["pdf", "png"]),
+                "".join(templates),
+                name, name, crsElements, geoBBox, bboxes, name, layerTree,
+                ",".join("Layer %d" % i for i in range(params["layers"]))
+            )).encode('utf-8')
+
+
+def parseParams(spec):
+    params = {}
+    for entry in filter(bool, spec.split(",")):
+        key, value = entry.split("=")
+        if key not in defaultParams:
+            raise KeyError("Unknown document parameter %s" % key)
+        params[key] = int(value)
+    return params
+
+
+def generatePng(width, height):
+    def chunk(chunkType, data):
+        return struct.pack(">I", len(data)) + chunkType + data + struct.pack(">I", zlib.crc32(chunkType + data) & 0xffffffff)
+    raw = b"".join(b"\x00" + b"\x40\x80\xc0" * width for row in range(height))
+    return (b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)) +
+            chunk(b"IDAT", zlib.compress(raw)) + chunk(b"IEND", b""))
+
+
+# QGIS Server stand-in, serving GetProjectSettings with ETag/Last-Modified validators and PNG images
+class StandInServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port, latency=0, compress=False):
+        super().__init__(("127.0.0.1", port), StandInRequestHandler)
+        self.latency = latency
+        self.compress = compress
+        self.documents = {}
+        self.lock = threading.Lock()
+        self.requestCounts = {}
+        self.bytesSent = 0
+        self.startTime = time.strftime("%a, %d %b %Y %H:%M:%S GMT", time.gmtime())
+
+    def getDocument(self, path):
+        with self.lock:
+            if path not in self.documents:
+                parts = path.strip("/").split("/")
+                serviceUrl = "http://%s:%d%s" % (self.server_address[0], self.server_address[1], path)
+                self.documents[path] = generateProjectSettings(parts[-1], parseParams(parts[-2] if len(parts) > 2 else ""), serviceUrl)
+            return self.documents[path]
+
+
+class StandInRequestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = {key.upper(): value for key, value in parse_qsl(url.query)}
+        requestType = query.get("REQUEST", "").lower()
+        with self.server.lock:
+            self.server.requestCounts[requestType] = self.server.requestCounts.get(requestType, 0) + 1
+        time.sleep(self.server.latency)
+
+        headers = {}
+        if requestType == "getprojectsettings":
+            try:
+                body = self.server.getDocument(url.path)
+            except Exception as e:
+                self.sendReply(400, str(e).encode('utf-8'), {"Content-Type": "text/plain"})
+                return
+            etag = '"%s"' % hashlib.md5(body).hexdigest()
+            headers = {"Content-Type": "text/xml; charset=utf-8", "ETag": etag, "Last-Modified": self.server.startTime}
+            if self.headers.get("If-None-Match") == etag or self.headers.get("If-Modified-Since") == self.server.startTime:
+                self.sendReply(304, b"", headers)
+                return
+        elif requestType == "getmap":
+            body = generatePng(int(query.get("WIDTH", 16)), int(query.get("HEIGHT", 16)))
+            headers = {"Content-Type": "image/png"}
+        elif requestType == "getlegendgraphic":
+            # legend size varies by layer and style, like symbol lists of different lengths
+            size = int(hashlib.md5((query.get("LAYER", "") + query.get("STYLE", "")).encode('utf-8')).hexdigest()[:2], 16)
+            body = generatePng(80 + size % 5 * 20, 20 + size % 4 * 20)
+            headers = {"Content-Type": "image/png"}
+        else:
+            self.sendReply(400, b"Unsupported request", {"Content-Type": "text/plain"})
+            return
+        if self.server.compress and "gzip" in self.headers.get("Accept-Encoding", ""):
+            body = gzip.compress(body)
+            headers["Content-Encoding"] = "gzip"
+        self.sendReply(200, body, headers)
+
+    def sendReply(self, status, body, headers):
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        with self.server.lock:
+            self.server.bytesSent += len(body)
+
+
+def startServer(port, latency, compress):
+    server = StandInServer(port, latency, compress)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def loadThemesConfigModule():
+    spec = importlib.util.spec_from_file_location("themesConfig", os.path.join(scriptDir, "themesConfig.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+# time fetching, parsing and building a single theme item in-process
+def measurePhases(themesConfig, url):
+    configItem = {"url": url}
+    result = {"themes": {"defaultMapCrs": "EPSG:3857", "defaultDisplayCrs": None}}
+    generator = themesConfig.ThemesGenerator(httpRetries=0)
+    start = time.perf_counter()
+    reply = generator.httpClient.get(generator.getProjectSettingsUrl(configItem))[0]
+    fetched = time.perf_counter()
+    capabilities, index = themesConfig.parseDocument(reply)
+    parsed = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        themesConfig.parseTheme({}, configItem, result, {}, {}, capabilities, index)
+    built = time.perf_counter()
+    generator.close()
+    return {
+        "documentSize": len(reply),
+        "fetch": fetched - start,
+        "parse": parsed - fetched,
+        "build": built - parsed
+    }
+
+
+# run themesConfig.py in a scratch qwc2 directory, returns wall time and peak RSS
+def runThemesConfig(workDir, themesConfigArgs):
+    env = dict(os.environ, QWC2_THEMES_CONFIG="static/themesConfig.json")
+    start = time.perf_counter()
+    with open(os.path.join(workDir, "themesConfig.log"), "w") as log:
+        process = subprocess.Popen([sys.executable, os.path.join(scriptDir, "themesConfig.py")] + themesConfigArgs, cwd=workDir, env=env, stdout=log, stderr=subprocess.STDOUT)
+        pid, status, rusage = os.wait4(process.pid, 0)
+    wallTime = time.perf_counter() - start
+    if os.waitstatus_to_exitcode(status) != 0:
+        raise Exception("themesConfig.py failed, see " + os.path.join(workDir, "themesConfig.log"))
+    # ru_maxrss is in kilobytes on Linux
+    result = {"wallTime": wallTime, "peakRss": rusage.ru_maxrss * 1024}
+    metricsFile = os.path.join(workDir, "metrics.json")
+    if "--metrics" in themesConfigArgs and os.path.exists(metricsFile):
+        # phase times summed over all theme items, from the themesConfig.py metrics report
+        with open(metricsFile) as fh:
+            report = json.load(fh)
+        itemPhases = {}
+        for item in report["items"]:
+            for phase, value in item["phases"].items():
+                itemPhases[phase] = itemPhases.get(phase, 0) + value
+        result["itemPhases"] = itemPhases
+    return result
+
+
+def setupWorkDir(workDir, port, projects, params):
+    os.makedirs(os.path.join(workDir, "static", "assets", "img", "mapthumbs"), exist_ok=True)
+    spec = ",".join("%s=%d" % (key, value) for key, value in params.items())
+    items = [{"url": "http://127.0.0.1:%d/ows/%s/project%d" % (port, spec, i)} for i in range(projects)]
+    config = {
+        "defaultScales": [1000000, 100000, 10000, 1000],
+        "themes": {"items": items, "backgroundLayers": []}
+    }
+    with open(os.path.join(workDir, "static", "themesConfig.json"), "w") as fh:
+        json.dump(config, fh, indent=2)
+    return items
+
+
+def runBenchmark(args):
+    server = startServer(args.port, args.latency, args.gzip)
+    port = server.server_address[1]
+    themesConfig = loadThemesConfigModule()
+    results = []
+    for layers in map(int, args.layers.split(",")):
+        params = dict(defaultParams, **parseParams(args.params))
+        params["layers"] = layers
+        workDir = tempfile.mkdtemp(prefix="qwc2-themes-benchmark-")
+        try:
+            items = setupWorkDir(workDir, port, args.projects, params)
+            phases = measurePhases(themesConfig, items[0]["url"])
+            for run in range(args.runs):
+                server.requestCounts = {}
+                entry = runThemesConfig(workDir, args.themesConfigArgs + (["--metrics", "metrics.json"] if args.item_metrics else []))
+                entry.update({"layers": layers, "projects": args.projects, "run": run + 1, "requests": server.requestCounts, "phases": phases})
+                results.append(entry)
+                print("layers=%-6d projects=%-4d run=%d  wall=%7.2fs  peakRSS=%7.1fMB  document=%6.2fMB  fetch=%6.1fms  parse=%7.1fms  build=%7.1fms  requests=%s" % (
+                    layers, args.projects, run + 1, entry["wallTime"], entry["peakRss"] / 1e6, phases["documentSize"] / 1e6,
+                    phases["fetch"] * 1000, phases["parse"] * 1000, phases["build"] * 1000, json.dumps(entry["requests"], sort_keys=True)))
+                if "itemPhases" in entry:
+                    print("    item phases: " + "  ".join("%s=%.2fs" % (phase, value) for phase, value in sorted(entry["itemPhases"].items())))
+        finally:
+            if args.keep:
+                print("Kept work directory " + workDir)
+            else:
+                shutil.rmtree(workDir)
+    server.shutdown()
+    if args.json:
+        with open(args.json, "w") as fh:
+            json.dump(results, fh, indent=2)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark themesConfig.py against a synthetic QGIS Server stand-in")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    generateParser = subparsers.add_parser("generate", help="Write a synthetic GetProjectSettings document to stdout")
+    generateParser.add_argument("--name", default="project")
+    for key, value in defaultParams.items():
+        generateParser.add_argument("--" + key, type=int, default=value)
+
+    serveParser = subparsers.add_parser("serve", help="Run the QGIS Server stand-in")
+    serveParser.add_argument("--port", type=int, default=8090)
+    serveParser.add_argument("--latency", type=float, default=0, help="Seconds to wait before each reply")
+    serveParser.add_argument("--gzip", action="store_true", help="Compress replies if the client accepts gzip")
+
+    runParser = subparsers.add_parser("run", help="Run themesConfig.py against the stand-in at several scales")
+    runParser.add_argument("--port", type=int, default=0, help="Stand-in server port (default: any free port)")
+    runParser.add_argument("--latency", type=float, default=0.05, help="Seconds to wait before each reply")
+    runParser.add_argument("--gzip", action="store_true", help="Compress replies if the client accepts gzip")
+    runParser.add_argument("--layers", default="100,1000,5000", help="Comma separated layer counts per document")
+    runParser.add_argument("--projects", type=int, default=20, help="Number of theme items")
+    runParser.add_argument("--params", default="", help="Other document parameters, i.e. depth=3,styles=4,templates=10,atlas=5")
+    runParser.add_argument("--runs", type=int, default=1, help="Number of runs per scale, i.e. 2 to measure a warm cache")
+    runParser.add_argument("--item-metrics", action="store_true", help="Pass --metrics to themesConfig.py and report the phase times summed over all theme items")
+    runParser.add_argument("--json", help="Write the results to this file")
+    runParser.add_argument("--keep", action="store_true", help="Keep the work directories")
+    runParser.add_argument("themesConfigArgs", nargs="*", help="Arguments passed to themesConfig.py, after --")
+
+    args = parser.parse_args()
+    if args.command == "generate":
+        params = {key: getattr(args, key) for key in defaultParams}
+        sys.stdout.buffer.write(generateProjectSettings(args.name, params))
+    elif args.command == "serve":
+        server = StandInServer(args.port, args.latency, args.gzip)
+        print("Serving on http://127.0.0.1:%d/ows/<params>/<name>, i.e. /ows/layers=1000,depth=3/project" % server.server_address[1])
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+    else:
+        runBenchmark(args)
@@ -0,0 +1,385 @@
+#!/usr/bin/python3
+
+# Tile cache seeding plans for the WMTS background layers of the themes in themes.json
+#
+# Usage:
+#   tile_seeder.py plan [options] [themes.json]
+#       Print the tiles of the WMTS background layers of all themes as "<layer> <z>/<x>/<y>" lines
+#       (or with --urls, as ready to fetch URLs) and a summary with the tile count and an estimate
+#       of the size of each level on stderr. Tiles covering the initial extent of the themes come
+#       first, then those covering the full theme extents, coarse levels before fine levels. Each
+#       tile is listed once.
+#   tile_seeder.py fetch [options] [themes.json]
+#       Fetch the tiles of the plan with a bounded number of concurrent requests, i.e. to warm a
+#       caching proxy (requests honour the http_proxy / https_proxy environment variables)
+#
+# The levels of a theme are the tile matrices closest to its scales (or the default scales), as picked
+# by the viewer. themes.json may be in the regular, compact or sharded (index.json) layout.
+#
+# Example: tile_seeder.py plan --max-level 12 --urls static/themes.json > tiles.txt
+# Example: tile_seeder.py fetch --layer "bg_*" --max-tiles 100000 --jobs 16 static/themes.json
+
+import argparse
+import fnmatch
+import json
+import math
+import os
+import re
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
+
+from themesConfig import HttpClient, expandCompactThemes
+
+try:
+    from pyproj import Transformer
+except ImportError:
+    Transformer = None
+
+
+# assumed tile sizes in bytes by format, if not sampled
+defaultTileBytes = {"image/png": 20000, "image/jpeg": 12000, "image/webp": 10000}
+
+# same values as the viewer, see MapUtils.getResolutionsForScales
+screenDpi = 96
+metersPerDegree = 2 * math.pi * 6370997 / 360
+
+
+def loadThemes(filename):
+    with open(filename, encoding='utf-8') as fh:
+        themes = expandCompactThemes(json.load(fh))
+    # sharded output, theme items are stored in files next to index.json
+    def loadGroup(group):
+        for index, item in enumerate(group.get("items", [])):
+            if "themeFile" in item:
+                with open(os.path.join(os.path.dirname(filename), item["themeFile"]), encoding='utf-8') as fh:
+                    group["items"][index] = json.load(fh)
+        for subdir in group.get("subdirs", []):
+            loadGroup(subdir)
+    loadGroup(themes["themes"])
+    return themes["themes"]
+
+
+def getThemeItems(group):
+    items = list(group.get("items", []))
+    for subdir in group.get("subdirs", []):
+        items += getThemeItems(subdir)
+    return items
+
+
+def isGeographic(crs):
+    return crs in ["EPSG:4326", "EPSG:4258", "CRS:84"]
+
+
+# transform bounds between projections, returns None if no transformation is available
+def transformBounds(bounds, fromCrs, toCrs):
+    if fromCrs == toCrs:
+        return list(bounds)
+    if isGeographic(fromCrs) and toCrs == "EPSG:3857":
+        def project(lon, lat):
+            lat = max(-85.0511287798, min(85.0511287798, lat))
+            return lon * 20037508.342789244 / 180, math.log(math.tan((90 + lat) * math.pi / 360)) * 6378137
+        return list(project(bounds[0], bounds[1]) + project(bounds[2], bounds[3]))
+    if fromCrs == "EPSG:3857" and isGeographic(toCrs):
+        def unproject(x, y):
+            return x * 180 / 20037508.342789244, math.atan(math.exp(y / 6378137)) * 360 / math.pi - 90
+        return list(unproject(bounds[0], bounds[1]) + unproject(bounds[2], bounds[3]))
+    if Transformer:
+        try:
+            return list(Transformer.from_crs(fromCrs, toCrs, always_xy=True).transform_bounds(*bounds))
+        except Exception:
+            return None
+    return None
+
+
+def intersectBounds(bounds, other):
+    result = [max(bounds[0], other[0]), max(bounds[1], other[1]), min(bounds[2], other[2]), min(bounds[3], other[3])]
+    return result if result[0] < result[2] and result[1] < result[3] else None
+
+
+# tile grid of a WMTS background layer entry, as written by wmts_config_generator.py
+class TileGrid:
+    def __init__(self, entry):
+        self.entry = entry
+        self.name = entry["name"]
+        self.projection = entry["projection"]
+        self.origin = (entry["originX"], entry["originY"])
+        self.tileSize = entry.get("tileSize") or [256, 256]
+        self.resolutions = entry["resolutions"]
+        prefix = entry.get("tileMatrixPrefix", "")
+        self.matrixIds = entry.get("matrixIds") or [(prefix + ":" + str(z)) if prefix else str(z) for z in range(len(self.resolutions))]
+        self.bounds = None
+        if entry.get("bbox"):
+            self.bounds = transformBounds(entry["bbox"]["bounds"], entry["bbox"]["crs"], self.projection)
+
+    # tile matrix used by the viewer at a scale, the one with the closest resolution
+    def getLevelForScale(self, scale, pixelRatio=1):
+        resolution = scale * 0.0254 / screenDpi / pixelRatio
+        if isGeographic(self.projection):
+            resolution /= metersPerDegree
+        return min(range(len(self.resolutions)), key=lambda z: abs(self.resolutions[z] - resolution))
+
+    # inclusive (minCol, minRow, maxCol, maxRow) of the tiles covering bounds at a level, or None
+    def getTileRange(self, level, bounds):
+        if self.bounds:
+            bounds = intersectBounds(bounds, self.bounds)
+            if not bounds:
+                return None
+        spanX = self.tileSize[0] * self.resolutions[level]
+        spanY = self.tileSize[1] * self.resolutions[level]
+        # the small offset avoids including a neighbour tile if the bounds end exactly on a tile boundary
+        minCol = max(0, math.floor((bounds[0] - self.origin[0]) / spanX))
+        maxCol = math.floor((bounds[2] - self.origin[0]) / spanX - 1e-9)
+        minRow = max(0, math.floor((self.origin[1] - bounds[3]) / spanY))
+        maxRow = math.floor((self.origin[1] - bounds[1]) / spanY - 1e-9)
+        if maxCol < minCol or maxRow < minRow:
+            return None
+        return (minCol, minRow, maxCol, maxRow)
+
+    # same URL as requested by the viewer, see createWMTSSource in components/map/layers/WMTSLayer.js
+    def getTileUrl(self, level, col, row):
+        entry = self.entry
+        url = (entry["url"][0] if isinstance(entry["url"], list) else entry["url"]).split("?")[0]
+        dimensions = (entry.get("sourceConfig") or {}).get("dimensions") or {}
+        if entry.get("requestEncoding") == "KVP":
+            params = {
+                "LAYER": entry.get("layerName") or entry["name"], "STYLE": entry.get("style", ""), "TILEMATRIXSET": entry.get("tileMatrixSet", ""),
+                "SERVICE": "WMTS", "REQUEST": "GetTile", "VERSION": "1.0.0", "FORMAT": entry.get("format", "image/jpeg"), **dimensions,
+                "TileMatrix": self.matrixIds[level], "TileCol": col, "TileRow": row
+            }
+            return url + ("?" + entry["rev"] + "&" if entry.get("rev") else "?") + urlencode(params)
+        values = {key.lower(): str(value) for key, value in dimensions.items()}
+        values.update({
+            "layer": entry.get("layerName") or entry["name"], "style": entry.get("style", ""), "tilematrixset": entry.get("tileMatrixSet", ""),
+            "tilematrix": self.matrixIds[level], "tilecol": str(col), "tilerow": str(row)
+        })
+        url = re.sub(r'\{(\w+?)\}', lambda match: values.get(match.group(1).lower(), match.group(0)), url)
+        return url + "?" + entry["rev"] if entry.get("rev") else url
+
+
+def countUnion(ranges):
+    # number of tiles covered by a list of tile ranges, by coordinate compression
+    cols = sorted({r[0] for r in ranges} | {r[2] + 1 for r in ranges})
+    rows = sorted({r[1] for r in ranges} | {r[3] + 1 for r in ranges})
+    count = 0
+    for i in range(len(cols) - 1):
+        for j in range(len(rows) - 1):
+            if any(r[0] <= cols[i] <= r[2] and r[1] <= rows[j] <= r[3] for r in ranges):
+                count += (cols[i + 1] - cols[i]) * (rows[j + 1] - rows[j])
+    return count
+
+
+# seeding plan of the WMTS background layers of all themes
+class SeedingPlan:
+    def __init__(self, themes, layerPatterns=None, minLevel=0, maxLevel=None, pixelRatio=1):
+        self.grids = {}
+        # (priority, tile range) by (layer, level), in priority order
+        self.ranges = {}
+        requests = []
+        backgroundLayers = {entry.get("name"): entry for entry in themes.get("backgroundLayers", [])}
+        for themeIndex, item in enumerate(getThemeItems(themes)):
+            scales = item.get("scales") or themes.get("defaultScales") or []
+            for reference in item.get("backgroundLayers", []):
+                entry = backgroundLayers.get(reference.get("name"))
+                if not entry or entry.get("type") != "wmts" or not entry.get("resolutions"):
+                    continue
+                if layerPatterns and not any(fnmatch.fnmatchcase(entry["name"], pattern) for pattern in layerPatterns):
+                    continue
+                if entry["name"] not in self.grids:
+                    self.grids[entry["name"]] = TileGrid(entry)
+                grid = self.grids[entry["name"]]
+                levels = sorted({grid.getLevelForScale(scale, pixelRatio) for scale in scales})
+                levels = [level for level in levels if level >= minLevel and (maxLevel is None or level <= maxLevel)]
+                # the initial extent is seeded before the full extent
+                for priority, key in enumerate(["initialBbox", "bbox"]):
+                    if not item.get(key):
+                        continue
+                    bounds = transformBounds(item[key]["bounds"], item[key]["crs"], grid.projection)
+                    if bounds is None:
+                        print("WARNING: cannot transform %s of theme %s from %s to %s, install pyproj" % (key, item.get("id"), item[key]["crs"], grid.projection), file=sys.stderr)
+                        continue
+                    for level in levels:
+                        tileRange = grid.getTileRange(level, bounds)
+                        if tileRange:
+                            requests.append((priority, level, themeIndex, entry["name"], tileRange))
+        for priority, level, themeIndex, layer, tileRange in sorted(requests, key=lambda request: request[:3]):
+            ranges = self.ranges.setdefault((layer, level), [])
+            # ranges within an earlier range add no tiles
+            if not any(r[0] <= tileRange[0] and r[1] <= tileRange[1] and r[2] >= tileRange[2] and r[3] >= tileRange[3] for _, r in ranges):
+                ranges.append((priority, tileRange))
+        self.order = sorted({(priority, level, layer) for priority, level, themeIndex, layer, tileRange in requests})
+
+    # tiles in priority order as (layer, level, col, row)
+    def tiles(self):
+        for priority, level, layer in self.order:
+            ranges = self.ranges[(layer, level)]
+            for index, (rangePriority, tileRange) in enumerate(ranges):
+                if rangePriority != priority:
+                    continue
+                # tiles of earlier ranges were emitted before, at the same or a higher priority
+                for row in range(tileRange[1], tileRange[3] + 1):
+                    for col in range(tileRange[0], tileRange[2] + 1):
+                        if not any(r[0] <= col <= r[2] and r[1] <= row <= r[3] for _, r in ranges[:index]):
+                            yield layer, level, col, row
+
+    # tile count of each layer and level
+    def getLevelCounts(self):
+        return {key: countUnion([tileRange for _, tileRange in ranges]) for key, ranges in sorted(self.ranges.items())}
+
+    # up to count tiles of a layer and level, evenly spaced over its tile ranges, as (layer, level, col, row)
+    # the tiles are picked by position, tiles of overlapping ranges may be picked once per range
+    def getSampleTiles(self, layer, level, count):
+        ranges = [tileRange for _, tileRange in self.ranges[(layer, level)]]
+        sizes = [(r[2] - r[0] + 1) * (r[3] - r[1] + 1) for r in ranges]
+        count = min(count, sum(sizes))
+        tiles = set()
+        for i in range(count):
+            position = i * sum(sizes) // count
+            for tileRange, size in zip(ranges, sizes):
+                if position < size:
+                    break
+                position -= size
+            width = tileRange[2] - tileRange[0] + 1
+            tiles.add((layer, level, tileRange[0] + position % width, tileRange[1] + position // width))
+        return sorted(tiles)
+
+    def getTileUrl(self, layer, level, col, row):
+        return self.grids[layer].getTileUrl(level, col, row)
+
+
+# average tile size in bytes of each layer and level, from sampleSize tiles spread over the level
+def sampleTileBytes(plan, httpClient, sampleSize):
+    samples = {}
+    for key in sorted(plan.ranges):
+        for layer, level, col, row in plan.getSampleTiles(*key, sampleSize):
+            try:
+                samples.setdefault(key, []).append(len(httpClient.get(plan.getTileUrl(layer, level, col, row))[0]))
+            except Exception as e:
+                print("WARNING: sampling tile %s %d/%d/%d failed: %s" % (layer, level, col, row, e), file=sys.stderr)
+    return {key: sum(sizes) / len(sizes) for key, sizes in samples.items() if sizes}
+
+
+def getSummary(plan, counts, sampledBytes, bytesPerTile):
+    summary = {"layers": {}, "tiles": 0, "bytes": 0}
+    for (layer, level), count in counts.items():
+        grid = plan.grids[layer]
+        tileBytes = sampledBytes.get((layer, level)) or bytesPerTile or defaultTileBytes.get(grid.entry.get("format"), 15000)
+        layerSummary = summary["layers"].setdefault(layer, {"levels": [], "tiles": 0, "bytes": 0})
+        layerSummary["levels"].append({
+            "level": level,
+            "matrixId": grid.matrixIds[level],
+            "resolution": grid.resolutions[level],
+            "tiles": count,
+            "bytes": int(count * tileBytes),
+            "sampled": (layer, level) in sampledBytes
+        })
+        layerSummary["tiles"] += count
+        layerSummary["bytes"] += int(count * tileBytes)
+        summary["tiles"] += count
+        summary["bytes"] += int(count * tileBytes)
+    return summary
+
+
+def printSummary(summary, file):
+    for layer, layerSummary in summary["layers"].items():
+        print("%s: %d tiles, %.2f MB" % (layer, layerSummary["tiles"], layerSummary["bytes"] / 1e6), file=file)
+        for entry in layerSummary["levels"]:
+            print("  level %-3d %-16s resolution=%-12.6g tiles=%-10d %10.1f MB%s" % (
+                entry["level"], entry["matrixId"], entry["resolution"], entry["tiles"], entry["bytes"] / 1e6, " (sampled)" if entry["sampled"] else ""
+            ), file=file)
+    print("total: %d tiles, %.2f MB" % (summary["tiles"], summary["bytes"] / 1e6), file=file)
+
+
+def limitTiles(tiles, maxTiles):
+    for index, tile in enumerate(tiles):
+        if maxTiles is not None and index >= maxTiles:
+            return
+        yield tile
+
+
+# fetch the tiles with at most jobs concurrent requests, returns the number of failed tiles
+def fetchTiles(plan, httpClient, tiles, jobs, progressInterval=10):
+    lock = threading.Lock()
+    stats = {"fetched": 0, "failed": 0, "bytes": 0}
+    startTime = time.time()
+    lastProgress = [startTime]
+
+    def fetch(layer, level, col, row):
+        url = plan.getTileUrl(layer, level, col, row)
+        try:
+            body = httpClient.get(url)[0]
+            with lock:
+                stats["fetched"] += 1
+                stats["bytes"] += len(body)
+        except Exception as e:
+            print("ERROR fetching %s: %s" % (url, e), file=sys.stderr)
+            with lock:
+                stats["failed"] += 1
+        with lock:
+            if time.time() - lastProgress[0] >= progressInterval:
+                lastProgress[0] = time.time()
+                print("%d tiles fetched, %d failed, %.2f MB" % (stats["fetched"], stats["failed"], stats["bytes"] / 1e6), file=sys.stderr)
+
+    # only a few tiles per worker are queued, the plan may be very long
+    semaphore = threading.BoundedSemaphore(4 * jobs)
+    def run(tile):
+        try:
+            fetch(*tile)
+        finally:
+            semaphore.release()
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        for tile in tiles:
+            semaphore.acquire()
+            executor.submit(run, tile)
+
+    duration = time.time() - startTime
+    print("%d tiles fetched, %d failed, %.2f MB in %.1fs (%.1f tiles/s)" % (
+        stats["fetched"], stats["failed"], stats["bytes"] / 1e6, duration, stats["fetched"] / duration if duration > 0 else 0
+    ), file=sys.stderr)
+    return stats["failed"]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Tile cache seeding plans for the WMTS background layers of themes.json")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    planParser = subparsers.add_parser("plan", help="Print the tiles to seed and a summary of the tile counts and sizes")
+    fetchParser = subparsers.add_parser("fetch", help="Fetch the tiles to seed")
+    for subparser in [planParser, fetchParser]:
+        subparser.add_argument("themes", nargs="?", default="static/themes.json", help="themes.json, or index.json of the sharded output (default: static/themes.json)")
+        subparser.add_argument("--layer", action="append", help="Only seed background layers matching this name or glob pattern, may be repeated")
+        subparser.add_argument("--min-level", type=int, default=0, help="Lowest tile matrix index to seed")
+        subparser.add_argument("--max-level", type=int, help="Highest tile matrix index to seed")
+        subparser.add_argument("--pixel-ratio", type=float, default=1, help="Device pixel ratio of the clients, 2 for HiDPI screens")
+        subparser.add_argument("--max-tiles", type=int, help="Only the first tiles of the plan, by priority")
+        subparser.add_argument("--bytes-per-tile", type=int, help="Assumed tile size for the estimates (default: by format, i.e. %d for PNG)" % defaultTileBytes["image/png"])
+        subparser.add_argument("--sample", type=int, default=0, help="Estimate the tile sizes of each level by fetching this many tiles of it")
+        subparser.add_argument("--summary", help="Write the summary as JSON to this file")
+        subparser.add_argument("--timeout", type=float, default=30, help="HTTP read timeout in seconds")
+        subparser.add_argument("--retries", type=int, default=2, help="Number of retries of requests failing with 5xx or connection errors")
+    planParser.add_argument("--urls", action="store_true", help="Print tile URLs instead of <layer> <z>/<x>/<y> lines")
+    fetchParser.add_argument("-j", "--jobs", type=int, default=8, help="Number of concurrent requests")
+
+    args = parser.parse_args()
+    themes = loadThemes(args.themes)
+    plan = SeedingPlan(themes, args.layer, args.min_level, args.max_level, args.pixel_ratio)
+    httpClient = HttpClient(10, args.timeout, args.retries)
+
+    counts = plan.getLevelCounts()
+    sampledBytes = sampleTileBytes(plan, httpClient, args.sample) if args.sample > 0 else {}
+    summary = getSummary(plan, counts, sampledBytes, args.bytes_per_tile)
+    printSummary(summary, sys.stderr)
+    if args.summary:
+        with open(args.summary, "w") as fh:
+            json.dump(summary, fh, indent=2)
+
+    tiles = limitTiles(plan.tiles(), args.max_tiles)
+    if args.command == "plan":
+        for layer, level, col, row in tiles:
+            if args.urls:
+                print(plan.getTileUrl(layer, level, col, row))
+            else:
+                print("%s %s/%d/%d" % (layer, plan.grids[layer].matrixIds[level], col, row))
+    else:
+        sys.exit(1 if fetchTiles(plan, httpClient, tiles, max(1, args.jobs)) else 0)
@@ -2,171 +2,304 @@
 
 # Automatically generates a QWC2 WMTS background layer configuration, to be added to themesConfig.json
 #
-# Usage: wmts_config_generator.py <WMTS Capabilities URL> <LayerName> <Projection> [<format>]
+# Usage: wmts_config_generator.py <WMTS Capabilities URL> <LayerName> <Projection> [<style>]
 #
 # Example: wmts_config_generator.py https://www.wmts.nrw.de/geobasis/wmts_nw_dop/1.0.0/WMTSCapabilities.xml nw_dop EPSG:25832
+#
+# Batch mode: LayerName and Projection may also be comma separated lists of identifiers or glob patterns,
+# or "all". The capabilities are then fetched and parsed once and a JSON array with the configuration of
+# each matching layer and projection is printed. Layers which cannot be configured are reported on stderr.
+#
+# Example: wmts_config_generator.py https://www.wmts.nrw.de/geobasis/wmts_nw_dop/1.0.0/WMTSCapabilities.xml "nw_dop*,nw_dtk" all
 
+import fnmatch
+import io
 import json
 import re
 import sys
 import urllib.request
-from xml.dom.minidom import parseString
+import xml.etree.ElementTree as ET
+
+
+def getLocalName(tag):
+    return tag.rsplit("}", 1)[-1]
+
+# first descendant (or with direct, first child) with the given local name, in any namespace
+def findElement(parent, name, direct=False):
+    return parent.find(("{*}" if direct else ".//{*}") + name)
+
+def findElementValue(parent, name, direct=False):
+    element = findElement(parent, name, direct)
+    return element.text or "" if element is not None else ""
+
+def getEpsgCrs(crs):
+    crsMatch = re.search(r'(EPSG).*:(\d+)', crs)
+    return ("EPSG:" + crsMatch.group(2)) if crsMatch else None
+
+def parseBbox(element):
+    return {
+        "crs": element.get("crs", ""),
+        "lower": list(map(float, findElementValue(element, "LowerCorner").split(" "))),
+        "upper": list(map(float, findElementValue(element, "UpperCorner").split(" ")))
+    }
+
+
+# WMTS capabilities read in one streaming pass, with the layers and tile matrix sets indexed by identifier.
+# Only the parts needed for the background layer configurations are kept, the subtree of each layer and
+# tile matrix set is discarded as soon as it has been read, so that large documents need little memory.
+class WMTSCapabilities:
+    # source is a file object or the capabilities document as bytes
+    def __init__(self, capabilitiesUrl, source):
+        self.capabilitiesUrl = capabilitiesUrl
+        self.layers = {}
+        self.tileMatrixSets = {}
+        self.requestEncoding = ""
+        if isinstance(source, bytes):
+            source = io.BytesIO(source)
+
+        path = []
+        parents = []
+        haveContents = False
+        for event, element in ET.iterparse(source, events=("start", "end")):
+            if event == "start":
+                path.append(getLocalName(element.tag))
+                parents.append(element)
+                continue
+            path.pop()
+            parents.pop()
+            name = getLocalName(element.tag)
+            parentName = path[-1] if path else None
+            if parentName == "Contents" and name == "Layer":
+                self.readLayer(element)
+            elif parentName == "Contents" and name == "TileMatrixSet":
+                self.readTileMatrixSet(element)
+            elif name == "OperationsMetadata":
+                self.readOperationsMetadata(element)
+            elif name == "Contents":
+                haveContents = True
+            else:
+                continue
+            element.clear()
+            if parents:
+                parents[-1].remove(element)
+        if not haveContents:
+            raise Exception("No Contents in capabilities")
+
+    def readLayer(self, element):
+        identifier = findElementValue(element, "Identifier", True)
+        if identifier in self.layers:
+            return
+        wgsBboxEl = findElement(element, "WGS84BoundingBox")
+        defaultStyle = ""
+        for style in element.iterfind(".//{*}Style"):
+            if style.get("isDefault") == "true":
+                defaultStyle = findElementValue(style, "Identifier")
+                break
+        tileUrl = None
+        for resourceURL in element.iterfind(".//{*}ResourceURL"):
+            if resourceURL.get("resourceType") == "tile":
+                tileUrl = resourceURL.get("template")
+        self.layers[identifier] = {
+            "wgs84Bbox": parseBbox(wgsBboxEl) if wgsBboxEl is not None else None,
+            "tileMatrixSets": [findElementValue(link, "TileMatrixSet") for link in element.iterfind(".//{*}TileMatrixSetLink")],
+            "defaultStyle": defaultStyle,
+            "tileUrl": tileUrl,
+            "dimensions": [(findElementValue(dimension, "Identifier"), findElementValue(dimension, "Default")) for dimension in element.iterfind(".//{*}Dimension")],
+            "format": findElementValue(element, "Format")
+        }
+
+    def readTileMatrixSet(self, element):
+        identifier = findElementValue(element, "Identifier", True)
+        bboxEl = findElement(element, "BoundingBox")
+        self.tileMatrixSets.setdefault(identifier, {
+            "crs": getEpsgCrs(findElementValue(element, "SupportedCRS")),
+            "bbox": parseBbox(bboxEl) if bboxEl is not None else None,
+            "tileMatrices": [{
+                "identifier": findElementValue(tileMatrix, "Identifier"),
+                "scaleDenominator": findElementValue(tileMatrix, "ScaleDenominator"),
+                "topLeftCorner": findElementValue(tileMatrix, "TopLeftCorner"),
+                "tileWidth": findElementValue(tileMatrix, "TileWidth"),
+                "tileHeight": findElementValue(tileMatrix, "TileHeight")
+            } for tileMatrix in element.iterfind(".//{*}TileMatrix")]
+        })
+
+    def readOperationsMetadata(self, element):
+        for operation in element.iterfind(".//{*}Operation"):
+            if operation.get("name") == "GetCapabilities":
+                constraint = findElement(operation, "Constraint")
+                if constraint is not None and constraint.get("name") == "GetEncoding":
+                    self.requestEncoding = findElementValue(constraint, "Value")
+
+    def layerIdentifiers(self):
+        return list(self.layers)
+
+    def getLayer(self, layerName):
+        if layerName not in self.layers:
+            raise Exception("Could not find layer %s in capabilities" % layerName)
+        return self.layers[layerName]
+
+    # tile matrix sets linked by a layer, in document order
+    def getLayerTileMatrixSets(self, layerName):
+        links = self.getLayer(layerName)["tileMatrixSets"]
+        return [(identifier, tileMatrixSet) for identifier, tileMatrixSet in self.tileMatrixSets.items() if identifier in links]
+
+    # projections in which a layer is available
+    def getLayerCrs(self, layerName):
+        crsList = []
+        for identifier, tileMatrixSet in self.getLayerTileMatrixSets(layerName):
+            if tileMatrixSet["crs"] and tileMatrixSet["crs"] not in crsList:
+                crsList.append(tileMatrixSet["crs"])
+        return crsList
+
+    # background layer configuration of a layer in a projection
+    def getLayerConfig(self, layerName, crs, styleIdentifier="", name=None):
+        layer = self.getLayer(layerName)
 
+        # Get best tile matrix
+        tileMatrixName, tileMatrixSet = next(((identifier, entry) for identifier, entry in self.getLayerTileMatrixSets(layerName) if entry["crs"] == crs), ("", None))
+        if not tileMatrixSet or not tileMatrixSet["tileMatrices"]:
+            raise Exception("Could not find compatible tile matrix for layer %s in %s" % (layerName, crs))
+        tileMatrix = tileMatrixSet["tileMatrices"]
 
-def getFirstElementByTagName(parent, name):
+        # Boundingbox
+        bbox = None
+        if layer["wgs84Bbox"]:
+            bbox = {
+                "crs": "EPSG:4326",
+                "bounds": layer["wgs84Bbox"]["lower"][0:2] + layer["wgs84Bbox"]["upper"][0:2]
+            }
+        elif tileMatrixSet["bbox"]:
+            bbox = {
+                "crs": getEpsgCrs(tileMatrixSet["bbox"]["crs"]) or crs,
+                "bounds": tileMatrixSet["bbox"]["lower"][0:2] + tileMatrixSet["bbox"]["upper"][0:2]
+            }
+
+        # Compute origin and resolutions
+        origin = list(map(float, filter(bool, tileMatrix[0]["topLeftCorner"].split(" "))))
+        tileSize = [
+            int(tileMatrix[0]["tileWidth"]),
+            int(tileMatrix[0]["tileHeight"])
+        ]
+        matrixIds = []
+        resolutions = []
+        for entry in tileMatrix:
+            matrixIds.append(entry["identifier"])
+            # 0.00028: assumed pixel width in meters, as per WMTS standard
+            resolutions.append(float(entry["scaleDenominator"]) * 0.00028)
+
+        # Determine style
+        if not styleIdentifier:
+            styleIdentifier = layer["defaultStyle"]
+
+        # Resource URL
+        tileUrl = layer["tileUrl"] or self.capabilitiesUrl.split("?")[0]
+
+        # Dimensions
+        for dimensionIdentifier, dimensionValue in layer["dimensions"]:
+            tileUrl = tileUrl.replace("{%s}" % dimensionIdentifier, dimensionValue)
+
+        return {
+            "type": "wmts",
+            "url": tileUrl,
+            "name": name or layerName,
+            "format": layer["format"],
+            "requestEncoding": self.requestEncoding,
+            "tileMatrixPrefix": "",
+            "tileMatrixSet": tileMatrixName,
+            "originX": origin[0],
+            "originY": origin[1],
+            "projection": crs,
+            "tileSize": tileSize,
+            "style": styleIdentifier,
+            "bbox": bbox,
+            "matrixIds": matrixIds,
+            "resolutions": resolutions,
+            "thumbnail": layerName + ".jpg",
+        }
+
+
+# download and parse the capabilities, the response is parsed while it is being read
+def fetchCapabilities(capabilitiesUrl):
     try:
-        return parent.getElementsByTagName(name)[0]
+        response = urllib.request.urlopen(capabilitiesUrl)
     except:
-        return None
+        raise Exception("Failed to download capabilities")
+    with response:
+        try:
+            return WMTSCapabilities(capabilitiesUrl, response)
+        except OSError:
+            raise Exception("Failed to download capabilities")
+        except:
+            raise Exception("Failed to parse capabilities")
+
+
+def isBatchPattern(pattern):
+    return pattern == "all" or any(char in pattern for char in ",*?[")
+
+# select the values matching a comma separated list of identifiers or glob patterns, or "all"
+# returns the matches in the order of values, and the plain identifiers not among values
+def matchPatterns(pattern, values):
+    if pattern == "all":
+        return list(values), []
+    patterns = [entry.strip() for entry in pattern.split(",") if entry.strip()]
+    matches = [value for value in values if any(fnmatch.fnmatchcase(value, entry) for entry in patterns)]
+    missing = [entry for entry in patterns if not isBatchPattern(entry) and entry not in values]
+    return matches, missing
+
+
+# configurations of all matching layers and projections, with a list of errors of the ones which failed
+# layers configured in several projections are named <layer>_<EPSG_code>
+def getBatchLayerConfigs(capabilities, layerPattern, crsPattern, styleIdentifier=""):
+    results = []
+    errors = []
+    layerNames, missingLayers = matchPatterns(layerPattern, capabilities.layerIdentifiers())
+    for layerName in missingLayers:
+        errors.append("Could not find layer %s in capabilities" % layerName)
+    for layerName in layerNames:
+        try:
+            layerCrs = capabilities.getLayerCrs(layerName)
+            crsList, missingCrs = matchPatterns(crsPattern, layerCrs)
+            for crs in missingCrs:
+                errors.append("Could not find compatible tile matrix for layer %s in %s" % (layerName, crs))
+            if not crsList and not missingCrs:
+                errors.append("Layer %s is not available in %s" % (layerName, crsPattern))
+            for crs in crsList:
+                name = layerName if len(crsList) == 1 else layerName + "_" + crs.replace(":", "_")
+                results.append(capabilities.getLayerConfig(layerName, crs, styleIdentifier, name))
+        except Exception as e:
+            errors.append(str(e))
+    return results, errors
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 4:
+        print("Usage: %s WMTS_Capabilities_URL LayerName Projection [style=default]" % sys.argv[0], file=sys.stderr)
+        sys.exit(1)
+
+    capabilitiesUrl = sys.argv[1]
+    layerName = sys.argv[2]
+    crs = sys.argv[3]
+    styleIdentifier = sys.argv[4] if len(sys.argv) > 4 else ""
 
-def getFirstElementValueByTagName(parent, name):
     try:
-        return parent.getElementsByTagName(name)[0].firstChild.nodeValue
-    except:
-        return ""
-
-
-if len(sys.argv) < 4:
-    print("Usage: %s WMTS_Capabilities_URL LayerName Projection [style=default]" % sys.argv[0], file=sys.stderr)
-    sys.exit(1)
-
-capabilitiesUrl = sys.argv[1]
-layerName = sys.argv[2]
-crs = sys.argv[3]
-styleIdentifier = sys.argv[4] if len(sys.argv) > 4 else ""
-
-
-try:
-    response = urllib.request.urlopen(capabilitiesUrl)
-except:
-    print("Failed to download capabilities", file=sys.stderr)
-    sys.exit(1)
-
-try:
-    capabilities = parseString(response.read())
-except:
-    print("Failed to parse capabilities", file=sys.stderr)
-    sys.exit(1)
-
-contents = getFirstElementByTagName(capabilities, "Contents")
-
-# Search for layer
-targetLayer = None
-for layer in contents.getElementsByTagName("Layer"):
-    identifier = getFirstElementValueByTagName(layer, "ows:Identifier")
-    if identifier == layerName:
-        targetLayer = layer
-        break
-
-if not targetLayer:
-    print("Could not find layer %s in capabilities" % layerName, file=sys.stderr)
-    sys.exit(1)
-
-# Get supported tile matrix
-layerTileMatrixSet = []
-for tileMatrixSetLink in targetLayer.getElementsByTagName("TileMatrixSetLink"):
-    layerTileMatrixSet.append(getFirstElementValueByTagName(tileMatrixSetLink, "TileMatrixSet"))
-
-# Get best tile matrix
-tileMatrix = None
-tileMatrixName = ""
-for child in contents.childNodes:
-    if child.nodeName == "TileMatrixSet":
-        tileMatrixSet = child
-        tileMatrixName = getFirstElementValueByTagName(tileMatrixSet, "ows:Identifier")
-        supportedCrs = getFirstElementValueByTagName(tileMatrixSet, "ows:SupportedCRS")
-        crsMatch = re.search(r'(EPSG).*:(\d+)', supportedCrs)
-        if crsMatch and crs == "EPSG:" + crsMatch.group(2) and tileMatrixName in layerTileMatrixSet:
-            tileMatrix = tileMatrixSet.getElementsByTagName("TileMatrix")
-            break
-
-if not tileMatrix:
-    print("Could not find compatible tile matrix", file=sys.stderr)
-    sys.exit(1)
-
-# Boundingbox
-wgsBboxEl = getFirstElementByTagName(layer, "ows:WGS84BoundingBox")
-tmsBboxEl = getFirstElementByTagName(tileMatrixSet, "ows:BoundingBox")
-if wgsBboxEl is not None:
-    bboxLower = list(map(float, getFirstElementValueByTagName(wgsBboxEl, "ows:LowerCorner").split(" ")))
-    bboxUpper = list(map(float, getFirstElementValueByTagName(wgsBboxEl, "ows:UpperCorner").split(" ")))
-    bbox = {
-        "crs": "EPSG:4326",
-        "bounds": [bboxLower[0], bboxLower[1], bboxUpper[0], bboxUpper[1]]
-    }
-elif tmsBboxEl is not None:
-    bboxLower = list(map(float, getFirstElementValueByTagName(tmsBboxEl, "ows:LowerCorner").split(" ")))
-    bboxUpper = list(map(float, getFirstElementValueByTagName(tmsBboxEl, "ows:UpperCorner").split(" ")))
-    crsMatch = re.search(r'(EPSG).*:(\d+)', tmsBboxEl.getAttribute("crs"))
-    bbox = {
-        "crs": ("EPSG:" + crsMatch.group(2)) if crsMatch else crs,
-        "bounds": [bboxLower[0], bboxLower[1], bboxUpper[0], bboxUpper[1]]
-    }
+        capabilities = fetchCapabilities(capabilitiesUrl)
+    except Exception as e:
+        print(str(e), file=sys.stderr)
+        sys.exit(1)
 
+    if isBatchPattern(layerName) or isBatchPattern(crs):
+        results, errors = getBatchLayerConfigs(capabilities, layerName, crs, styleIdentifier)
+        for error in errors:
+            print(error, file=sys.stderr)
+        if errors:
+            print("%d layers configured, %d failed" % (len(results), len(errors)), file=sys.stderr)
+        print(json.dumps(results, indent=2))
+        sys.exit(1 if errors else 0)
+
+    try:
+        result = capabilities.getLayerConfig(layerName, crs, styleIdentifier)
+    except Exception as e:
+        print(str(e), file=sys.stderr)
+        sys.exit(1)
 
-# Compute origin and resolutions
-origin = list(map(float, filter(bool, getFirstElementValueByTagName(tileMatrix[0], "TopLeftCorner").split(" "))))
-tileSize = [
-    int(getFirstElementValueByTagName(tileMatrix[0], "TileWidth")),
-    int(getFirstElementValueByTagName(tileMatrix[0], "TileHeight"))
-]
-matrixIds = []
-resolutions = []
-for entry in tileMatrix:
-    matrixIds.append(getFirstElementValueByTagName(entry, "ows:Identifier"))
-    scaleDenominator = getFirstElementValueByTagName(entry, "ScaleDenominator")
-    # 0.00028: assumed pixel width in meters, as per WMTS standard
-    resolutions.append(float(scaleDenominator) * 0.00028)
-
-# Determine style
-if not styleIdentifier:
-    for style in targetLayer.getElementsByTagName("Style"):
-        if style.getAttribute("isDefault") == "true":
-            styleIdentifier = getFirstElementValueByTagName(style, "ows:Identifier")
-            break
-
-# Resource URL
-tileUrl = capabilitiesUrl.split("?")[0]
-for resourceURL in targetLayer.getElementsByTagName("ResourceURL"):
-    if resourceURL.getAttribute("resourceType") == "tile":
-        tileUrl = resourceURL.getAttribute("template")
-
-# Dimensions
-for dimension in targetLayer.getElementsByTagName("Dimension"):
-    dimensionIdentifier = getFirstElementValueByTagName(dimension, "ows:Identifier")
-    dimensionValue = getFirstElementValueByTagName(dimension, "Default")
-    tileUrl = tileUrl.replace("{%s}" % dimensionIdentifier, dimensionValue)
-
-# Format
-format = getFirstElementValueByTagName(targetLayer, "Format")
-
-# RequestEncoding
-requestEncoding = ""
-operationsMetadata = getFirstElementByTagName(capabilities, "ows:OperationsMetadata")
-if operationsMetadata is not None:
-    for operation in operationsMetadata.getElementsByTagName("ows:Operation"):
-        if operation.getAttribute("name") == "GetCapabilities":
-            constraint = getFirstElementByTagName(operation, "ows:Constraint")
-            if constraint.getAttribute("name") == "GetEncoding":
-                requestEncoding = getFirstElementValueByTagName(constraint, "ows:Value")
-
-result = {
-    "type": "wmts",
-    "url": tileUrl,
-    "name": layerName,
-    "format": format,
-    "requestEncoding": requestEncoding,
-    "tileMatrixPrefix": "",
-    "tileMatrixSet": tileMatrixName,
-    "originX": origin[0],
-    "originY": origin[1],
-    "projection": crs,
-    "tileSize": tileSize,
-    "style": styleIdentifier,
-    "bbox": bbox,
-    "matrixIds": matrixIds,
-    "resolutions": resolutions,
-    "thumbnail": layerName + ".jpg",
-}
-
-print(json.dumps(result, indent=2))
+    print(json.dumps(result, indent=2))
@@ -1,61 +1,157 @@
 #!/usr/bin/python3
 
+# Move translation message ids in tsconfig.json and all language files
+#
+# Usage:
+#   move_msgid.py oldpath newpath
+#   move_msgid.py -m mapping
+#
+# The mapping file contains one "oldpath newpath" move per line (empty lines and lines starting
+# with # are ignored), or a JSON object {"oldpath": "newpath", ...}. Moves are applied in order,
+# all moves are applied to a language file in one pass and the language files are processed in
+# parallel. A failed move leaves the file unchanged, files are only written if they change.
+
+import argparse
 import json
+import os
 import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
 
-if len(sys.argv) < 3:
-    print(f"Usage: {sys.argv[0]} oldpath newpath", file=sys.stderr)
-    sys.exit(1)
 
-oldpath = sys.argv[1]
-old_parts = oldpath.split(".")
-newpath = sys.argv[2]
-new_parts = newpath.split(".")
+def read_mapping(filename):
+    with open(filename) as fh:
+        text = fh.read()
+    if text.lstrip().startswith("{"):
+        return list(json.loads(text).items())
+    moves = []
+    for lineno, line in enumerate(text.splitlines(), 1):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        parts = line.split()
+        if len(parts) != 2:
+            raise ValueError(f"{filename}:{lineno}: expected 'oldpath newpath'")
+        moves.append((parts[0], parts[1]))
+    return moves
 
-def move_path(root):
-    current = root
+
+def move_path(root, oldpath, newpath):
+    old_parts = oldpath.split(".")
+    new_parts = newpath.split(".")
+    old_parent = root
     for p in old_parts[:-1]:
-        if not isinstance(current, dict):
-            raise TypeError(f"Path '{path}' traverses a non-dict value")
-        current = current[p]
-    try:
-        value = current.pop(old_parts[1])
-    except:
+        if not isinstance(old_parent, dict) or p not in old_parent:
+            raise KeyError(f"Key '{oldpath}' does not exist")
+        old_parent = old_parent[p]
+    if not isinstance(old_parent, dict) or old_parts[-1] not in old_parent:
         raise KeyError(f"Key '{oldpath}' does not exist")
 
+    # check newpath before removing anything, a failed move leaves root unchanged
     current = root
     for p in new_parts[:-1]:
-        if p not in current:
-            current[p] = {}
-        elif not isinstance(current[p], dict):
+        # missing parents are created, as is the old key if newpath runs through it
+        if p not in current or (current is old_parent and p == old_parts[-1]):
+            break
+        if not isinstance(current[p], dict):
             raise TypeError(f"Path '{newpath}' traverses a non-dict value")
         current = current[p]
+    value = old_parent.pop(old_parts[-1])
+
+    current = root
+    for p in new_parts[:-1]:
+        current = current.setdefault(p, {})
     if not new_parts[-1] in current or value:
         current[new_parts[-1]] = value
 
-with open('tsconfig.json') as fh:
-    tsconfig = json.load(fh)
-print(f'Moving {oldpath} to {newpath} in tsconfig.json')
-if oldpath in tsconfig['extra_strings']:
-    tsconfig['extra_strings'].remove(oldpath)
-    tsconfig['extra_strings'].append(newpath)
-if oldpath in tsconfig['strings']:
-    tsconfig['strings'].remove(oldpath)
-    tsconfig['strings'].append(newpath)
-with open('tsconfig.json', 'w') as fh:
-    json.dump(tsconfig, fh, indent=2)
-
-
-for lang in tsconfig['languages']:
-    print(f'Moving {oldpath} to {newpath} in {lang}.json')
-    with open(f'{lang}.json') as fh:
-        data = json.load(fh)
+
+# write filename atomically if its contents differ, returns whether the file was written
+def write_if_changed(filename, data):
+    # same formatting as scripts/updateTranslations.js
+    text = json.dumps(data, indent=2, ensure_ascii=False) + "\n"
+    with open(filename, encoding='utf-8') as fh:
+        if fh.read() == text:
+            return False
+    fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)), prefix=f'.{os.path.basename(filename)}.')
     try:
-        move_path(data['messages'])
+        with os.fdopen(fd, 'w', encoding='utf-8') as fh:
+            fh.write(text)
+        os.chmod(tmpname, os.stat(filename).st_mode & 0o777)
+        os.replace(tmpname, filename)
     except:
-        print(f'Failed to move {oldpath} to {newpath} in {lang}.json')
-        continue
-    with open(f'{lang}.json', 'w') as fh:
-        json.dump(data, fh, indent=2, ensure_ascii=False)
+        os.unlink(tmpname)
+        raise
+    return True
+
+
+# returns (changed, list of (oldpath, newpath, error) of the failed moves)
+def move_messages(lang, moves):
+    with open(f'{lang}.json', encoding='utf-8') as fh:
+        data = json.load(fh)
+    failed = []
+    for oldpath, newpath in moves:
+        try:
+            move_path(data['messages'], oldpath, newpath)
+        except (KeyError, TypeError) as e:
+            failed.append((oldpath, newpath, e.args[0]))
+    return write_if_changed(f'{lang}.json', data), failed
+
+
+def move_strings(tsconfig, moves):
+    for oldpath, newpath in moves:
+        for key in ['extra_strings', 'strings']:
+            if oldpath in tsconfig[key]:
+                tsconfig[key].remove(oldpath)
+                tsconfig[key].append(newpath)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Move translation message ids in tsconfig.json and all language files")
+    parser.add_argument("oldpath", nargs="?", help="Message id to move, i.e. appmenu.items.Foo")
+    parser.add_argument("newpath", nargs="?", help="New message id")
+    parser.add_argument("-m", "--mapping", help="File with the moves to apply, see above")
+    args = parser.parse_args()
+    if args.mapping and not args.oldpath:
+        moves = read_mapping(args.mapping)
+    elif not args.mapping and args.newpath:
+        moves = [(args.oldpath, args.newpath)]
+    else:
+        parser.print_usage(sys.stderr)
+        sys.exit(1)
+
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    with open('tsconfig.json', encoding='utf-8') as fh:
+        tsconfig = json.load(fh)
+    print(f'Moving {len(moves)} message ids')
+
+    failures = {}
+    with ProcessPoolExecutor() as executor:
+        futures = {lang: executor.submit(move_messages, lang, moves) for lang in tsconfig['languages']}
+        for lang, future in futures.items():
+            try:
+                changed, failed = future.result()
+                print(f'{lang}.json: {len(moves) - len(failed)} moved, {len(failed)} failed{"" if changed else ", unchanged"}')
+            except Exception as e:
+                failed = [(None, None, f"{type(e).__name__}: {e}")]
+                print(f'{lang}.json: failed')
+            if failed:
+                failures[lang] = failed
+
+    # moves which failed in all language files are not applied to tsconfig.json either,
+    # a language file which could not be processed at all has a (None, None) entry
+    failed_moves = {lang: {(oldpath, newpath) for oldpath, newpath, _ in failed} for lang, failed in failures.items()}
+    def failed_everywhere(move):
+        return all(move in failed_moves.get(lang, ()) or (None, None) in failed_moves.get(lang, ()) for lang in tsconfig['languages'])
+    tsconfig_moves = [move for move in moves if not failed_everywhere(move)]
+    move_strings(tsconfig, tsconfig_moves)
+    changed = write_if_changed('tsconfig.json', tsconfig)
+    print(f'tsconfig.json: {len(tsconfig_moves)} moved{"" if changed else ", unchanged"}')
 
-print("Done!")
+    if failures:
+        print("\nFailed moves:", file=sys.stderr)
+        for lang, failed in failures.items():
+            for oldpath, newpath, error in failed:
+                move = f'{oldpath} -> {newpath}: ' if oldpath else ''
+                print(f'  {lang}.json: {move}{error}', file=sys.stderr)
+        sys.exit(1)
+    print("Done!")
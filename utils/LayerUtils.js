@@ -854,6 +854,33 @@ const LayerUtils = {
             return url.format(urlParts);
         }
     },
+    getLegendSprite(layer, sublayer, bboxDependentLegend, scaleDependentLegend, extraLegendParameters) {
+        // Legend sprites (see themesConfig.py --legend-sprites) contain the static legends of the theme sublayers
+        if (layer.type !== "wms" || !layer.legendSprite || layer === sublayer || extraLegendParameters || layer.params?.FILTER) {
+            return null;
+        }
+        if (scaleDependentLegend === true || (scaleDependentLegend === "theme" && layer.role === LayerRole.THEME)) {
+            return null;
+        }
+        if (bboxDependentLegend === true || (bboxDependentLegend === "theme" && layer.role === LayerRole.THEME)) {
+            return null;
+        }
+        if (layer.externalLayerMap && layer.externalLayerMap[sublayer.name]) {
+            return null;
+        }
+        const styles = layer.legendSprite.layers[sublayer.name] || {};
+        const offsets = styles[sublayer.style ?? ""] ?? (sublayer.style === undefined ? Object.values(styles)[0] : undefined);
+        if (!offsets) {
+            return null;
+        }
+        return {
+            src: ConfigUtils.getAssetsPath() + "/" + layer.legendSprite.src,
+            x: offsets[0],
+            y: offsets[1],
+            width: offsets[2],
+            height: offsets[3]
+        };
+    },
     layerScaleInRange(layer, mapScale) {
         return (layer.minScale === undefined || mapScale >= layer.minScale) && (layer.maxScale === undefined || mapScale < layer.maxScale);
     },
@@ -127,6 +127,7 @@ const ThemeUtils = {
             role: role,
             attribution: theme.attribution,
             legendUrl: ThemeUtils.inheritBaseUrlParams(theme.legendUrl, theme.url, baseParams),
+            legendSprite: theme.legendSprite,
             printUrl: ThemeUtils.inheritBaseUrlParams(theme.printUrl, theme.url, baseParams),
             featureInfoUrl: ThemeUtils.inheritBaseUrlParams(theme.featureInfoUrl, theme.url, baseParams),
             infoFormats: theme.infoFormats,
@@ -239,6 +240,70 @@ const ThemeUtils = {
             }))
         }];
     },
+    getThumbnailSrcSet(entry, assetsPath) {
+        const variants = entry.thumbnailVariants || [];
+        const type = variants.find(variant => variant.type === "image/webp") ? "image/webp" : "image/png";
+        const srcSet = variants.filter(variant => variant.type === type).map(variant => assetsPath + "/" + variant.src + " " + variant.scale + "x");
+        return srcSet.length > 0 ? srcSet.join(", ") : undefined;
+    },
+    expandCompactThemes(data) {
+        // Expand themes.json written in the compact schema (themesConfig.py --compact) to the regular structure
+        if (!data.compact) {
+            return data;
+        }
+        const expand = (node) => {
+            if (Array.isArray(node)) {
+                return node.map(expand);
+            } else if (node !== null && typeof node === "object") {
+                const keys = Object.keys(node);
+                if (keys.length === 1 && keys[0] === "$ref") {
+                    return expand(data.shared[node.$ref]);
+                }
+                const res = {};
+                keys.forEach(key => {
+                    res[key] = expand(node[key]);
+                });
+                return res;
+            }
+            return node;
+        };
+        const applyDefaults = (entry, defaults) => {
+            const missing = entry.$missing || [];
+            delete entry.$missing;
+            Object.entries(defaults).forEach(([key, value]) => {
+                if (!(key in entry) && !missing.includes(key)) {
+                    entry[key] = expand(value);
+                }
+            });
+        };
+        const expandLayer = (layer) => {
+            applyDefaults(layer, layer.sublayers ? data.defaults.group : data.defaults.layer);
+            (layer.sublayers || []).forEach(expandLayer);
+        };
+        const expandGroup = (group) => {
+            group.items.forEach(item => {
+                applyDefaults(item, data.defaults.theme);
+                (item.sublayers || []).forEach(expandLayer);
+            });
+            group.subdirs.forEach(expandGroup);
+        };
+        // Keys of the themes starting with "$" are escaped with another "$", unescaped once $missing is consumed
+        const unescape = (node) => {
+            if (Array.isArray(node)) {
+                return node.map(unescape);
+            } else if (node !== null && typeof node === "object") {
+                const res = {};
+                Object.entries(node).forEach(([key, value]) => {
+                    res[key.startsWith("$$") ? key.slice(1) : key] = unescape(value);
+                });
+                return res;
+            }
+            return node;
+        };
+        const result = {themes: expand(data.themes)};
+        expandGroup(result.themes);
+        return unescape(result);
+    },
     getThemeNames(themes) {
         const names = (themes.items || []).reduce((res, theme) => ({...res, [theme.id]: theme.title}), {});
         (themes.subdirs || []).forEach(group => {